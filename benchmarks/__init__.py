@@ -0,0 +1 @@
+"""Benchmarks of the collector hot paths, see benchmarks/README.md"""
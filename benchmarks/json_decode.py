@@ -0,0 +1,113 @@
+"""
+Benchmark of websocket frame decoding, stdlib json against orjson.
+
+Decodes order book frames (the largest and most frequent payloads) of
+several depths with every available decoder and reports the CPU
+microseconds per message, stored as JSON like the pipeline benchmark:
+
+    python -m benchmarks.json_decode --depths 10 50 200 1000 --messages 2000
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.pipeline import RESULTS_DIR, git_commit
+from benchmarks.synthetic import order_book
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEPTHS = (10, 50, 200, 1000)
+
+
+def decoders() -> Dict[str, Callable[[bytes], Any]]:
+    available = {"json": json.loads}
+    if orjson is not None:
+        available["orjson"] = orjson.loads
+    return available
+
+
+def frames(depth: int, count: int, seed: int = 0) -> List[bytes]:
+    """
+    Encoded order book frames as received from the websocket
+    """
+    rng = random.Random(seed)
+    now = time.time() * 1000
+    return [
+        json.dumps(order_book("BTC/USDT", seq, now, depth, rng), separators=(",", ":")).encode()
+        for seq in range(count)
+    ]
+
+
+def time_decoder(decode: Callable[[bytes], Any], payloads: List[bytes], repeat: int = 3) -> float:
+    """
+    Best of repeat runs, CPU microseconds per message
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.process_time()
+        for payload in payloads:
+            decode(payload)
+        best = min(best, time.process_time() - started)
+    return best / len(payloads) * 1e6
+
+
+def run_benchmark(depths: List[int] = list(DEPTHS), messages: int = 2000, repeat: int = 3) -> Dict[str, Any]:
+    results = {}
+    for depth in depths:
+        payloads = frames(depth, messages)
+        row: Dict[str, Any] = {"frame_bytes": sum(map(len, payloads)) // len(payloads)}
+        for name, decode in decoders().items():
+            row[f"{name}_us_per_message"] = time_decoder(decode, payloads, repeat)
+        if "orjson_us_per_message" in row:
+            row["speedup"] = row["json_us_per_message"] / row["orjson_us_per_message"]
+        results[str(depth)] = row
+    return results
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depths", nargs="+", type=int, default=list(DEPTHS), help="Order book levels per side")
+    parser.add_argument("--messages", type=int, default=2000, help="Frames decoded per depth and run")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per decoder, the best one is reported")
+    parser.add_argument("--output", type=Path, default=RESULTS_DIR, help="Directory for the JSON result")
+    parser.add_argument("--no-save", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    params = {"depths": args.depths, "messages": args.messages, "repeat": args.repeat}
+    if orjson is None:
+        print("orjson not installed, timing the stdlib json module only")
+    results = run_benchmark(**params)
+    commit = git_commit()
+    report = {
+        "benchmark": "json_decode",
+        "commit": commit,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+
+    if not args.no_save:
+        args.output.mkdir(parents=True, exist_ok=True)
+        path = args.output / f"json_decode-{commit or 'nocommit'}-{int(time.time())}.json"
+        path.write_text(json.dumps(report, indent=2))
+        print(f"Saved to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
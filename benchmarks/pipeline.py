@@ -0,0 +1,255 @@
+"""
+Benchmark of the producer -> delegator -> consumer path.
+
+DataProducers fed by a SyntheticExchange push into a ProducerPipeline, the
+ConsumerPipeline delegator fans out to K consumers, each timing every
+message from receive to consume. Reports throughput, p50 / p99 latency,
+CPU time and peak RSS, and stores the result as JSON named after the
+current commit so runs can be compared across commits:
+
+    python -m benchmarks.pipeline --symbols 20 --consumers 4 --duration 10
+    python -m benchmarks.pipeline --loop uvloop
+    python -m benchmarks.pipeline --compare benchmarks/results/<baseline>.json
+"""
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from benchmarks.synthetic import SyntheticExchange
+from crypto_data_collector import runtime
+from crypto_data_collector.consumer import BaseConsumer, ConsumerPipeline
+from crypto_data_collector.metrics import Histogram
+from crypto_data_collector.orderbook import OrderBookEngine
+from crypto_data_collector.producer import DataProducer, ProducerPipeline
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.records import Normalizer
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+STREAMS = ("watchTicker", "watchTrades", "watchOrderBook", "watchOHLCV")
+
+
+class TimingConsumer(BaseConsumer):
+    """
+    Times every message from receive to consume, unlike the sampled metrics
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.histogram = Histogram()
+        self.count = 0
+
+    async def run(self) -> None:
+        queue = self.data_queue
+        histogram = self.histogram
+        while True:
+            message = await queue.get()
+            histogram.record(time.time() * 1000 - message["received"])
+            self.count += 1
+            queue.task_done()
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(
+    symbols: int = 10,
+    streams: List[str] = list(STREAMS),
+    consumers: int = 2,
+    duration: float = 5.0,
+    warmup: float = 1.0,
+    rate: Optional[float] = None,
+    depth: int = 50,
+    normalize: bool = True,
+    orderbook_engine: bool = False,
+    ring_capacity: Optional[int] = None,
+    queue_size: int = 10_000
+    ) -> Dict[str, Any]:
+    """
+    Run the pipeline for warmup + duration seconds, returns the measurements
+    of the duration window
+    """
+    exchange = SyntheticExchange(rate=rate, depth=depth)
+    queue = BoundedQueue(maxsize=queue_size)
+    producer_pipeline = ProducerPipeline(data_queue=queue)
+    consumer_pipeline = ConsumerPipeline(data_queue=queue, ring_capacity=ring_capacity)
+    if orderbook_engine:
+        consumer_pipeline.add_stage(OrderBookEngine())
+    normalizer = Normalizer() if normalize else None
+
+    timing_consumers = [TimingConsumer(name=f"consumer-{i}") for i in range(consumers)]
+    for consumer in timing_consumers:
+        consumer_pipeline.add_consumer(name=consumer.name, consumer=consumer)
+    delegator = asyncio.create_task(consumer_pipeline.consumer_delegator(), name="consumer_delegator")
+
+    producers = []
+    for i in range(symbols):
+        for stream_name in streams:
+            producer = DataProducer(
+                exchange_name=exchange.name,
+                exchange=exchange,
+                symbol=f"SYM{i}/USDT",
+                stream_name=stream_name,
+                stream_method=getattr(exchange, stream_name),
+                stream_options={},
+                data_queue=queue,
+                normalizer=normalizer
+            )
+            producers.append(producer)
+            producer_pipeline.add_producer(producer.producer_name, producer)
+
+    await asyncio.sleep(warmup)
+    produced_start = sum(p.messages for p in producers)
+    consumed_start = [c.count for c in timing_consumers]
+    for consumer in timing_consumers:
+        consumer.histogram.reset()
+    cpu_start = time.process_time()
+    started = time.perf_counter()
+
+    await asyncio.sleep(duration)
+
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_start
+    produced = sum(p.messages for p in producers) - produced_start
+    consumed = [c.count - start for c, start in zip(timing_consumers, consumed_start)]
+    latency = Histogram()
+    for consumer in timing_consumers:
+        latency.merge(consumer.histogram)
+
+    for producer in producers:
+        await producer_pipeline.remove_producer(producer.producer_name)
+    delegator.cancel()
+    try:
+        await delegator
+    except asyncio.CancelledError:
+        pass
+    for consumer in timing_consumers:
+        await consumer_pipeline.remove_consumer(consumer.name)
+
+    return {
+        "produced_per_second": produced / elapsed,
+        "consumed_per_second": sum(consumed) / elapsed,
+        "cpu_us_per_message": cpu / produced * 1e6 if produced else None,
+        "latency_ms": latency.summary(),
+        "queue_high_water": queue.high_water,
+        "queue_dropped": queue.dropped,
+        "peak_rss_mb": peak_rss_mb(),
+        "elapsed_s": elapsed,
+    }
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Regressions of result against baseline beyond threshold (a fraction)
+    """
+    regressions = []
+    current, previous = result["results"], baseline["results"]
+    checks = (
+        ("produced_per_second", current["produced_per_second"], previous["produced_per_second"], -1),
+        ("consumed_per_second", current["consumed_per_second"], previous["consumed_per_second"], -1),
+        ("p99_ms", current["latency_ms"]["p99"], previous["latency_ms"]["p99"], 1),
+        ("peak_rss_mb", current["peak_rss_mb"], previous["peak_rss_mb"], 1),
+    )
+    for name, now, then, worse in checks:
+        if not then:
+            continue
+        change = (now - then) / then
+        print(f"{name:>22}: {then:12.2f} -> {now:12.2f} ({change:+.1%})")
+        if change * worse > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--symbols", type=int, default=10, help="Symbols, every symbol runs every stream")
+    parser.add_argument("--streams", nargs="+", default=list(STREAMS), choices=STREAMS)
+    parser.add_argument("--consumers", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=5.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=1.0, help="Seconds before measuring")
+    parser.add_argument("--rate", type=float, default=None, help="Messages per second per producer, unthrottled by default")
+    parser.add_argument("--depth", type=int, default=50, help="Order book levels per side")
+    parser.add_argument("--raw", action="store_true", help="Skip normalization")
+    parser.add_argument("--orderbook-engine", action="store_true", help="Run the OrderBookEngine stage")
+    parser.add_argument("--ring", type=int, default=None, metavar="CAPACITY", help="Fan out through a BroadcastRing")
+    parser.add_argument("--queue-size", type=int, default=10_000)
+    parser.add_argument("--loop", default="asyncio", choices=runtime.LOOPS, help="Event loop, see runtime.py")
+    parser.add_argument("--output", type=Path, default=RESULTS_DIR, help="Directory for the JSON result")
+    parser.add_argument("--no-save", action="store_true")
+    parser.add_argument("--compare", type=Path, default=None, help="Baseline result to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Regression tolerance, fraction")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    params = {
+        "symbols": args.symbols,
+        "streams": args.streams,
+        "consumers": args.consumers,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "rate": args.rate,
+        "depth": args.depth,
+        "normalize": not args.raw,
+        "orderbook_engine": args.orderbook_engine,
+        "ring_capacity": args.ring,
+        "queue_size": args.queue_size,
+    }
+    results = runtime.run(run_benchmark(**params), loop=args.loop)
+    params["loop"] = args.loop
+    commit = git_commit()
+    report = {
+        "benchmark": "pipeline",
+        "commit": commit,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+
+    if not args.no_save:
+        args.output.mkdir(parents=True, exist_ok=True)
+        path = args.output / f"pipeline-{commit or 'nocommit'}-{int(time.time())}.json"
+        path.write_text(json.dumps(report, indent=2))
+        print(f"Saved to {path}")
+
+    if args.compare is not None:
+        baseline = json.loads(args.compare.read_text())
+        if baseline.get("params") != params:
+            print("Warning: baseline was run with different parameters")
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"Regressions beyond {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
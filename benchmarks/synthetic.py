@@ -0,0 +1,121 @@
+"""
+In-process synthetic exchange for benchmarks.
+
+SyntheticExchange stands in for a ccxt.pro exchange object: its watch*
+methods return ccxt shaped payloads (tickers, trades, order books,
+candles) at a configurable rate per stream, without any network. Plug its
+methods into DataProducer as stream_method.
+"""
+import time
+import random
+import asyncio
+
+from typing import Any, Dict, List, Optional
+
+
+def ticker(symbol: str, seq: int, now: float) -> Dict[str, Any]:
+    last = 50_000.0 + (seq % 1000) * 0.5
+    return {
+        "symbol": symbol, "timestamp": int(now), "datetime": None,
+        "high": last + 100, "low": last - 100, "bid": last - 0.5, "bidVolume": 1.2,
+        "ask": last + 0.5, "askVolume": 0.8, "vwap": last, "open": last - 10, "close": last,
+        "last": last, "previousClose": None, "change": 10.0, "percentage": 0.02, "average": last - 5,
+        "baseVolume": 1234.5, "quoteVolume": 61_725_000.0, "info": {"s": symbol, "c": str(last), "E": int(now)},
+    }
+
+
+def trades(symbol: str, seq: int, now: float, count: int) -> List[Dict[str, Any]]:
+    return [
+        {
+            "info": {"t": seq * count + i, "p": "50000.5", "q": "0.01"}, "id": str(seq * count + i),
+            "timestamp": int(now), "datetime": None, "symbol": symbol, "order": None, "type": None,
+            "side": "buy" if i % 2 else "sell", "takerOrMaker": "taker", "price": 50_000.0 + i * 0.5,
+            "amount": 0.01 * (i + 1), "cost": 500.0, "fee": None, "fees": [],
+        }
+        for i in range(count)
+    ]
+
+
+def order_book(symbol: str, seq: int, now: float, depth: int, rng: random.Random) -> Dict[str, Any]:
+    mid = 50_000.0 + (seq % 200) * 0.5
+    bids = [[mid - 0.5 * (i + 1), round(rng.uniform(0.01, 5.0), 4)] for i in range(depth)]
+    asks = [[mid + 0.5 * (i + 1), round(rng.uniform(0.01, 5.0), 4)] for i in range(depth)]
+    return {
+        "symbol": symbol, "timestamp": int(now), "datetime": None, "nonce": seq,
+        "bids": bids, "asks": asks,
+    }
+
+
+def ohlcv(seq: int, now: float) -> List[List[float]]:
+    open_time = int(now // 60_000 * 60_000)
+    return [[open_time, 50_000.0, 50_010.0, 49_990.0, 50_000.0 + seq % 10, 12.5]]
+
+
+class SyntheticExchange:
+    """
+    Args:
+        rate (float, optional): Messages per second per stream and symbol, None is unthrottled
+        depth (int): Levels per side of order books
+        trades_per_message (int): Trades per watchTrades result
+        seed (int): Seed of the order book sizes
+    """
+
+    def __init__(
+        self,
+        name: str = "synthetic",
+        rate: Optional[float] = None,
+        depth: int = 50,
+        trades_per_message: int = 3,
+        seed: int = 0
+        ) -> None:
+        self.name = name
+        self.id = name
+        self.rate = rate
+        self.depth = depth
+        self.trades_per_message = trades_per_message
+        self.rng = random.Random(seed)
+        self.has = {
+            "watchTicker": True, "watchTrades": True, "watchOrderBook": True, "watchOHLCV": True,
+        }
+        self.sent = 0
+        self.closed = False
+        # (stream, symbol) -> (sequence, next send time)
+        self._schedule: Dict[tuple, List[float]] = {}
+
+    async def _tick(self, stream: str, symbol: str) -> int:
+        loop = asyncio.get_running_loop()
+        schedule = self._schedule.get((stream, symbol))
+        if schedule is None:
+            schedule = self._schedule[(stream, symbol)] = [0, loop.time()]
+        schedule[0] += 1
+        if self.rate is None:
+            # A websocket read always suspends, even when a frame is already buffered
+            await asyncio.sleep(0)
+        else:
+            schedule[1] += 1 / self.rate
+            delay = schedule[1] - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                await asyncio.sleep(0)
+        self.sent += 1
+        return int(schedule[0])
+
+    async def watchTicker(self, symbol: str, params: Optional[dict] = None) -> Dict[str, Any]:
+        seq = await self._tick("ticker", symbol)
+        return ticker(symbol, seq, time.time() * 1000)
+
+    async def watchTrades(self, symbol: str, since=None, limit=None, params: Optional[dict] = None) -> List[Dict[str, Any]]:
+        seq = await self._tick("trades", symbol)
+        return trades(symbol, seq, time.time() * 1000, self.trades_per_message)
+
+    async def watchOrderBook(self, symbol: str, limit=None, params: Optional[dict] = None) -> Dict[str, Any]:
+        seq = await self._tick("orderbook", symbol)
+        return order_book(symbol, seq, time.time() * 1000, self.depth, self.rng)
+
+    async def watchOHLCV(self, symbol: str, timeframe: str = "1m", since=None, limit=None, params: Optional[dict] = None) -> List[List[float]]:
+        seq = await self._tick("ohlcv", symbol)
+        return ohlcv(seq, time.time() * 1000)
+
+    async def close(self) -> None:
+        self.closed = True
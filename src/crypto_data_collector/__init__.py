@@ -1,10 +1,12 @@
 """crypto_data_collector — async producer/consumer pipeline for websocket data."""
 import logging
 
-from .consumer import ConsumerPipeline, BaseConsumer 
+from .consumer import ConsumerPipeline, BaseConsumer, BatchConsumer
 from .producer import ProducerPipeline, DataProducer
+from .queues import BoundedQueue, OverflowPolicy
+from .replay import ReplayProducer
 
 
-__all__ = ["DataPipeline", "DataProducer", "BaseConsumer", "ConsumerPipeline"]
+__all__ = ["DataPipeline", "DataProducer", "ReplayProducer", "BaseConsumer", "BatchConsumer", "ConsumerPipeline", "BoundedQueue", "OverflowPolicy"]
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
\ No newline at end of file
@@ -3,16 +3,29 @@ Example usage
 
 Usage:
     poetry run python -m crypto_data_collector
+    CRYPTO_COLLECTOR_LOOP=asyncio poetry run python -m crypto_data_collector
 """
+import os
 import asyncio
 import logging
 
 from pathlib import Path
 
-from crypto_data_collector.consumer import ConsumerPipeline, BaseConsumer
-from crypto_data_collector.producer import ProducerPipeline, DataProducer
-from crypto_data_collector.helpers import ConfigHandler, setup_logger
+from crypto_data_collector.bars import BarAggregator
+from crypto_data_collector.control import ControlPlane
+from crypto_data_collector.consumer import ConsumerPipeline, BaseConsumer, BatchConsumer
+from crypto_data_collector.dedupe import TradeDeduplicator
+from crypto_data_collector.producer import ProducerPipeline
+from crypto_data_collector.queues import BoundedQueue, OverflowPolicy
+from crypto_data_collector.records import Normalizer
+from crypto_data_collector.helpers import ConfigHandler, Subscription, setup_logger
+from crypto_data_collector.market_cache import MarketCache
+from crypto_data_collector.metrics import MetricsCollector
+from crypto_data_collector.orderbook import OrderBookEngine
 from crypto_data_collector.registry import Registry
+from crypto_data_collector.reload import ConfigReloader
+from crypto_data_collector import runtime
+from crypto_data_collector.sharding import ShardSupervisor
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +39,8 @@ class ExampleConsumer(BaseConsumer):
 					######## Do something with the data ########
 					######## Put your code here ################
 					print(f"{self.name} ran")
+					# Optional, counts the message and samples its latency for metrics
+					self.mark_consumed(data)
 				finally:
 					self.data_queue.task_done()
 				
@@ -55,6 +70,8 @@ class ExampleConsumer2(BaseConsumer):
 					######## Do something with the data ########
 					######## Put your code here ################
 					print(f"{self.name} ran")
+					# Optional, counts the message and samples its latency for metrics
+					self.mark_consumed(data)
 				finally:
 					self.data_queue.task_done()
 				
@@ -74,6 +91,14 @@ class ExampleConsumer2(BaseConsumer):
 					finally:
 						self.data_queue.task_done()
 			raise
+
+
+class ExampleBatchConsumer(BatchConsumer):
+	# Receives lists of messages, draining on cancel is handled by BatchConsumer
+	async def run_batch(self, batch):
+		######## Do something with the data ########
+		######## Put your code here ################
+		print(f"{self.name} ran with {len(batch)} messages")
 	
 
 async def main():
@@ -99,92 +124,178 @@ async def main():
 	config_handler = ConfigHandler(project_root=project_root)
 	config = config_handler.get_config()
 
+	# Optional, markets are loaded from disk instead of the network on restarts
+	# while the cache is younger than ttl_s
+	cache_config = config.get("market_cache") or {}
+	market_cache = None
+	if cache_config.get("cache_dir"):
+		# Absolute, shard processes share the cache
+		cache_config["cache_dir"] = str(project_root / cache_config["cache_dir"])
+		market_cache = MarketCache(**cache_config)
+
 	# Instantiate Pipelines and Registry
-	registry = Registry()
+	registry = Registry(market_cache=market_cache)
 	# This is the main queue between producers and consumer delegator
-	queue = asyncio.Queue()
+	# Bounded so a slow consumer cannot grow memory without limit
+	queue_config = config.get("queue", {})
+	queue = BoundedQueue(
+		maxsize=queue_config.get("maxsize", 0),
+		policy=queue_config.get("policy", OverflowPolicy.BLOCK)
+		)
+
+	# Optional, converts raw ccxt output to compact records
+	# Set keep_info=True to keep the raw exchange payload on trades and tickers
+	normalizer = Normalizer(keep_info=False)
 
 	producer_pipeline = ProducerPipeline(data_queue=queue)
 	consumer_pipeline = ConsumerPipeline(data_queue=queue)
 
-	# Register all exchanges, symbols, and streams from the config
-	# Data Producer when created: STAGED, RUNNING if running without
-	# Registry holds config data for the producers
+	# Optional, drops trades repeated after re-subscribing and reports trade gaps
+	consumer_pipeline.add_stage(TradeDeduplicator(window=4096))
+	# Optional, builds OHLCV + VWAP bars from trades, sent as exchange|symbol|bars_<interval>
+	consumer_pipeline.add_stage(BarAggregator(intervals=("1s", "1m", "5m", "1h")))
+	# Optional, replaces full order books with deltas and periodic snapshots
+	consumer_pipeline.add_stage(OrderBookEngine(snapshot_interval=1000))
+
+	# Per stream overflow policies of the main queue
 	for exchange_name, exch_data in config["exchanges"].items():
-		await registry.register_exchange(exchange_name, exch_data["properties"])
 		for symbol, symbol_data in exch_data["symbols"].items():
-			await registry.register_symbol(exchange_name, symbol)
 			for stream_name, stream_info in symbol_data["streams"].items():
-				stream_args = stream_info.get('options', {})
-				await registry.register_stream(exchange_name, symbol, stream_name, stream_args)
-				
-				exch_obj = registry.get_exchange_object(exchange_name)
-				stream_method = registry.get_stream_method(exchange_name, symbol, stream_name)
-
-				producer = DataProducer(
-					exchange_name=exchange_name,
-					exchange=exch_obj,
-					symbol=symbol,
-					stream_name=stream_name,
-					stream_method=stream_method,
-					stream_options=stream_args,
-					data_queue=producer_pipeline.get_data_queue()
-				)
-				
-				# Register producer with producer pipeline and implicitly start producer
-				producer_pipeline.add_producer(
-					producer_name = producer.producer_name,
-					producer = producer
+				if stream_info.get("overflow"):
+					queue.set_policy(f"{exchange_name}|{symbol}|{stream_name}", stream_info["overflow"])
+
+	# Register all exchanges, symbols, and streams from the config
+	# Data Producer when created: STAGED, RUNNING if running without
+	# Registry holds config data for the producers
+	# Set "shards" in the config to run the producers in that many worker
+	# processes, each with its own event loop, instead of on this one
+	shards = config.get("shards", 0)
+	if shards > 1:
+		supervisor = ShardSupervisor(config, shards=shards, data_queue=queue)
+		await supervisor.start()
+	else:
+		# Exchanges register concurrently
+		await registry.register_config(config)
+		# Set "grouped" in the config to serve all symbols of a stream from one
+		# watch*ForSymbols subscription where the exchange supports it
+		producers = registry.create_producers(
+			data_queue=producer_pipeline.get_data_queue(),
+			normalizer=normalizer,
+			grouped=config.get("grouped", False)
+			)
+		for producer in producers:
+			# Register producer with producer pipeline and implicitly start producer
+			producer_pipeline.add_producer(
+				producer_name = producer.producer_name,
+				producer = producer
+			)
+
+		# Optional, applies edits of config/producers.yaml without a restart,
+		# only the streams that changed are started / stopped
+		reload_config = config.get("reload") or {}
+		if reload_config.get("interval") and not config.get("grouped", False):
+			reloader = ConfigReloader(
+				registry,
+				producer_pipeline,
+				project_root,
+				normalizer=normalizer,
+				interval=reload_config["interval"],
+				config=config
 				)
+			asyncio.create_task(reloader.run(), name="config_reloader")
+
 
+	# Only the latest pending ticker per symbol is kept if this consumer lags
+	exampleconsumer = ExampleConsumer(conflate_streams=["ticker"])
+	# Drop the oldest messages instead of blocking the delegator if this consumer lags
+	# and only route trades and tickers to it. Order book deltas from the
+	# OrderBookEngine are never dropped, they would fall back to blocking
+	exampleconsumer2 = ExampleConsumer2(
+		maxsize=1000,
+		overflow_policy=OverflowPolicy.DROP_OLDEST,
+		subscriptions=["*|*|watchTrades", "*|*|watchTicker"]
+		)
 
-	exampleconsumer = ExampleConsumer()
-	exampleconsumer2 = ExampleConsumer2()
+	# Up to 500 messages per batch, or whatever arrived within 250ms
+	# Add durable_dir=project_root / "cache" / "queues" / "ExampleBatchConsumer" to queue
+	# to disk, a slow sink then never drops and resumes where it stopped after a restart
+	# Routed by the "consumers: ExampleBatchConsumer:" config entry, everything without one
+	consumers_config = config.get("consumers") or {}
+	examplebatchconsumer = ExampleBatchConsumer(
+		batch_size=500,
+		batch_timeout_ms=250,
+		subscriptions=Subscription.from_config(consumers_config.get("ExampleBatchConsumer"))
+		)
 
 	# Register consumer with consumer pipeline and implicitly start consumer
 	consumer_pipeline.add_consumer(name="ExampleConsumer", consumer=exampleconsumer)
 	consumer_pipeline.add_consumer(name="ExampleConsumer2", consumer=exampleconsumer2)
+	consumer_pipeline.add_consumer(name="ExampleBatchConsumer", consumer=examplebatchconsumer)
 
 	asyncio.create_task(
 		consumer_pipeline.consumer_delegator(),
 		name="consumer_delegator"
 		)
 
-	await consumer_pipeline.remove_consumer("ExampleConsumer")
+	# Optional, Prometheus metrics on http://127.0.0.1:<port>/metrics and JSON on /stats
+	metrics_config = config.get("metrics", {})
+	metrics = MetricsCollector(producer_pipeline, consumer_pipeline)
+	if metrics_config.get("port"):
+		await metrics.serve(host=metrics_config.get("host", "127.0.0.1"), port=metrics_config["port"])
 
-	print(producer_pipeline.producers["binance|BTC/USD:BTC|watchOHLCV"].state)
+	# Optional, control API on http://127.0.0.1:<port> to list, add and remove
+	# streams and consumers at runtime, see control.py
+	# e.g. curl -X POST localhost:9465/producers -H "Authorization: Bearer <token>" -H "Content-Type: application/json"
+	#   -d '{"exchange": "kraken", "symbol": "BTC/USD", "stream": "watchTicker"}'
+	control_config = config.get("control", {})
+	if control_config.get("port"):
+		if not control_config.get("token"):
+			logger.warning("Control API enabled without a token, any local process can manage the collector")
+		control = ControlPlane(
+			registry,
+			producer_pipeline,
+			consumer_pipeline,
+			metrics=metrics,
+			normalizer=normalizer,
+			consumer_factories={"batch": ExampleBatchConsumer},
+			token=control_config.get("token")
+			)
+		await control.serve(host=control_config.get("host", "127.0.0.1"), port=control_config["port"])
 
-	await producer_pipeline.remove_producer("binance|BTC/USD:BTC|watchOHLCV")
-	await producer_pipeline.remove_producer("binance|BTC/USD:BTC|watchTicker")
-	await producer_pipeline.remove_producer("binance|BTC/USD:BTC|watchTrades")
-	await producer_pipeline.remove_producer("binance|BTC/USD:BTC|watchOrderBook")
-	
-	# Add a new producer
-	# #######################################################
-	await registry.register_exchange("kraken")
-	await registry.register_symbol("kraken","BTC/USD")
-	await registry.register_stream("kraken", "BTC/USD", "watchTicker")
-	
-	exch_obj = registry.get_exchange_object("kraken")
-	stream_method = registry.get_stream_method("kraken", "BTC/USD", "watchTicker")
-	
-	producer = DataProducer(
-		exchange_name="kraken",
-		exchange=exch_obj,
-		symbol="BTC/USD",
-		stream_name="watchTicker",
-		stream_method=stream_method,
-		stream_options={},
-		data_queue=producer_pipeline.get_data_queue()
+	# Runtime management demo, the producers live in worker processes when sharded
+	# and are keyed exchange|*|stream when grouped
+	if shards <= 1 and not config.get("grouped", False):
+		await consumer_pipeline.remove_consumer("ExampleConsumer")
+
+		print(producer_pipeline.producers["binance|BTC/USD:BTC|watchOHLCV"].state)
+
+		await producer_pipeline.remove_producer("binance|BTC/USD:BTC|watchOHLCV")
+		await producer_pipeline.remove_producer("binance|BTC/USD:BTC|watchTicker")
+		await producer_pipeline.remove_producer("binance|BTC/USD:BTC|watchTrades")
+		await producer_pipeline.remove_producer("binance|BTC/USD:BTC|watchOrderBook")
+
+		# Add a new producer
+		# #######################################################
+		await registry.register_exchange("kraken")
+		await registry.register_symbol("kraken","BTC/USD")
+		await registry.register_stream("kraken", "BTC/USD", "watchTicker")
+
+		# Same normalizer as the configured producers, consumers get records from every stream
+		producer = registry.create_producer(
+			"kraken",
+			"BTC/USD",
+			"watchTicker",
+			data_queue=producer_pipeline.get_data_queue(),
+			normalizer=normalizer
+			)
+
+		# Register producer with producer pipeline and implicitly start producer
+		producer_pipeline.add_producer(
+			producer_name = producer.producer_name,
+			producer = producer
 		)
-				
-	# Register producer with producer pipeline and implicitly start producer
-	producer_pipeline.add_producer(
-		producer_name = producer.producer_name,
-		producer = producer
-	)
-	# #######################################################
-	print(producer_pipeline.producers)
+		# #######################################################
+		print(producer_pipeline.producers)
 
 	# await producer_pipeline.remove_producer("binance|BTC/USDT:USDT|watchOHLCV")
 	# await producer_pipeline.remove_producer("binance|BTC/USDT:USDT|watchTicker")
@@ -208,4 +319,12 @@ async def main():
 
 	await asyncio.Event().wait()	
 
-asyncio.run(main(), debug=False)
\ No newline at end of file
+def cli():
+	"""
+	Entry point of the crypto-pipeline script and python -m crypto_data_collector
+	"""
+	# Event loop: auto (uvloop when installed), uvloop or asyncio
+	runtime.run(main(), loop=os.environ.get("CRYPTO_COLLECTOR_LOOP", "auto"), debug=False)
+
+if __name__ == "__main__":
+	cli()
\ No newline at end of file
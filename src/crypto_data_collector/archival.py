@@ -0,0 +1,337 @@
+"""
+Columnar archival consumer.
+
+Writes normalized trades, tickers, OHLCV and order books to Parquet or
+Arrow IPC files partitioned by exchange / symbol / stream / date:
+
+    <root>/exchange=binance/symbol=BTC_USDT_USDT/stream=watchTrades/date=2024-01-01/part-<time>-<n>.parquet
+
+With the OrderBookEngine stage, order book snapshots go to the
+watchOrderBook partition and the deltas between them to
+watchOrderBook_deltas, the book at any point is the last snapshot plus
+the following deltas (see OrderBookReplica). Other stage events (trade
+gaps) have no table, they are counted in skipped_by_type and skipped.
+
+Requires the optional pyarrow dependency (poetry install -E archival).
+"""
+import os
+import time
+import asyncio
+import logging
+
+from collections import Counter
+from pathlib import Path
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from crypto_data_collector.consumer import BatchConsumer
+from crypto_data_collector.helpers import producer_name_parser
+from crypto_data_collector.orderbook import OrderBookDelta
+from crypto_data_collector.records import (
+    Normalizer, OHLCVRecord, OrderBookRecord, Record, TickerRecord, TradeRecord
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+DAY_MS = 86_400_000
+
+# Column name -> arrow type name, in file column order
+COLUMNS: Dict[type, Tuple[Tuple[str, str], ...]] = {
+    TradeRecord: (
+        ("timestamp", "int64"), ("received", "float64"), ("id", "string"), ("price", "float64"),
+        ("amount", "float64"), ("side", "string"), ("taker_or_maker", "string"),
+    ),
+    TickerRecord: (
+        ("timestamp", "int64"), ("received", "float64"), ("bid", "float64"), ("ask", "float64"),
+        ("last", "float64"), ("bid_volume", "float64"), ("ask_volume", "float64"),
+        ("base_volume", "float64"), ("quote_volume", "float64"),
+    ),
+    OHLCVRecord: (
+        ("timestamp", "int64"), ("received", "float64"), ("open", "float64"), ("high", "float64"),
+        ("low", "float64"), ("close", "float64"), ("volume", "float64"),
+    ),
+    OrderBookRecord: (
+        ("timestamp", "int64"), ("received", "float64"), ("nonce", "int64"),
+        ("bids", "list<float64>"), ("asks", "list<float64>"),
+    ),
+    OrderBookDelta: (
+        ("timestamp", "int64"), ("received", "float64"), ("nonce", "int64"), ("prev_nonce", "int64"),
+        ("changes", "list<float64>"), ("checksum", "int64"),
+    ),
+}
+
+RECORD_TYPES = tuple(COLUMNS)
+
+# Record type -> suffix of its stream partition, for records sharing a
+# producer with another record type
+PARTITION_SUFFIX: Dict[type, str] = {OrderBookDelta: "_deltas"}
+
+
+def _arrow_type(name: str) -> "pa.DataType":
+    if name == "list<float64>":
+        return pa.list_(pa.float64())
+    return getattr(pa, name)()
+
+
+def sanitize(value: str) -> str:
+    """
+    Make a symbol safe for a path segment, BTC/USDT:USDT -> BTC_USDT_USDT
+    """
+    return value.replace("/", "_").replace(":", "_")
+
+
+@dataclass
+class PartitionBuffer():
+    record_type: type
+    directory: Path
+    columns: Dict[str, list] = field(default_factory=dict)
+    rows: int = 0
+    buffered_since: float = 0.0
+    # Open file state, only touched from the writer thread
+    writer: Any = None
+    path: Optional[Path] = None
+    file_rows: int = 0
+    file_bytes: int = 0
+    opened_at: float = 0.0
+
+
+class ArchivalConsumer(BatchConsumer):
+    """
+    Buffers normalized messages into columnar batches and writes them to
+    partitioned Parquet / Arrow IPC files.
+
+    Buffers are written out as one row group once they reach row_group_size
+    rows. A file is closed and a new one started once it holds max_rows rows,
+    reaches max_bytes on disk or has been open for max_age_s seconds. These
+    checks also run while no messages arrive, so quiet streams are written
+    and rolled on time. All file IO and compression runs in a worker thread.
+
+    Raw (non normalized) messages are normalized on the fly, streams with
+    no record type are skipped.
+
+    Args:
+        root_dir (str | Path): Root directory of the archive
+        file_format (str): "parquet" or "arrow"
+        compression (str): Codec passed to the writer, e.g. "zstd", "snappy", None
+        row_group_size (int): Buffered rows per partition before a write
+        flush_interval_s (float): Write buffered rows older than this even if
+            the row group is not full
+        max_rows (int): Roll the file after this many rows
+        max_bytes (int): Roll the file after it reaches this size on disk
+        max_age_s (float): Roll the file after it has been open this long,
+            also forces buffered rows out
+    """
+
+    def __init__(
+        self,
+        root_dir: Union[str, Path],
+        name: Optional[str] = None,
+        file_format: str = "parquet",
+        compression: Optional[str] = "zstd",
+        row_group_size: int = 50_000,
+        flush_interval_s: float = 60.0,
+        max_rows: int = 5_000_000,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_age_s: float = 3600.0,
+        normalizer: Optional[Normalizer] = None,
+        **kwargs: Any
+        ):
+        if pa is None:
+            raise ImportError("ArchivalConsumer requires pyarrow, install with: poetry install -E archival")
+        if file_format not in ("parquet", "arrow"):
+            raise ValueError(f"Unsupported file format: {file_format}")
+        super().__init__(name, **kwargs)
+        self.root_dir = Path(root_dir)
+        self.file_format = file_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.flush_interval_s = flush_interval_s
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.normalizer = normalizer or Normalizer()
+
+        self.partitions: Dict[Tuple[str, str, str, str], PartitionBuffer] = {}
+        self.files_written: int = 0
+        self.rows_written: int = 0
+        # Records without a table, by record type name
+        self.skipped_by_type: Counter = Counter()
+        self._producers: Dict[str, Tuple[str, str, str]] = {}
+        self._dates: Dict[int, str] = {}
+        self._schemas: Dict[type, "pa.Schema"] = {
+            record_type: pa.schema([(n, _arrow_type(t)) for n, t in columns])
+            for record_type, columns in COLUMNS.items()
+        }
+
+    async def run(self) -> None:
+        try:
+            await super().run()
+        finally:
+            await self.close()
+
+    async def get_batch(self) -> List[Any]:
+        # Wait for messages no longer than the next buffer or file is due,
+        # flush() runs between batches so it never overlaps run_batch
+        while True:
+            try:
+                return await asyncio.wait_for(super().get_batch(), self._next_due())
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    def _next_due(self) -> Optional[float]:
+        """
+        Seconds until flush() has a buffer to write or a file to roll by age,
+        None when nothing is buffered or open
+        """
+        due = [
+            deadline
+            for buffer in self.partitions.values()
+            for deadline in (
+                buffer.buffered_since + self.flush_interval_s if buffer.rows else None,
+                buffer.opened_at + self.max_age_s if buffer.writer is not None else None,
+            )
+            if deadline is not None
+        ]
+        if not due:
+            return None
+        return max(min(due) - time.time(), 0.0)
+
+    async def run_batch(self, batch: List[Dict[str, Any]]) -> None:
+        for message in batch:
+            data = message["data"]
+            if isinstance(data, list):
+                if data and not isinstance(data[0], RECORD_TYPES):
+                    data = self._normalize(message)
+                for record in data or ():
+                    self._append(message["producer"], record)
+            else:
+                if isinstance(data, Record) and not isinstance(data, RECORD_TYPES):
+                    # Stage events without a table, e.g. trade gaps
+                    name = type(data).__name__
+                    if not self.skipped_by_type[name]:
+                        logger.warning("Consumer [%s] has no table for %s records, skipping them", self.name, name)
+                    self.skipped_by_type[name] += 1
+                    continue
+                if not isinstance(data, RECORD_TYPES):
+                    data = self._normalize(message)
+                if data is not None:
+                    self._append(message["producer"], data)
+        await self.flush()
+
+    def _normalize(self, message: Dict[str, Any]) -> Any:
+        stream = producer_name_parser(message["producer"])[-1]
+        data = self.normalizer.normalize(stream, message["producer"], message["data"], message.get("received", 0.0))
+        if data is message["data"]:
+            # Not a stream we have a record type for
+            return None
+        return data
+
+    def _append(self, producer: str, record: Any) -> None:
+        parts = self._producers.get(producer)
+        if parts is None:
+            exchange, symbol, stream = producer_name_parser(producer)
+            parts = (exchange, sanitize(symbol), stream)
+            self._producers[producer] = parts
+
+        day = int((record.timestamp or record.received) // DAY_MS)
+        date = self._dates.get(day)
+        if date is None:
+            date = time.strftime("%Y-%m-%d", time.gmtime(day * 86_400))
+            self._dates[day] = date
+
+        record_type = type(record)
+        suffix = PARTITION_SUFFIX.get(record_type)
+        if suffix is not None:
+            parts = parts[:2] + (parts[2] + suffix,)
+        key = parts + (date,)
+        buffer = self.partitions.get(key)
+        if buffer is None:
+            exchange, symbol, stream = parts
+            buffer = PartitionBuffer(
+                record_type=record_type,
+                directory=self.root_dir / f"exchange={exchange}" / f"symbol={symbol}" / f"stream={stream}" / f"date={date}",
+                columns={name: [] for name, _ in COLUMNS[type(record)]},
+            )
+            self.partitions[key] = buffer
+
+        if not buffer.rows:
+            buffer.buffered_since = time.time()
+        for name, column in buffer.columns.items():
+            value = getattr(record, name)
+            # Order book levels and changes are array('d'), arrow wants a sequence of floats
+            column.append(value.tolist() if name in record.array_fields else value)
+        buffer.rows += 1
+
+    async def flush(self, force: bool = False) -> None:
+        """
+        Write full buffers and roll files that are due.
+        With force, every buffer is written regardless of size.
+        """
+        now = time.time()
+        for key, buffer in list(self.partitions.items()):
+            aged = buffer.writer is not None and now - buffer.opened_at >= self.max_age_s
+            stale = now - buffer.buffered_since >= self.flush_interval_s
+            if buffer.rows and (force or aged or stale or buffer.rows >= self.row_group_size):
+                await asyncio.to_thread(self._write, buffer)
+            if buffer.writer is not None and (
+                aged or buffer.file_rows >= self.max_rows or buffer.file_bytes >= self.max_bytes
+            ):
+                await asyncio.to_thread(self._close_file, buffer)
+            if buffer.writer is None and not buffer.rows:
+                # Nothing buffered and no file open, e.g. yesterday's partition
+                self.partitions.pop(key, None)
+
+    async def close(self) -> None:
+        """
+        Write all buffered rows and close every open file
+        """
+        await self.flush(force=True)
+        for buffer in list(self.partitions.values()):
+            if buffer.writer is not None:
+                await asyncio.to_thread(self._close_file, buffer)
+        self.partitions.clear()
+        logger.info("Consumer [%s] archive closed, %d files written", self.name, self.files_written)
+
+    # Writer thread
+    # -------------------------------------------------------------------------
+    def _write(self, buffer: PartitionBuffer) -> None:
+        schema = self._schemas[buffer.record_type]
+        columns, rows = buffer.columns, buffer.rows
+        buffer.columns = {name: [] for name in columns}
+        buffer.rows = 0
+        table = pa.Table.from_pydict(columns, schema=schema)
+
+        if buffer.writer is None:
+            self._open_file(buffer, schema)
+        buffer.writer.write_table(table)
+        buffer.file_rows += rows
+        buffer.file_bytes = os.path.getsize(buffer.path)
+        self.rows_written += rows
+
+    def _open_file(self, buffer: PartitionBuffer, schema: "pa.Schema") -> None:
+        buffer.directory.mkdir(parents=True, exist_ok=True)
+        suffix = "parquet" if self.file_format == "parquet" else "arrow"
+        buffer.path = buffer.directory / f"part-{time.time_ns()}-{self.files_written}.{suffix}"
+        if self.file_format == "parquet":
+            buffer.writer = pq.ParquetWriter(buffer.path, schema, compression=self.compression or "none")
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=self.compression)
+            buffer.writer = pa.ipc.new_file(str(buffer.path), schema, options=options)
+        buffer.opened_at = time.time()
+        buffer.file_rows = 0
+        buffer.file_bytes = 0
+        self.files_written += 1
+        logger.info("Consumer [%s] opened archive file [%s]", self.name, buffer.path)
+
+    def _close_file(self, buffer: PartitionBuffer) -> None:
+        buffer.writer.close()
+        logger.info("Consumer [%s] closed archive file [%s] with %d rows", self.name, buffer.path, buffer.file_rows)
+        buffer.writer = None
+        buffer.path = None
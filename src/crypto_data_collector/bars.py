@@ -0,0 +1,228 @@
+"""
+OHLCV + VWAP bars built from trades.
+
+The BarAggregator stage builds bars of several intervals (1s, 1m, 5m, 1h
+by default) from watchTrades messages, so no separate watchOHLCV
+subscription is needed and intervals the exchange does not offer are
+available. Each closed bar is sent as a BarRecord under a virtual producer
+key per interval:
+
+    binance|BTC/USDT|watchTrades  ->  binance|BTC/USDT|bars_1s
+                                      binance|BTC/USDT|bars_1m ...
+
+Consumers subscribe to them like any stream, e.g. "*|*|bars_1m".
+
+Bars are bucketed by the exchange timestamp of the trades. A bar is closed
+by the first trade of a later bar, or once the wall clock is grace_ms past
+its end for quiet symbols. Trades of an already closed bar are counted as
+late and ignored for that interval. Intervals without trades produce no
+bar.
+
+The open bars of a producer live in one flat array('d'), FIELDS values per
+interval, the work per trade is a few float updates per interval.
+"""
+import sys
+import logging
+
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from crypto_data_collector.helpers import producer_name_parser
+from crypto_data_collector.records import Record, TradeRecord
+from crypto_data_collector.stages import BaseStage
+
+logger = logging.getLogger(__name__)
+
+UNITS_MS = {"s": 1000, "m": 60_000, "h": 3_600_000, "d": 86_400_000}
+
+# Per interval layout of BarState.bars
+FIELDS = 8
+OPEN_TIME, OPEN, HIGH, LOW, CLOSE, VOLUME, NOTIONAL, TRADES = range(FIELDS)
+
+
+def parse_timeframe(timeframe: str) -> int:
+    """
+    Interval in milliseconds of a ccxt style timeframe, e.g. "5m"
+    """
+    unit = UNITS_MS.get(timeframe[-1:])
+    if unit is None or not timeframe[:-1].isdigit() or int(timeframe[:-1]) <= 0:
+        raise ValueError(f"Invalid timeframe: {timeframe}, expected e.g. 1s, 5m, 1h, 1d")
+    return int(timeframe[:-1]) * unit
+
+
+class BarRecord(Record):
+    """
+    One closed bar, timestamp is its open time (ms) and vwap the volume
+    weighted average price of its trades
+    """
+    __slots__ = ("producer", "timestamp", "received", "open", "high", "low", "close", "volume", "vwap", "trades")
+
+    def __init__(
+        self,
+        producer: str,
+        timestamp: int,
+        received: float,
+        open: float,
+        high: float,
+        low: float,
+        close: float,
+        volume: float,
+        vwap: float,
+        trades: int
+        ) -> None:
+        self.producer = producer
+        self.timestamp = timestamp
+        self.received = received
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.vwap = vwap
+        self.trades = trades
+
+
+class BarState:
+    """
+    Open bars of one trade producer, FIELDS values per interval. TRADES 0
+    with an OPEN_TIME set is a bar already sent, later trades of it are late.
+    """
+    __slots__ = ("bars", "producers")
+
+    def __init__(self, producers: List[str]) -> None:
+        self.bars = array("d", [-1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0] * len(producers))
+        # Virtual producer key per interval
+        self.producers = producers
+
+
+class BarAggregator(BaseStage):
+    """
+    Stage building OHLCV + VWAP bars from trades, see the module docstring.
+    Trade messages are passed on unchanged.
+
+    Args:
+        intervals (Iterable[str]): Bar intervals as ccxt timeframes
+        grace_ms (float): Wall clock time past a bar's end before a quiet symbol's bar is closed
+        sweep_interval_ms (float): How often quiet symbols are checked
+        streams (tuple): Stream names bars are built from
+    """
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        intervals: Iterable[str] = ("1s", "1m", "5m", "1h"),
+        grace_ms: float = 2000.0,
+        sweep_interval_ms: float = 1000.0,
+        streams: Tuple[str, ...] = ("watchTrades",)
+        ) -> None:
+        super().__init__(name)
+        self.timeframes = list(intervals)
+        self.intervals = [float(parse_timeframe(t)) for t in self.timeframes]
+        self.grace_ms = grace_ms
+        self.sweep_interval_ms = sweep_interval_ms
+        self.streams = streams
+        self.states: Dict[str, BarState] = {}
+        self._handled: Dict[str, bool] = {}
+        self._next_sweep = 0.0
+
+        self.trades = 0
+        self.bars = 0
+        self.late = 0
+
+    def bar_producer(self, producer: str, timeframe: str) -> str:
+        """
+        Virtual producer key of the bars of a trade producer
+        """
+        exchange, symbol, _ = producer_name_parser(producer)
+        return sys.intern(f"{exchange}|{symbol}|bars_{timeframe}")
+
+    def process(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        producer = message["producer"]
+        received = message.get("received", 0.0)
+        if received >= self._next_sweep:
+            self._next_sweep = received + self.sweep_interval_ms
+            self.sweep(received)
+
+        handled = self._handled.get(producer)
+        if handled is None:
+            parts = producer_name_parser(producer)
+            handled = len(parts) == 3 and parts[-1] in self.streams
+            self._handled[producer] = handled
+        trades = message["data"]
+        if not handled or not isinstance(trades, list):
+            return message
+
+        state = self.states.get(producer)
+        if state is None:
+            state = self.states[producer] = BarState([self.bar_producer(producer, t) for t in self.timeframes])
+        bars = state.bars
+        intervals = self.intervals
+        for trade in trades:
+            if isinstance(trade, TradeRecord):
+                timestamp, price, amount = trade.timestamp, trade.price, trade.amount
+            else:
+                timestamp, price, amount = trade.get("timestamp"), trade.get("price"), trade.get("amount")
+            if price is None or amount is None:
+                continue
+            if timestamp is None:
+                timestamp = received
+            base = 0
+            for i, interval in enumerate(intervals):
+                start = timestamp - timestamp % interval
+                open_time = bars[base]
+                if start == open_time and bars[base + TRADES]:
+                    if price > bars[base + HIGH]:
+                        bars[base + HIGH] = price
+                    elif price < bars[base + LOW]:
+                        bars[base + LOW] = price
+                    bars[base + CLOSE] = price
+                    bars[base + VOLUME] += amount
+                    bars[base + NOTIONAL] += price * amount
+                    bars[base + TRADES] += 1
+                elif start > open_time:
+                    if bars[base + TRADES]:
+                        self.emit(self._close(state, i, received))
+                    bars[base:base + FIELDS] = array("d", (start, price, price, price, price, amount, price * amount, 1.0))
+                else:
+                    self.late += 1
+                base += FIELDS
+        self.trades += len(trades)
+        return message
+
+    def sweep(self, now: float) -> None:
+        """
+        Close the bars that ended more than grace_ms before now (wall clock ms)
+        """
+        grace = self.grace_ms
+        intervals = self.intervals
+        for state in self.states.values():
+            bars = state.bars
+            for i, interval in enumerate(intervals):
+                base = i * FIELDS
+                if bars[base + TRADES] and bars[base] + interval + grace <= now:
+                    self.emit(self._close(state, i, now))
+
+    def _close(self, state: BarState, i: int, received: float) -> Dict[str, Any]:
+        bars = state.bars
+        base = i * FIELDS
+        volume = bars[base + VOLUME]
+        producer = state.producers[i]
+        bar = BarRecord(
+            producer,
+            int(bars[base]),
+            received,
+            bars[base + OPEN],
+            bars[base + HIGH],
+            bars[base + LOW],
+            bars[base + CLOSE],
+            volume,
+            bars[base + NOTIONAL] / volume if volume else bars[base + CLOSE],
+            int(bars[base + TRADES]),
+        )
+        # Keep the open time, later trades of this bar are late
+        bars[base + TRADES] = 0.0
+        self.bars += 1
+        return {"data": bar, "producer": producer, "received": received}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"streams": len(self.states), "trades": self.trades, "bars": self.bars, "late": self.late}
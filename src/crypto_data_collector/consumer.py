@@ -1,24 +1,50 @@
+import time
 import asyncio
 import logging
+import functools
 from abc import ABC, abstractmethod
-from typing import Any, Dict, Optional
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from crypto_data_collector.durable_queue import DurableQueue
+from crypto_data_collector.helpers import STREAM_ALIASES, Subscription
+from crypto_data_collector.metrics import SAMPLE_EVERY, SAMPLE_MASK, Histogram
+from crypto_data_collector.queues import BoundedQueue, BroadcastRing, OverflowPolicy, RingCursor, get_batch
+from crypto_data_collector.stages import BaseStage, run_stages
 
 logger = logging.getLogger(__name__)
 
 
 class ConsumerPipeline():
-    def __init__(self, data_queue: asyncio.Queue, name: Optional[str] = None):
+    def __init__(
+        self,
+        data_queue: asyncio.Queue,
+        name: Optional[str] = None,
+        ring_capacity: Optional[int] = None
+        ):
         self.data_queue: asyncio.Queue = data_queue
         self.name: str = name or self.__class__.__name__
         self.consumers = {}
+        # producer name -> consumers subscribed to it, rebuilt lazily when consumers change
+        self.routes: Dict[str, Tuple["BaseConsumer", ...]] = {}
+        # With a ring each message is written once and consumers read through
+        # their own cursor, instead of one put per consumer queue
+        self.ring: Optional[BroadcastRing] = BroadcastRing(ring_capacity) if ring_capacity else None
+        # Run in order on every message before routing, see stages.py
+        self.stages: List[BaseStage] = []
 
     async def consumer_delegator(self):
         logger.info("Consumer Delegator started")
+        stages = self.stages
         try:
             while True:
                 data = await self.data_queue.get()
-                for consumer in self.consumers.values():
-                    consumer.get_data_queue().put_nowait(data)
+                if stages:
+                    for message in run_stages(stages, data):
+                        await self.dispatch(message)
+                else:
+                    await self.dispatch(data)
                 self.data_queue.task_done()
         except asyncio.CancelledError:
             logger.warning("Delegator called to be cancelled")
@@ -29,8 +55,8 @@ class ConsumerPipeline():
                 except asyncio.QueueEmpty:
                     break
                 else:
-                    for consumer in self.consumers.values():
-                        consumer.get_data_queue().put_nowait(data)
+                    for message in run_stages(stages, data) if stages else (data,):
+                        self.dispatch_nowait(message)
                     self.data_queue.task_done()
             logger.info("Delegator Queue emptied. Exiting")
             raise
@@ -38,6 +64,121 @@ class ConsumerPipeline():
             logger.exception("Unhandled error in consumer delegator")
             raise
 
+    async def dispatch(self, data: Dict[str, Any]) -> None:
+        if self.ring is not None:
+            self.ring.publish(data)
+            return
+        targets = self.routes.get(data["producer"])
+        if targets is None:
+            targets = self.route(data["producer"])
+        for consumer in targets:
+            try:
+                consumer.data_queue.put_nowait(data)
+            except asyncio.QueueFull:
+                # Full queue with the BLOCK policy
+                await self._put_blocking(consumer, data)
+
+    async def _put_blocking(self, consumer: "BaseConsumer", data: Dict[str, Any]) -> None:
+        """
+        Wait for room in a consumer queue, the put is abandoned if the
+        consumer stops meanwhile (removed or crashed), nothing would ever
+        make room again and the delegator would stall every other consumer
+        """
+        put = asyncio.ensure_future(consumer.data_queue.put(data))
+        if consumer.task is None:
+            await put
+            return
+        try:
+            await asyncio.wait((put, consumer.task), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not put.done():
+                put.cancel()
+        if put.cancelled():
+            logger.warning("Consumer [%s] stopped with a full queue, message dropped", consumer.name)
+
+    def dispatch_nowait(self, data: Dict[str, Any]) -> None:
+        if self.ring is not None:
+            self.ring.publish(data)
+            return
+        for consumer in self.route(data["producer"]):
+            try:
+                consumer.data_queue.put_nowait(data)
+            except asyncio.QueueFull:
+                logger.warning("Consumer [%s] queue full during shutdown, message dropped", consumer.name)
+
+    def add_stage(self, stage: BaseStage) -> None:
+        """
+        Append a processing stage, run on every message before routing
+        """
+        if any(s.name == stage.name for s in self.stages):
+            logger.warning("Stage [%s] already added, skipping", stage.name)
+            return
+        self.stages.append(stage)
+        logger.info("Stage [%s] added", stage.name)
+        for consumer in self.consumers.values():
+            self._keep_deltas(consumer)
+
+    def _keep_deltas(self, consumer: "BaseConsumer") -> None:
+        """
+        A delta only applies on top of every earlier message of its producer,
+        conflating or dropping one leaves the consumer out of sync until the
+        next snapshot. Lossy overflow policies of delta streams (see
+        BaseStage.delta_streams) fall back to BLOCK.
+        """
+        queue = consumer.data_queue
+        if not isinstance(queue, BoundedQueue):
+            return
+        for stage in self.stages:
+            for stream_name in stage.delta_streams():
+                if not self._subscribed(consumer, stream_name):
+                    continue
+                lossy = [
+                    name for name, policy in queue.overrides.items()
+                    if policy is not OverflowPolicy.BLOCK and name.rsplit("|", 1)[-1] == stream_name
+                ]
+                if queue.policy is not OverflowPolicy.BLOCK and stream_name not in queue.overrides:
+                    lossy.append(stream_name)
+                for name in lossy:
+                    logger.warning(
+                        "Consumer [%s] policy %s on [%s] would lose %s deltas, using block instead",
+                        consumer.name, queue.policy_for(name).value, name, stage.name
+                    )
+                    queue.set_policy(name, OverflowPolicy.BLOCK)
+
+    @staticmethod
+    def _subscribed(consumer: "BaseConsumer", stream_name: str) -> bool:
+        return consumer.subscriptions is None or any(
+            fnmatchcase(stream_name, s.stream) for s in consumer.subscriptions
+        )
+
+    def _resync_deltas(self, consumer: "BaseConsumer", skipped: int) -> None:
+        """
+        A lapped ring cursor cannot be slowed down like a BLOCK queue, the
+        skipped messages may hold deltas. Stages whose delta streams the
+        consumer reads resync so it gets snapshots again.
+        """
+        for stage in self.stages:
+            if any(self._subscribed(consumer, s) for s in stage.delta_streams()):
+                logger.warning(
+                    "Consumer [%s] skipped %d messages that may hold %s deltas, resyncing",
+                    consumer.name, skipped, stage.name
+                )
+                stage.resync()
+
+    def remove_stage(self, stage_name: str) -> None:
+        self.stages[:] = [s for s in self.stages if s.name != stage_name]
+        logger.info("Stage [%s] removed", stage_name)
+
+    def route(self, producer_name: str) -> Tuple["BaseConsumer", ...]:
+        """
+        Resolve and cache the consumers subscribed to a producer
+        """
+        targets = self.routes.get(producer_name)
+        if targets is None:
+            targets = tuple(c for c in self.consumers.values() if c.wants(producer_name))
+            self.routes[producer_name] = targets
+        return targets
+
     def add_consumer(
         self,
         name: str,
@@ -47,6 +188,23 @@ class ConsumerPipeline():
             logger.warning("Consumer [%s] already added, skipping", name)
             return
         self.consumers[name] = consumer
+        self.routes.clear()
+        if self.ring is not None:
+            if consumer.conflate_streams:
+                logger.warning("Consumer [%s] conflate_streams has no effect when reading from a ring", name)
+            if isinstance(consumer.data_queue, DurableQueue):
+                logger.warning("Consumer [%s] durable_dir has no effect when reading from a ring", name)
+            queue = consumer.data_queue
+            if isinstance(queue, BoundedQueue) and (queue.maxsize or queue.policy is not OverflowPolicy.BLOCK):
+                logger.warning("Consumer [%s] maxsize and overflow_policy have no effect when reading from a ring", name)
+            # Subscriptions filter at the cursor, every message still goes through
+            # the ring, so unwanted traffic counts toward lapping a slow cursor
+            accept = consumer.accepts if consumer.subscriptions is not None else None
+            cursor = self.ring.cursor(name, accept=accept)
+            cursor.on_lag = functools.partial(self._resync_deltas, consumer)
+            consumer.set_data_queue(cursor)
+        else:
+            self._keep_deltas(consumer)
         consumer.set_status("staged")
         task = asyncio.create_task(consumer.start_loop(), name=consumer.name)
         task.add_done_callback(consumer.task_done_callback)
@@ -64,6 +222,9 @@ class ConsumerPipeline():
         except:
             pass
         self.consumers.pop(consumer_name)
+        self.routes.clear()
+        if self.ring is not None:
+            self.ring.remove_cursor(consumer_name)
         logger.info("Consumer [%s] fully removed", consumer_name)
 
     def get_data_queue(self) -> asyncio.Queue:
@@ -73,15 +234,87 @@ class ConsumerPipeline():
 
 
 class BaseConsumer(ABC):
-    def __init__(self, name: Optional[str] = None):
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        maxsize: int = 0,
+        overflow_policy: Union[OverflowPolicy, str] = OverflowPolicy.BLOCK,
+        subscriptions: Optional[Iterable[Union[Subscription, str]]] = None,
+        conflate_streams: Optional[Iterable[str]] = None,
+        durable_dir: Optional[Union[str, Path]] = None
+        ):
+        # maxsize 0 is unbounded, overflow_policy only applies once maxsize is reached
+        # subscriptions None receives every stream
+        # conflate_streams (e.g. ["ticker"]) keep at most one pending message per
+        # producer of those streams, newer updates overwrite it in place. Streams
+        # turned into deltas by a stage (OrderBookEngine) are never conflated
+        # durable_dir queues to disk instead (DurableQueue, see durable_queue.py),
+        # nothing is dropped and unacknowledged messages survive restarts
         self.name = name or self.__class__.__name__
         self.task = None
         self.status = None
-        self.data_queue: asyncio.Queue = asyncio.Queue()
+        self.conflate_streams: Tuple[str, ...] = tuple(
+            STREAM_ALIASES.get(s, s) for s in conflate_streams or ()
+        )
+        if durable_dir is not None:
+            if maxsize or self.conflate_streams:
+                logger.warning("Consumer [%s] maxsize and conflate_streams have no effect with durable_dir", self.name)
+            self.data_queue: asyncio.Queue = DurableQueue(durable_dir)
+        else:
+            self.data_queue = BoundedQueue(maxsize=maxsize, policy=overflow_policy)
+            for stream_name in self.conflate_streams:
+                self.data_queue.set_policy(stream_name, OverflowPolicy.CONFLATE)
+        self.subscriptions: Optional[Tuple[Subscription, ...]] = None
+        if subscriptions is not None:
+            self.subscriptions = tuple(
+                Subscription.parse(s) if isinstance(s, str) else s for s in subscriptions
+            )
+        self._wants: Dict[str, bool] = {}
+
+        # Metrics, read by MetricsCollector. Updated by mark_consumed(), which
+        # BatchConsumer calls for you
+        self.consumed = 0
+        self.latency = Histogram()
     
     def get_data_queue(self) -> asyncio.Queue:
         return self.data_queue
 
+    def set_data_queue(self, data_queue: Union[asyncio.Queue, RingCursor]) -> None:
+        self.data_queue = data_queue
+
+    def wants(self, producer_name: str) -> bool:
+        """
+        Whether this consumer is subscribed to a producer, cached per producer name
+        """
+        wanted = self._wants.get(producer_name)
+        if wanted is None:
+            wanted = self.subscriptions is None or any(
+                s.matches(producer_name) for s in self.subscriptions
+            )
+            self._wants[producer_name] = wanted
+        return wanted
+
+    def accepts(self, data: Dict[str, Any]) -> bool:
+        return self.wants(data["producer"])
+
+    def mark_consumed(self, message: Dict[str, Any]) -> None:
+        """
+        Count a handled message, every SAMPLE_EVERY-th one records its
+        receive to consume latency
+        """
+        self.consumed += 1
+        if not self.consumed & SAMPLE_MASK:
+            self.latency.record(time.time() * 1000 - message.get("received", 0.0))
+
+    def mark_consumed_batch(self, batch: List[Dict[str, Any]]) -> None:
+        start = self.consumed
+        self.consumed += len(batch)
+        first = -(start + 1) % SAMPLE_EVERY
+        if first < len(batch):
+            now = time.time() * 1000
+            for message in batch[first::SAMPLE_EVERY]:
+                self.latency.record(now - message.get("received", 0.0))
+
     def task_done_callback(self, task:asyncio.Task) -> None:
         ######## Do something with the callback########
         ######## Put your code here ################
@@ -103,3 +336,83 @@ class BaseConsumer(ABC):
 
     def get_name(self) -> str:
         return self.name
+
+
+
+class BatchConsumer(BaseConsumer):
+    """
+    Opt-in batch mode for consumers.
+
+    Implement run_batch instead of run. It is called with up to batch_size
+    messages, or with whatever arrived within batch_timeout_ms of the first
+    message of the batch. task_done is called for every message once
+    run_batch returns. On cancel the queue is drained in batches before the
+    CancelledError is re-raised, like the per message examples. A
+    DurableQueue is not drained, its messages are recovered on restart.
+    """
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        batch_size: int = 500,
+        batch_timeout_ms: float = 100.0,
+        **kwargs: Any
+        ):
+        super().__init__(name, **kwargs)
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout_ms / 1000
+        # Messages taken off the queue but not yet handed to run_batch
+        self._pending: List[Any] = []
+
+    async def get_batch(self) -> List[Any]:
+        batch = await get_batch(self.data_queue, self.batch_size, self.batch_timeout, self._pending)
+        self._pending = []
+        return batch
+
+    async def _handle(self, batch: List[Any]) -> None:
+        handled = False
+        try:
+            await self.run_batch(batch)
+            handled = True
+            self.mark_consumed_batch(batch)
+        finally:
+            if handled or not isinstance(self.data_queue, DurableQueue):
+                for _ in batch:
+                    self.data_queue.task_done()
+            else:
+                # Not acknowledged, the batch is delivered again after a restart
+                for _ in batch:
+                    self.data_queue.task_done(ack=False)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                batch = await self.get_batch()
+                await self._handle(batch)
+        except asyncio.CancelledError:
+            if isinstance(self.data_queue, DurableQueue):
+                # Unacknowledged messages, the pending batch included, are recovered on restart
+                self._pending = []
+                self.data_queue.flush()
+                logger.info("Consumer [%s] cancelled, %d messages left in its durable queue", self.name, self.data_queue.qsize())
+                raise
+            logger.info("Consumer [%s] marked as cancelled. Greedily emptying its data queue...", self.name)
+            batch, self._pending = self._pending, []
+            while True:
+                try:
+                    batch.append(self.data_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+                if len(batch) >= self.batch_size:
+                    await self._handle(batch)
+                    batch = []
+            if batch:
+                await self._handle(batch)
+            logger.info("Consumer [%s] data queue emptied", self.name)
+            raise
+
+    @abstractmethod
+    async def run_batch(self, batch: List[Any]) -> None:
+        pass
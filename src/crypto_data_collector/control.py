@@ -0,0 +1,328 @@
+"""
+Control plane HTTP API.
+
+ControlPlane exposes the Registry, ProducerPipeline and ConsumerPipeline
+of a running collector on a local HttpServer, next to the /metrics and
+/stats routes of its MetricsCollector, so streams can be added, removed
+and rebalanced without a restart:
+
+    GET    /streams              registered streams, ?exchange= and ?stream= filter
+    GET    /producers            running producers: state, rate and lag
+    GET    /producers/{key}      one producer
+    POST   /producers            start a stream: {"exchange", "symbol", "stream", "options", "properties"}
+    DELETE /producers/{key}      stop a producer and unregister its stream
+    GET    /consumers            consumers: status, rate, queue and lag
+    POST   /consumers            start a consumer: {"name", "factory", "options"}
+    DELETE /consumers/{name}     stop a consumer
+
+{key} is the producer key "exchange|symbol|stream", URL encoded, e.g.
+binance%7CBTC%2FUSDT%7CwatchTicker. Producer lag is the sampled exchange
+timestamp to receive latency plus the time since the last message,
+consumer lag its queue size plus the receive to consume latency.
+
+Consumers are code: POST /consumers builds one with a factory registered
+by name, e.g. ControlPlane(..., consumer_factories={"recorder": RecorderConsumer}),
+called as factory(name=name, **options).
+
+Security: the API is off unless control.port is set and binds to
+localhost by default. With a token every control route needs an
+"Authorization: Bearer <token>" header. POST requests must be
+"Content-Type: application/json" and POST / DELETE requests carrying an
+Origin header not in allowed_origins are refused, so a web page cannot
+drive the API from a browser. Only the keys in PRODUCER_PROPERTIES and
+CONSUMER_OPTIONS are accepted in "properties" and "options", a request
+cannot point an exchange at another host or a consumer at another path.
+
+Every route can be called in-process with control.server.dispatch(Request(...)),
+or with ControlPlane.build_server() without opening a socket.
+"""
+import hmac
+import time
+import asyncio
+import logging
+
+from typing import Any, Callable, Dict, Iterable, Optional, TYPE_CHECKING
+from urllib.parse import unquote
+
+from crypto_data_collector.exceptions import UnregisteredExchange, UnregisteredStream, UnregisteredSymbol
+from crypto_data_collector.helpers import producer_name_parser
+from crypto_data_collector.metrics import MetricsCollector
+from crypto_data_collector.server import HttpServer, Request, Response
+
+if TYPE_CHECKING:
+    from crypto_data_collector.consumer import BaseConsumer, ConsumerPipeline
+    from crypto_data_collector.producer import DataProducer, ProducerPipeline
+    from crypto_data_collector.records import Normalizer
+    from crypto_data_collector.registry import Registry
+
+logger = logging.getLogger(__name__)
+
+UNREGISTERED = (UnregisteredExchange, UnregisteredSymbol, UnregisteredStream)
+
+# ccxt exchange properties POST /producers may set, urls, hostname, proxies
+# and credentials are left to the config file
+PRODUCER_PROPERTIES = ("enableRateLimit", "rateLimit", "timeout", "newUpdates")
+# Consumer options POST /consumers may pass to a factory, paths and
+# connections are left to the factory
+CONSUMER_OPTIONS = (
+    "subscriptions", "maxsize", "overflow_policy", "conflate_streams", "batch_size", "batch_timeout_ms"
+)
+
+
+def _check_keys(field: str, values: Dict[str, Any], allowed: Iterable[str]) -> None:
+    if not isinstance(values, dict):
+        raise ValueError(f"{field} must be an object")
+    refused = sorted(set(values) - set(allowed))
+    if refused:
+        raise ValueError(f"{field} not allowed: {', '.join(refused)}, allowed: {', '.join(sorted(allowed))}")
+
+
+class ControlPlane:
+    """
+    Args:
+        registry (Registry): Registry new producers are registered and created in
+        producer_pipeline (ProducerPipeline): Pipeline running the producers
+        consumer_pipeline (ConsumerPipeline, optional): Pipeline running the consumers
+        metrics (MetricsCollector, optional): Source of rates, one is created by default
+        normalizer (Normalizer, optional): Passed to new producers
+        consumer_factories (dict, optional): Name -> callable building a consumer for POST /consumers
+        token (str, optional): Bearer token required on every control route
+        allowed_origins (iterable, optional): Browser origins allowed to POST and DELETE, none by default
+        producer_properties (iterable): Exchange properties accepted by POST /producers
+        consumer_options (iterable): Consumer options accepted by POST /consumers
+    """
+
+    def __init__(
+        self,
+        registry: "Registry",
+        producer_pipeline: "ProducerPipeline",
+        consumer_pipeline: Optional["ConsumerPipeline"] = None,
+        metrics: Optional[MetricsCollector] = None,
+        normalizer: Optional["Normalizer"] = None,
+        consumer_factories: Optional[Dict[str, Callable[..., "BaseConsumer"]]] = None,
+        token: Optional[str] = None,
+        allowed_origins: Optional[Iterable[str]] = None,
+        producer_properties: Iterable[str] = PRODUCER_PROPERTIES,
+        consumer_options: Iterable[str] = CONSUMER_OPTIONS
+        ) -> None:
+        self.registry = registry
+        self.producer_pipeline = producer_pipeline
+        self.consumer_pipeline = consumer_pipeline
+        self.metrics = metrics if metrics is not None else MetricsCollector(producer_pipeline, consumer_pipeline)
+        self.normalizer = normalizer
+        self.consumer_factories = dict(consumer_factories or {})
+        self.token = token
+        self.allowed_origins = set(allowed_origins or ())
+        self.producer_properties = tuple(producer_properties)
+        self.consumer_options = tuple(consumer_options)
+        self.server: Optional[HttpServer] = None
+
+    def add_routes(self, server: HttpServer) -> None:
+        routes = (
+            ("GET", "/streams", self.list_streams),
+            ("GET", "/producers", self.list_producers),
+            ("GET", "/producers/{key}", self.get_producer),
+            ("POST", "/producers", self.add_producer),
+            ("DELETE", "/producers/{key}", self.remove_producer),
+            ("GET", "/consumers", self.list_consumers),
+            ("POST", "/consumers", self.add_consumer),
+            ("DELETE", "/consumers/{name}", self.remove_consumer),
+        )
+        for method, path, handler in routes:
+            server.route(method, path, self.guarded(handler))
+
+    def refuse(self, request: Request) -> Optional[Response]:
+        """
+        Error response for a request the API must not run, None when allowed
+        """
+        if self.token is not None:
+            expected = f"Bearer {self.token}".encode()
+            if not hmac.compare_digest(request.headers.get("authorization", "").encode(), expected):
+                return Response.json({"error": "missing or invalid token"}, 401)
+        if request.method in ("POST", "DELETE"):
+            origin = request.headers.get("origin")
+            if origin is not None and origin not in self.allowed_origins:
+                return Response.json({"error": f"origin [{origin}] not allowed"}, 403)
+        if request.method == "POST":
+            content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+            if content_type != "application/json":
+                return Response.json({"error": "Content-Type must be application/json"}, 415)
+        return None
+
+    def guarded(self, handler: Callable[[Request], Any]) -> Callable[[Request], Any]:
+        async def guarded_handler(request: Request) -> Response:
+            refused = self.refuse(request)
+            if refused is not None:
+                logger.warning("Control API refused [%s %s]: %s", request.method, request.path, refused.body.decode())
+                return refused
+            response = handler(request)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+        return guarded_handler
+
+    def build_server(self, host: str = "127.0.0.1", port: int = 0) -> HttpServer:
+        """
+        HttpServer with the control and metrics routes, not started
+        """
+        self.server = HttpServer(host, port)
+        self.add_routes(self.server)
+        self.metrics.add_routes(self.server)
+        return self.server
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 9465) -> HttpServer:
+        server = self.build_server(host, port)
+        await server.start()
+        return server
+
+    # Producers
+    # -------------------------------------------------------------------------
+    def producer_view(self, name: str, producer: "DataProducer", stats: Dict[str, Any]) -> Dict[str, Any]:
+        state = producer.state
+        return {
+            "producer": name,
+            "exchange": producer.exchange_name,
+            "symbol": producer.symbol,
+            "stream": producer.stream_name,
+            "state": {
+                "status": state.status.name.lower() if state.status else None,
+                "tries": state.tries,
+                "timeout": state.timeout,
+                "last_error": state.last_error,
+                "since": state.since,
+            },
+            "messages": stats["messages"],
+            "rate": stats["rate"],
+            "restarts": stats["restarts"],
+            "stalls": stats["stalls"],
+            "lag_ms": stats["latency_ms"],
+            "idle_ms": time.time() * 1000 - producer.last_message if producer.last_message else None,
+        }
+
+    def list_producers(self, request: Request) -> Response:
+        stats = self.metrics.producer_stats()
+        producers = self.producer_pipeline.producers
+        return Response.json([
+            self.producer_view(name, producers[name], producer_stats)
+            for name, producer_stats in stats.items() if name in producers
+        ])
+
+    def get_producer(self, request: Request) -> Response:
+        key = unquote(request.params["key"])
+        producer = self.producer_pipeline.producers.get(key)
+        if producer is None:
+            return Response.json({"error": f"producer [{key}] not running"}, 404)
+        stats = self.metrics.producer_stats()
+        return Response.json(self.producer_view(key, producer, stats[key]))
+
+    def list_streams(self, request: Request) -> Response:
+        running = self.producer_pipeline.producers
+        keys = self.registry.producer_keys(
+            exchange_name=request.query.get("exchange"), stream_name=request.query.get("stream")
+        )
+        return Response.json([
+            {"producer": key, "running": key in running, "options": self.registry.streams[key]["stream_options"]}
+            for key in keys
+        ])
+
+    async def add_producer(self, request: Request) -> Response:
+        body = request.json() or {}
+        missing = [field for field in ("exchange", "symbol", "stream") if not body.get(field)]
+        if missing:
+            raise ValueError(f"Missing fields: {', '.join(missing)}")
+        exchange_name, symbol, stream_name = body["exchange"], body["symbol"], body["stream"]
+        options = body.get("options") or {}
+        properties = body.get("properties") or {}
+        _check_keys("properties", properties, self.producer_properties)
+        key = f"{exchange_name}|{symbol}|{stream_name}"
+        if key in self.producer_pipeline.producers:
+            return Response.json({"error": f"producer [{key}] already running"}, 409)
+
+        registry = self.registry
+        if (
+            properties and registry.exchange_registered(exchange_name)
+            and registry.registered["exchanges"][exchange_name]["overrides"] != properties
+        ):
+            # The running connection is shared, its properties cannot change per producer
+            return Response.json(
+                {"error": f"exchange [{exchange_name}] already registered with other properties"}, 409
+            )
+        try:
+            await registry.register_exchange(exchange_name, properties)
+            await registry.register_symbol(exchange_name, symbol)
+            if key in registry.streams and registry.streams[key]["stream_options"] != options:
+                # Registered but not running, take the requested options
+                registry.unregister_stream(exchange_name, symbol, stream_name)
+            await registry.register_stream(exchange_name, symbol, stream_name, options)
+        except AttributeError as e:
+            # Unknown exchange, symbol or stream
+            return Response.json({"error": str(e)}, 400)
+        producer = registry.create_producer(
+            exchange_name, symbol, stream_name,
+            data_queue=self.producer_pipeline.get_data_queue(),
+            normalizer=self.normalizer
+        )
+        self.producer_pipeline.add_producer(producer.producer_name, producer)
+        logger.info("Producer [%s] added through the control API", key)
+        stats = self.metrics.producer_stats()
+        return Response.json(self.producer_view(key, producer, stats[key]), 201)
+
+    async def remove_producer(self, request: Request) -> Response:
+        key = unquote(request.params["key"])
+        if key not in self.producer_pipeline.producers:
+            return Response.json({"error": f"producer [{key}] not running"}, 404)
+        await self.producer_pipeline.remove_producer(key)
+        if key in self.registry.streams:
+            try:
+                self.registry.unregister_stream(*producer_name_parser(key))
+            except UNREGISTERED:
+                pass
+        logger.info("Producer [%s] removed through the control API", key)
+        return Response.json({"removed": key})
+
+    # Consumers
+    # -------------------------------------------------------------------------
+    def _consumer_pipeline(self) -> "ConsumerPipeline":
+        if self.consumer_pipeline is None:
+            raise LookupError("no consumer pipeline")
+        return self.consumer_pipeline
+
+    def list_consumers(self, request: Request) -> Response:
+        consumers = self._consumer_pipeline().consumers
+        views = []
+        for name, stats in self.metrics.consumer_stats().items():
+            consumer = consumers.get(name)
+            if consumer is None:
+                continue
+            subscriptions = None
+            if consumer.subscriptions is not None:
+                subscriptions = [f"{s.exchange}|{s.symbol}|{s.stream}" for s in consumer.subscriptions]
+            views.append({"consumer": name, "subscriptions": subscriptions, **stats})
+        return Response.json(views)
+
+    async def add_consumer(self, request: Request) -> Response:
+        pipeline = self._consumer_pipeline()
+        body = request.json() or {}
+        name, factory_name = body.get("name"), body.get("factory")
+        if not name or not factory_name:
+            raise ValueError("Missing fields: name and factory are required")
+        options = body.get("options") or {}
+        _check_keys("options", options, self.consumer_options)
+        factory = self.consumer_factories.get(factory_name)
+        if factory is None:
+            raise ValueError(f"Unknown consumer factory [{factory_name}], known: {sorted(self.consumer_factories)}")
+        if name in pipeline.consumers:
+            return Response.json({"error": f"consumer [{name}] already running"}, 409)
+        consumer = factory(name=name, **options)
+        pipeline.add_consumer(name=name, consumer=consumer)
+        logger.info("Consumer [%s] added through the control API", name)
+        return Response.json({"consumer": name, "factory": factory_name}, 201)
+
+    async def remove_consumer(self, request: Request) -> Response:
+        pipeline = self._consumer_pipeline()
+        name = unquote(request.params["name"])
+        if name not in pipeline.consumers:
+            return Response.json({"error": f"consumer [{name}] not running"}, 404)
+        await pipeline.remove_consumer(name)
+        logger.info("Consumer [%s] removed through the control API", name)
+        return Response.json({"removed": name})
@@ -0,0 +1,231 @@
+"""
+Trade de-duplication and gap detection for watchTrades streams.
+
+watchTrades can hand out the same trades again, e.g. when a producer
+re-subscribes after a backoff and ccxt replays its trade cache. The
+TradeDeduplicator stage remembers the last window trade ids per producer
+and drops trades it has seen, memory per stream is bounded by the window
+whatever the uptime.
+
+It also reports gaps as TradeGap records, sent under the producer of the
+trades right after the message that revealed them:
+
+    kind "id":   a jump in sequential trade ids, missing ids in between.
+                 Only for producers whose ids were consecutive integers for
+                 the first learn_ids trades, ids of many exchanges are not.
+    kind "time": no trade for more than max_time_gap_ms of exchange time
+"""
+import logging
+
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+from crypto_data_collector.helpers import producer_name_parser
+from crypto_data_collector.records import Record, TradeRecord
+from crypto_data_collector.stages import BaseStage
+
+logger = logging.getLogger(__name__)
+
+
+class TradeGap(Record):
+    """
+    Trades missing between two received trades, first / last are the ids
+    (kind "id") or exchange timestamps (kind "time") on both sides of the gap
+    """
+    __slots__ = ("producer", "kind", "received", "first", "last", "missing")
+
+    def __init__(
+        self,
+        producer: str,
+        kind: str,
+        received: float,
+        first: Any,
+        last: Any,
+        missing: Optional[int] = None
+        ) -> None:
+        self.producer = producer
+        self.kind = kind
+        self.received = received
+        self.first = first
+        self.last = last
+        self.missing = missing
+
+
+class TradeWindow:
+    """
+    Recently seen trade keys of one producer, oldest evicted first
+    """
+    __slots__ = ("keys", "order", "last_id", "sequential", "steps", "last_timestamp")
+
+    def __init__(self, size: int) -> None:
+        self.keys: Set[Hashable] = set()
+        self.order: Deque[Hashable] = deque(maxlen=size)
+        # Sequential id learning, None while undecided
+        self.last_id: Optional[int] = None
+        self.sequential: Optional[bool] = None
+        self.steps = 0
+        self.last_timestamp: Optional[int] = None
+
+    def add(self, key: Hashable) -> bool:
+        """
+        Remember key, False if it was already in the window
+        """
+        if key in self.keys:
+            return False
+        order = self.order
+        if len(order) == order.maxlen:
+            self.keys.discard(order[0])
+        order.append(key)
+        self.keys.add(key)
+        return True
+
+
+def _trade_fields(trade: Any) -> Tuple[Any, Optional[int], Hashable]:
+    """
+    (id, timestamp, dedupe key) of a raw ccxt trade or a TradeRecord
+    """
+    if isinstance(trade, TradeRecord):
+        trade_id, timestamp = trade.id, trade.timestamp
+        if trade_id is None:
+            return None, timestamp, (timestamp, trade.price, trade.amount, trade.side)
+        return trade_id, timestamp, trade_id
+    trade_id, timestamp = trade.get("id"), trade.get("timestamp")
+    if trade_id is None:
+        return None, timestamp, (timestamp, trade.get("price"), trade.get("amount"), trade.get("side"))
+    return trade_id, timestamp, trade_id
+
+
+class TradeDeduplicator(BaseStage):
+    """
+    Stage dropping repeated trades and reporting gaps, see the module docstring.
+
+    Accepts raw ccxt trade lists or TradeRecord lists. Trades without an id
+    are keyed by (timestamp, price, amount, side). A message whose trades
+    were all seen is dropped, otherwise it is passed on with only the new
+    trades.
+
+    Args:
+        window (int): Trade keys remembered per producer
+        max_time_gap_ms (float, optional): Exchange time between trades reported as a gap, None disables
+        learn_ids (int): Consecutive id steps before a producer's ids are treated as sequential, 0 disables id gaps
+        streams (tuple): Stream names handled by the stage
+    """
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        window: int = 4096,
+        max_time_gap_ms: Optional[float] = 60_000.0,
+        learn_ids: int = 50,
+        streams: Tuple[str, ...] = ("watchTrades",)
+        ) -> None:
+        super().__init__(name)
+        self.window = window
+        self.max_time_gap_ms = max_time_gap_ms
+        self.learn_ids = learn_ids
+        self.streams = streams
+        self.windows: Dict[str, TradeWindow] = {}
+        self._handled: Dict[str, bool] = {}
+
+        self.trades = 0
+        self.duplicates = 0
+        self.id_gaps = 0
+        self.missing_ids = 0
+        self.time_gaps = 0
+
+    def process(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        producer = message["producer"]
+        handled = self._handled.get(producer)
+        if handled is None:
+            handled = producer_name_parser(producer)[-1] in self.streams
+            self._handled[producer] = handled
+        if not handled or not isinstance(message["data"], list):
+            return message
+
+        window = self.windows.get(producer)
+        if window is None:
+            window = self.windows[producer] = TradeWindow(self.window)
+        received = message.get("received", 0.0)
+        trades = message["data"]
+        kept: Optional[List[Any]] = None
+        for i, trade in enumerate(trades):
+            trade_id, timestamp, key = _trade_fields(trade)
+            if not window.add(key):
+                self.duplicates += 1
+                if kept is None:
+                    kept = list(trades[:i])
+                continue
+            if kept is not None:
+                kept.append(trade)
+            self._check_gaps(producer, window, trade_id, timestamp, received)
+        self.trades += len(trades)
+
+        if kept is None:
+            return message
+        if not kept:
+            return None
+        return {"data": kept, "producer": producer, "received": received}
+
+    def _check_gaps(
+        self,
+        producer: str,
+        window: TradeWindow,
+        trade_id: Any,
+        timestamp: Optional[int],
+        received: float
+        ) -> None:
+        max_gap = self.max_time_gap_ms
+        if timestamp is not None:
+            last_timestamp = window.last_timestamp
+            if last_timestamp is not None and max_gap is not None and timestamp - last_timestamp > max_gap:
+                self.time_gaps += 1
+                self.emit(self._gap(TradeGap(producer, "time", received, last_timestamp, timestamp)))
+            if last_timestamp is None or timestamp > last_timestamp:
+                window.last_timestamp = timestamp
+
+        if window.sequential is False or not self.learn_ids:
+            return
+        try:
+            numeric = int(trade_id)
+        except (TypeError, ValueError):
+            window.sequential = False
+            return
+        last_id = window.last_id
+        if last_id is None or numeric <= last_id:
+            # First trade, or an older trade arriving late
+            if last_id is None:
+                window.last_id = numeric
+            return
+        window.last_id = numeric
+        step = numeric - last_id
+        if window.sequential is None:
+            if step != 1:
+                window.sequential = False
+                return
+            window.steps += 1
+            if window.steps >= self.learn_ids:
+                window.sequential = True
+                logger.info("Trade ids of [%s] are sequential, reporting id gaps", producer)
+            return
+        if step > 1:
+            self.id_gaps += 1
+            self.missing_ids += step - 1
+            self.emit(self._gap(TradeGap(producer, "id", received, last_id, numeric, step - 1)))
+
+    @staticmethod
+    def _gap(gap: TradeGap) -> Dict[str, Any]:
+        logger.warning(
+            "Trade %s gap on [%s]: %s -> %s%s", gap.kind, gap.producer, gap.first, gap.last,
+            f", {gap.missing} missing" if gap.missing is not None else ""
+        )
+        return {"data": gap, "producer": gap.producer, "received": gap.received}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "streams": len(self.windows),
+            "trades": self.trades,
+            "duplicates": self.duplicates,
+            "id_gaps": self.id_gaps,
+            "missing_ids": self.missing_ids,
+            "time_gaps": self.time_gaps,
+        }
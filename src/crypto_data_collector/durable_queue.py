@@ -0,0 +1,407 @@
+"""
+Disk backed consumer queue.
+
+DurableQueue is a drop-in asyncio.Queue for a consumer that must not lose
+messages when the process dies, or that may fall far behind its sink.
+Every message gets a sequential offset and is written to an mmap'd
+segment file when it is put:
+
+    <root>/<first offset>.seg    segment, header then records
+    <root>/ack                   first unacknowledged offset (uint64)
+
+Segment header: MAGIC, serializer byte (0 json, 1 msgpack)
+Record:         RECORD header (offset, payload length, crc32) + serialized message
+
+Only the oldest memory_items pending messages are also kept as objects in
+memory. Past that depth the queue spills: newer messages live on disk only
+and are read back in order once the consumer catches up, memory stays
+bounded however far the consumer falls behind.
+
+A consumer acknowledges a message by offset once it is handled, by default
+task_done() acknowledges the oldest message handed out. Acknowledged
+segments are deleted. On start the queue recovers every message after the
+last acknowledged offset from its segments, so a restarted consumer
+resumes where it stopped. Delivery is at least once: messages handed out
+but not acknowledged before a crash are delivered again.
+
+Writes go to the page cache through the mmap, a killed process loses
+nothing. Set fsync to also survive power loss, at the cost of a flush per
+message.
+
+Messages read back from disk, spilled or recovered, are decoded json /
+msgpack. Records (records.py) are stored with their type and rebuilt, a
+consumer gets the same record classes however far behind it is; other
+values come back as their json / msgpack equivalent (tuples as lists).
+"""
+import json
+import mmap
+import zlib
+import struct
+import asyncio
+import logging
+
+from collections import deque
+from pathlib import Path
+from typing import Any, BinaryIO, Deque, Dict, List, Optional, Tuple, Union
+
+from crypto_data_collector.records import from_tagged, tagged_default
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CDCSPL1\n"
+SEGMENT_HEADER = struct.Struct("<8sB")
+RECORD = struct.Struct("<QII")
+ACK = struct.Struct("<Q")
+
+SERIALIZERS = {"json": 0, "msgpack": 1}
+
+
+def _dumps(serializer: int, value: Any) -> bytes:
+    if serializer == 1:
+        return msgpack.packb(value, default=tagged_default, use_bin_type=True)
+    return json.dumps(value, default=tagged_default, separators=(",", ":")).encode()
+
+
+def _loads(serializer: int, payload: bytes) -> Any:
+    if serializer == 1:
+        value = msgpack.unpackb(payload, raw=False)
+    else:
+        value = json.loads(payload)
+    # Records, also the data of a message envelope, come back as records
+    value = from_tagged(value)
+    if type(value) is dict and "data" in value:
+        value["data"] = from_tagged(value["data"])
+    return value
+
+
+class Segment:
+    """
+    One mmap'd segment file, records are appended at position
+    """
+    __slots__ = ("path", "first", "last", "serializer", "position", "file", "map")
+
+    def __init__(self, path: Path, first: int, serializer: int, file: BinaryIO, map: mmap.mmap) -> None:
+        self.path = path
+        self.first = first
+        # Last offset written, first - 1 while empty
+        self.last = first - 1
+        self.serializer = serializer
+        self.position = SEGMENT_HEADER.size
+        self.file = file
+        self.map = map
+
+    @classmethod
+    def create(cls, path: Path, first: int, size: int, serializer: int) -> "Segment":
+        file = open(path, "x+b")
+        # Sparse, disk space is used as records are written
+        file.truncate(size)
+        segment = cls(path, first, serializer, file, mmap.mmap(file.fileno(), size))
+        SEGMENT_HEADER.pack_into(segment.map, 0, MAGIC, serializer)
+        return segment
+
+    @classmethod
+    def open(cls, path: Path) -> "Segment":
+        """
+        Open an existing segment and find its last complete record, a torn
+        record after a crash ends the segment
+        """
+        file = open(path, "r+b")
+        map = mmap.mmap(file.fileno(), 0)
+        magic, serializer = SEGMENT_HEADER.unpack_from(map, 0)
+        if magic != MAGIC:
+            map.close()
+            file.close()
+            raise ValueError(f"Not a queue segment: [{path}]")
+        if serializer == 1 and msgpack is None:
+            map.close()
+            file.close()
+            raise ImportError("Segment is msgpack serialized, install msgpack to read it")
+        segment = cls(path, int(path.stem), serializer, file, map)
+        size = len(map)
+        position = SEGMENT_HEADER.size
+        while position + RECORD.size <= size:
+            offset, length, crc = RECORD.unpack_from(map, position)
+            if length == 0:
+                break
+            end = position + RECORD.size + length
+            if offset != segment.last + 1 or end > size or zlib.crc32(map[position + RECORD.size:end]) != crc:
+                logger.warning("Torn record at %d of queue segment [%s], ignoring the rest", position, path)
+                break
+            segment.last = offset
+            position = end
+        segment.position = position
+        return segment
+
+    def fits(self, length: int) -> bool:
+        return self.position + RECORD.size + length <= len(self.map)
+
+    def append(self, offset: int, payload: bytes) -> int:
+        """
+        Write a record, the header goes last so a torn write fails the crc
+        """
+        position = self.position
+        start = position + RECORD.size
+        self.map[start:start + len(payload)] = payload
+        RECORD.pack_into(self.map, position, offset, len(payload), zlib.crc32(payload))
+        self.position = start + len(payload)
+        self.last = offset
+        return position
+
+    def read(self, position: int) -> Tuple[int, bytes, int]:
+        """
+        (offset, payload, next position) of the record at position
+        """
+        offset, length, _ = RECORD.unpack_from(self.map, position)
+        start = position + RECORD.size
+        return offset, self.map[start:start + length], start + length
+
+    def flush(self, position: int) -> None:
+        # msync from the page holding position
+        start = position - position % mmap.ALLOCATIONGRANULARITY
+        self.map.flush(start, self.position - start)
+
+    def close(self) -> None:
+        self.map.close()
+        self.file.close()
+
+
+class DurableQueue(asyncio.Queue):
+    """
+    Disk backed, unbounded asyncio.Queue with offset acknowledgements, see
+    the module docstring. Recovers unacknowledged messages from root_dir
+    on creation.
+
+    With auto_ack, task_done() acknowledges the oldest message handed out,
+    which suits consumers that handle messages in order (BaseConsumer run
+    loops, BatchConsumer). Without it call ack(offset) yourself, the offset
+    of the last message handed out is last_offset.
+
+    Args:
+        root_dir (str | Path): Directory of the queue, one queue per directory
+        memory_items (int): Pending messages also kept in memory, newer ones are read back from disk
+        segment_bytes (int): Size of a segment file
+        serializer (str): "msgpack" or "json", defaults to msgpack when installed
+        auto_ack (bool): task_done() acknowledges in order
+        fsync (bool): msync every message and acknowledgement
+    """
+
+    def __init__(
+        self,
+        root_dir: Union[str, Path],
+        memory_items: int = 10_000,
+        segment_bytes: int = 64 * 1024 * 1024,
+        serializer: Optional[str] = None,
+        auto_ack: bool = True,
+        fsync: bool = False
+        ) -> None:
+        if serializer is None:
+            serializer = "msgpack" if msgpack is not None else "json"
+        if serializer not in SERIALIZERS:
+            raise ValueError(f"Unsupported serializer: {serializer}")
+        if serializer == "msgpack" and msgpack is None:
+            raise ImportError("msgpack serialization requires msgpack, install with: poetry install -E recorder")
+        super().__init__()
+        self.root_dir = Path(root_dir)
+        self.memory_items = memory_items
+        self.segment_bytes = segment_bytes
+        self.serializer = SERIALIZERS[serializer]
+        self.auto_ack = auto_ack
+        self.fsync = fsync
+
+        self.segments: List[Segment] = []
+        # Recovered segments are only read, writes start a new one
+        self._writer: Optional[Segment] = None
+        self._memory: Deque[Tuple[int, Any]] = deque()
+        # Messages on disk only, read from _reader onwards
+        self._spilled = 0
+        self._reader: Optional[Tuple[Segment, int]] = None
+        # Handed out, not yet acknowledged
+        self._delivered: Deque[int] = deque()
+        self.next_offset = 0
+        self.committed = 0
+        self.last_offset: Optional[int] = None
+
+        self.spilled_total = 0
+        self.recovered = 0
+        self.high_water = 0
+        self._recover()
+
+    # Recovery
+    # -------------------------------------------------------------------------
+    def _recover(self) -> None:
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        ack_path = self.root_dir / "ack"
+        if not ack_path.exists():
+            ack_path.write_bytes(ACK.pack(0))
+        self._ack_file = open(ack_path, "r+b")
+        self._ack_map = mmap.mmap(self._ack_file.fileno(), ACK.size)
+        (self.committed,) = ACK.unpack_from(self._ack_map, 0)
+        self.next_offset = self.committed
+
+        for path in sorted(self.root_dir.glob("*.seg"), key=lambda p: int(p.stem)):
+            segment = Segment.open(path)
+            if segment.last < max(segment.first, self.committed):
+                segment.close()
+                path.unlink()
+                continue
+            self.segments.append(segment)
+            self.next_offset = max(self.next_offset, segment.last + 1)
+            if self._reader is None:
+                # First unacknowledged record
+                position = SEGMENT_HEADER.size
+                while position < segment.position:
+                    offset, _, following = segment.read(position)
+                    if offset >= self.committed:
+                        break
+                    position = following
+                self._reader = (segment, position)
+                first = max(segment.first, self.committed)
+            self._spilled += segment.last + 1 - max(segment.first, self.committed)
+
+        if self._spilled:
+            self.recovered = self._spilled
+            self._unfinished_tasks = self._spilled
+            self._finished.clear()
+            logger.info(
+                "Queue [%s] recovered %d unacknowledged messages, offsets %d to %d",
+                self.root_dir, self._spilled, first, self.next_offset - 1
+            )
+        else:
+            self._reader = None
+
+    # asyncio.Queue hooks
+    # -------------------------------------------------------------------------
+    def qsize(self) -> int:
+        return len(self._memory) + self._spilled
+
+    def empty(self) -> bool:
+        return not self._memory and not self._spilled
+
+    def _put(self, item: Any) -> None:
+        offset = self.next_offset
+        self.next_offset += 1
+        payload = _dumps(self.serializer, item)
+        segment = self._writer
+        if segment is None or not segment.fits(len(payload)):
+            segment = self._roll(offset, len(payload))
+        position = segment.append(offset, payload)
+        if self.fsync:
+            segment.flush(position)
+
+        if not self._spilled and len(self._memory) < self.memory_items:
+            self._memory.append((offset, item))
+        else:
+            if not self._spilled:
+                self._reader = (segment, position)
+                logger.info("Queue [%s] spilling to disk at %d pending messages", self.root_dir, len(self._memory))
+            self._spilled += 1
+            self.spilled_total += 1
+        size = self.qsize()
+        if size > self.high_water:
+            self.high_water = size
+
+    def _get(self) -> Any:
+        if self._memory:
+            offset, item = self._memory.popleft()
+        else:
+            offset, item = self._read()
+        self._delivered.append(offset)
+        self.last_offset = offset
+        return item
+
+    def task_done(self, ack: bool = True) -> None:
+        """
+        With auto_ack, also acknowledge the oldest message handed out.
+        ack False leaves it unacknowledged, it is delivered again after a
+        restart.
+        """
+        super().task_done()
+        if ack and self.auto_ack and self._delivered:
+            self.ack(self._delivered[0])
+
+    # Disk
+    # -------------------------------------------------------------------------
+    def _roll(self, first: int, length: int) -> Segment:
+        size = max(self.segment_bytes, SEGMENT_HEADER.size + RECORD.size + length)
+        segment = Segment.create(self.root_dir / f"{first:020d}.seg", first, size, self.serializer)
+        self.segments.append(segment)
+        self._writer = segment
+        return segment
+
+    def _read(self) -> Tuple[int, Any]:
+        segment, position = self._reader
+        if position >= segment.position:
+            segment = self.segments[self.segments.index(segment) + 1]
+            position = SEGMENT_HEADER.size
+        offset, payload, position = segment.read(position)
+        self._spilled -= 1
+        self._reader = (segment, position) if self._spilled else None
+        return offset, _loads(segment.serializer, payload)
+
+    def ack(self, offset: int) -> None:
+        """
+        Acknowledge every message up to and including offset
+        """
+        if offset >= self.next_offset:
+            raise ValueError(f"Offset {offset} was never put, next offset is {self.next_offset}")
+        if offset < self.committed:
+            return
+        self.committed = offset + 1
+        ACK.pack_into(self._ack_map, 0, self.committed)
+        if self.fsync:
+            self._ack_map.flush()
+        delivered = self._delivered
+        while delivered and delivered[0] <= offset:
+            delivered.popleft()
+        # Drop fully acknowledged segments, the one being written and the one
+        # being read stay, the reader steps to the next segment from it
+        segments = self.segments
+        reading = self._reader[0] if self._reader is not None else None
+        while (
+            segments and segments[0] is not self._writer and segments[0] is not reading
+            and segments[0].last < self.committed
+        ):
+            segment = segments.pop(0)
+            segment.close()
+            segment.path.unlink()
+
+    def flush(self) -> None:
+        """
+        msync the segment being written and the acknowledged offset
+        """
+        if self._writer is not None:
+            self._writer.map.flush()
+        self._ack_map.flush()
+
+    def close(self) -> None:
+        """
+        Flush and close the files, unacknowledged messages are recovered
+        by the next queue on root_dir
+        """
+        self.flush()
+        for segment in self.segments:
+            segment.close()
+        self.segments.clear()
+        self._writer = None
+        self._ack_map.close()
+        self._ack_file.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.qsize(),
+            "maxsize": self.maxsize,
+            "high_water": self.high_water,
+            "memory": len(self._memory),
+            "spilled": self._spilled,
+            "spilled_total": self.spilled_total,
+            "recovered": self.recovered,
+            "committed": self.committed,
+            "next_offset": self.next_offset,
+            "segments": len(self.segments),
+            "disk_bytes": sum(s.position for s in self.segments),
+        }
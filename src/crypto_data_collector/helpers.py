@@ -4,6 +4,7 @@ import time
 import logging
 import yaml
 
+from fnmatch import fnmatchcase
 from pathlib import Path
 from enum import Enum, auto
 from dataclasses import dataclass, field
@@ -18,12 +19,17 @@ class Status(Enum):
     BACKOFF = auto()
     CANCELLED = auto()
     ERRORED = auto()
+    # Finite producers (replay) that reached the end of their input
+    FINISHED = auto()
+    # Silent for too long, the watchdog is restarting the subscription
+    STALLED = auto()
 
 @dataclass(frozen=False)
 class State():
     status: Status | None = None
     tries: int = 0
-    timeout: float = 0.0
+    # Current backoff delay in seconds
+    timeout: float = 1.0
     last_error: str | None = None
     since: float = field(default_factory=lambda: time.time())
 
@@ -55,6 +61,68 @@ def producer_name_parser(producer_name:str) -> List[str]:
     """
     return producer_name.split("|")
 
+# Short stream names accepted in consumer config, e.g. valid_streams: ["orderbook", "trades"]
+STREAM_ALIASES = {
+    "trades": "watchTrades",
+    "orderbook": "watchOrderBook",
+    "ticker": "watchTicker",
+    "ohlcv": "watchOHLCV",
+}
+
+@dataclass(frozen=True)
+class Subscription():
+    """
+    What a consumer wants to receive, matched against the producer name.
+    Each field is a glob pattern (fnmatch), "*" matches everything.
+    """
+    exchange: str = "*"
+    symbol: str = "*"
+    stream: str = "*"
+
+    @classmethod
+    def parse(cls, pattern: str) -> "Subscription":
+        """
+        Parse a pattern in producer name format "exchange|symbol|stream",
+        missing trailing parts default to "*"
+        """
+        parts = pattern.split("|")
+        if len(parts) > 3:
+            raise ValueError(f"Invalid subscription pattern: {pattern}")
+        parts += ["*"] * (3 - len(parts))
+        return cls(parts[0], parts[1], STREAM_ALIASES.get(parts[2], parts[2]))
+
+    @classmethod
+    def from_config(cls, consumer_config: Optional[Dict[str, Any]]) -> Optional[List["Subscription"]]:
+        """
+        Build subscriptions from a consumer config entry.
+        Recognised keys: valid_streams, exchanges, symbols (lists of patterns)
+        Returns None (receive everything) if none of them are set
+        """
+        if not consumer_config:
+            return None
+        streams = consumer_config.get("valid_streams") or ["*"]
+        exchanges = consumer_config.get("exchanges") or ["*"]
+        symbols = consumer_config.get("symbols") or ["*"]
+        if streams == exchanges == symbols == ["*"]:
+            return None
+        return [
+            cls(exchange, symbol, STREAM_ALIASES.get(stream, stream))
+            for exchange in exchanges
+            for symbol in symbols
+            for stream in streams
+        ]
+
+    def matches(self, producer_name: str) -> bool:
+        parts = producer_name_parser(producer_name)
+        if len(parts) != 3:
+            return False
+        exchange, symbol, stream = parts
+        return (
+            fnmatchcase(exchange, self.exchange)
+            and fnmatchcase(symbol, self.symbol)
+            and fnmatchcase(stream, self.stream)
+        )
+
 def setup_logger(
     log_file_path: Optional[Union[str, Path]] = None,
     level: int = logging.INFO,
@@ -0,0 +1,90 @@
+"""
+On-disk cache of exchange market metadata.
+
+load_markets() is a full REST round trip per exchange (several for some
+exchanges), and dominates startup with many exchanges. MarketCache stores
+the loaded markets and currencies of an exchange as JSON, keyed by the
+exchange name and its overrides, and serves them until they are ttl_s old:
+
+    <cache_dir>/<exchange>-<overrides hash>.json
+
+Files are replaced atomically, concurrent writers (e.g. shard processes)
+never leave a partial file behind.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class MarketCache:
+    """
+    Args:
+        cache_dir (str | Path): Directory of the cache files
+        ttl_s (float, optional): Seconds a cached entry is served for, None never expires
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], ttl_s: Optional[float] = 24 * 3600.0) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, exchange_name: str, overrides: Optional[Dict[str, Any]] = None) -> Path:
+        # Overrides like sandbox mode or default market types change the markets
+        key = json.dumps(overrides or {}, sort_keys=True, default=str)
+        digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+        return self.cache_dir / f"{exchange_name}-{digest}.json"
+
+    def load(self, exchange_name: str, overrides: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Cached {"markets", "currencies"} of an exchange, None if missing,
+        expired or unreadable
+        """
+        path = self.path(exchange_name, overrides)
+        try:
+            entry = json.loads(path.read_text())
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Unreadable market cache [%s]: %s", path, e)
+            self.misses += 1
+            return None
+
+        age = time.time() - entry.get("created", 0)
+        if self.ttl_s is not None and age > self.ttl_s:
+            logger.info("Market cache of exchange [%s] expired, %.0fs old", exchange_name, age)
+            self.misses += 1
+            return None
+        self.hits += 1
+        logger.info("Loaded markets of exchange [%s] from cache, %.0fs old", exchange_name, age)
+        return {"markets": entry["markets"], "currencies": entry.get("currencies")}
+
+    def store(
+        self,
+        exchange_name: str,
+        overrides: Optional[Dict[str, Any]],
+        markets: Dict[str, Any],
+        currencies: Optional[Dict[str, Any]] = None
+        ) -> Path:
+        """
+        Write the markets and currencies of an exchange to the cache
+        """
+        path = self.path(exchange_name, overrides)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry = {"exchange": exchange_name, "created": time.time(), "markets": markets, "currencies": currencies}
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(entry, default=str))
+        os.replace(tmp, path)
+        logger.info("Cached [%d] markets of exchange [%s] to [%s]", len(markets), exchange_name, path)
+        return path
+
+    def invalidate(self, exchange_name: str, overrides: Optional[Dict[str, Any]] = None) -> None:
+        self.path(exchange_name, overrides).unlink(missing_ok=True)
@@ -0,0 +1,404 @@
+"""
+Pipeline metrics.
+
+Producers and consumers keep plain attribute counters on their hot paths
+(a message count, plus a latency histogram and a payload size estimate
+updated on every SAMPLE_EVERY-th message). MetricsCollector reads those
+counters and the queue stats when scraped and turns them into rates,
+latency percentiles and the Prometheus text format, served on a local
+port with serve().
+
+Latencies are in milliseconds:
+    producer: exchange timestamp -> received (wall clock, includes clock skew)
+    consumer: received -> consumed
+
+Prometheus latency histograms are exported with the fixed le bounds of
+LATENCY_BUCKETS_MS on every scrape, so rate() and histogram_quantile()
+work across scrapes and series.
+"""
+import json
+import math
+import time
+import logging
+
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, TYPE_CHECKING
+
+from crypto_data_collector.helpers import producer_name_parser
+from crypto_data_collector.records import OHLCVRecord, Record, json_default
+from crypto_data_collector.server import HttpServer, Request, Response
+
+if TYPE_CHECKING:
+    from crypto_data_collector.consumer import ConsumerPipeline
+    from crypto_data_collector.producer import ProducerPipeline
+
+logger = logging.getLogger(__name__)
+
+# Power of two, sampled work runs on every SAMPLE_EVERY-th message
+SAMPLE_EVERY = 16
+SAMPLE_MASK = SAMPLE_EVERY - 1
+
+# le bounds of the exported latency histograms, +Inf is added
+LATENCY_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class Histogram:
+    """
+    HDR style log-linear histogram. Values are bucketed by power of two,
+    each split into 2**precision linear sub buckets, so the relative error
+    of any recorded value is below 1 / 2**precision (12.5% by default)
+    whatever its magnitude. Only non empty buckets are stored.
+
+    Values below min_value (including negative latencies from clock skew)
+    are recorded as min_value.
+    """
+    __slots__ = ("sub_buckets", "min_value", "counts", "count", "sum", "max")
+
+    def __init__(self, precision: int = 3, min_value: float = 0.001) -> None:
+        self.sub_buckets = 1 << precision
+        self.min_value = min_value
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value: float) -> None:
+        if value < self.min_value:
+            value = self.min_value
+        mantissa, exponent = math.frexp(value)
+        # mantissa is in [0.5, 1)
+        index = exponent * self.sub_buckets + int((mantissa - 0.5) * 2 * self.sub_buckets)
+        counts = self.counts
+        counts[index] = counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def lower_bound(self, index: int) -> float:
+        exponent, sub = divmod(index, self.sub_buckets)
+        return math.ldexp(0.5 + sub / (2 * self.sub_buckets), exponent)
+
+    def upper_bound(self, index: int) -> float:
+        exponent, sub = divmod(index, self.sub_buckets)
+        return math.ldexp(0.5 + (sub + 1) / (2 * self.sub_buckets), exponent)
+
+    def buckets(self) -> List[Tuple[float, int]]:
+        """
+        Cumulative (upper bound, count) pairs of the non empty buckets
+        """
+        total = 0
+        out = []
+        for index in sorted(self.counts):
+            total += self.counts[index]
+            out.append((self.upper_bound(index), total))
+        return out
+
+    def cumulative(self, bounds: Sequence[float]) -> List[int]:
+        """
+        Cumulative counts at fixed ascending bounds (Prometheus le buckets).
+        A bucket counts toward the first bound at or above its lower edge,
+        exact within the relative error of the histogram.
+        """
+        counts = [0] * len(bounds)
+        for index, count in self.counts.items():
+            position = bisect_left(bounds, self.lower_bound(index))
+            if position < len(counts):
+                counts[position] += count
+        return list(accumulate(counts))
+
+    def percentile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-th percentile (0-100), capped at the max
+        """
+        if not self.count:
+            return 0.0
+        target = max(1, math.ceil(self.count * q / 100))
+        for bound, total in self.buckets():
+            if total >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def merge(self, other: "Histogram") -> None:
+        if other.sub_buckets != self.sub_buckets:
+            raise ValueError("Cannot merge histograms of different precision")
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def reset(self) -> None:
+        self.counts.clear()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+def exchange_timestamp(data: Any) -> Optional[float]:
+    """
+    Exchange timestamp of a raw ccxt payload or record, the newest entry for lists.
+    None for candles, whose timestamp is the open time and not a send time.
+    """
+    if isinstance(data, list):
+        if not data:
+            return None
+        data = data[-1]
+    if isinstance(data, OHLCVRecord):
+        return None
+    if isinstance(data, Record):
+        return getattr(data, "timestamp", None)
+    if isinstance(data, dict):
+        return data.get("timestamp")
+    return None
+
+
+def payload_size(data: Any) -> int:
+    """
+    Approximate size of a payload in bytes, as compact JSON
+    """
+    try:
+        return len(json.dumps(data, default=json_default, separators=(",", ":")))
+    except (TypeError, ValueError):
+        return 0
+
+
+class RateMeter:
+    """
+    Messages per second of monotonically increasing counters, measured
+    between scrapes at least min_interval seconds apart
+    """
+
+    def __init__(self, min_interval: float = 1.0) -> None:
+        self.min_interval = min_interval
+        # name -> (time, count, rate)
+        self._last: Dict[str, Tuple[float, int, float]] = {}
+
+    def rate(self, name: str, count: int, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        last = self._last.get(name)
+        if last is None or count < last[1]:
+            self._last[name] = (now, count, 0.0)
+            return 0.0
+        then, last_count, last_rate = last
+        elapsed = now - then
+        if elapsed < self.min_interval:
+            return last_rate
+        rate = (count - last_count) / elapsed
+        self._last[name] = (now, count, rate)
+        return rate
+
+    def forget(self, names: Iterable[str]) -> None:
+        for name in list(self._last):
+            if name not in names:
+                del self._last[name]
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+class MetricsCollector:
+    """
+    Reads the counters of a ProducerPipeline and ConsumerPipeline.
+
+    Producers running in shard processes are not visible here, only the
+    main queue they feed.
+
+    Args:
+        producer_pipeline (ProducerPipeline, optional)
+        consumer_pipeline (ConsumerPipeline, optional)
+        namespace (str): Prefix of the Prometheus metric names
+        latency_buckets (sequence): Ascending le bounds of the exported latency histograms, in ms
+    """
+
+    def __init__(
+        self,
+        producer_pipeline: Optional["ProducerPipeline"] = None,
+        consumer_pipeline: Optional["ConsumerPipeline"] = None,
+        namespace: str = "crypto_collector",
+        latency_buckets: Sequence[float] = LATENCY_BUCKETS_MS
+        ) -> None:
+        self.producer_pipeline = producer_pipeline
+        self.consumer_pipeline = consumer_pipeline
+        self.namespace = namespace
+        self.latency_buckets = tuple(sorted(latency_buckets))
+        self.rates = RateMeter()
+        self.server: Optional[HttpServer] = None
+
+    def producer_stats(self) -> Dict[str, Dict[str, Any]]:
+        if self.producer_pipeline is None:
+            return {}
+        stats = {}
+        for name, producer in list(self.producer_pipeline.producers.items()):
+            stats[name] = {
+                "status": producer.state.status.name.lower() if producer.state.status else None,
+                "tries": producer.state.tries,
+                "restarts": producer.restarts,
+                "stalls": producer.stalls,
+                "messages": producer.messages,
+                "rate": self.rates.rate(f"producer:{name}", producer.messages),
+                "bytes": producer.bytes,
+                "latency_ms": producer.latency.summary(),
+            }
+        return stats
+
+    def consumer_stats(self) -> Dict[str, Dict[str, Any]]:
+        if self.consumer_pipeline is None:
+            return {}
+        stats = {}
+        for name, consumer in list(self.consumer_pipeline.consumers.items()):
+            queue = consumer.data_queue
+            stats[name] = {
+                "status": consumer.status,
+                "consumed": consumer.consumed,
+                "rate": self.rates.rate(f"consumer:{name}", consumer.consumed),
+                "queue": queue.stats() if hasattr(queue, "stats") else {"size": queue.qsize()},
+                "latency_ms": consumer.latency.summary(),
+            }
+        return stats
+
+    def queue_stats(self) -> Dict[str, Any]:
+        queue = None
+        if self.consumer_pipeline is not None:
+            queue = self.consumer_pipeline.data_queue
+        elif self.producer_pipeline is not None:
+            queue = self.producer_pipeline.data_queue
+        if queue is None:
+            return {}
+        return queue.stats() if hasattr(queue, "stats") else {"size": queue.qsize(), "maxsize": queue.maxsize}
+
+    def snapshot(self) -> Dict[str, Any]:
+        snapshot = {
+            "producers": self.producer_stats(),
+            "consumers": self.consumer_stats(),
+            "queue": self.queue_stats(),
+        }
+        if self.consumer_pipeline is not None:
+            snapshot["stages"] = {s.name: s.stats() for s in self.consumer_pipeline.stages}
+            if self.consumer_pipeline.ring is not None:
+                snapshot["ring"] = self.consumer_pipeline.ring.stats()
+        names = {f"producer:{n}" for n in snapshot["producers"]} | {f"consumer:{n}" for n in snapshot["consumers"]}
+        self.rates.forget(names)
+        return snapshot
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format (0.0.4)
+        """
+        ns = self.namespace
+        lines: List[str] = []
+        families: Dict[str, Tuple[str, str, List[str]]] = {}
+
+        def add(name: str, kind: str, help_text: str, labels: Dict[str, Any], value: float) -> None:
+            family = families.setdefault(name, (kind, help_text, []))
+            family[2].append(f"{ns}_{name}{_labels(labels)} {value}")
+
+        def add_histogram(name: str, help_text: str, labels: Dict[str, Any], histogram: Histogram) -> None:
+            family = families.setdefault(name, ("histogram", help_text, []))
+            # Same bounds on every scrape, empty buckets included
+            for bound, total in zip(self.latency_buckets, histogram.cumulative(self.latency_buckets)):
+                family[2].append(f"{ns}_{name}_bucket{_labels({**labels, 'le': repr(float(bound))})} {total}")
+            family[2].append(f"{ns}_{name}_bucket{_labels({**labels, 'le': '+Inf'})} {histogram.count}")
+            family[2].append(f"{ns}_{name}_sum{_labels(labels)} {histogram.sum}")
+            family[2].append(f"{ns}_{name}_count{_labels(labels)} {histogram.count}")
+
+        snapshot = self.snapshot()
+        producers = self.producer_pipeline.producers if self.producer_pipeline else {}
+        for name, stats in snapshot["producers"].items():
+            parts = producer_name_parser(name)
+            if len(parts) == 3:
+                labels = {"exchange": parts[0], "symbol": parts[1], "stream": parts[2]}
+            else:
+                labels = {"producer": name}
+            add("producer_messages_total", "counter", "Messages produced", labels, stats["messages"])
+            add("producer_messages_per_second", "gauge", "Messages produced per second", labels, stats["rate"])
+            add("producer_bytes_total", "counter", "Estimated payload bytes produced (sampled)", labels, stats["bytes"])
+            add("producer_tries", "gauge", "Consecutive failed attempts", labels, stats["tries"])
+            add("producer_restarts_total", "counter", "Restarts after giving up", labels, stats["restarts"])
+            add("producer_stalls_total", "counter", "Subscriptions restarted by the stall watchdog", labels, stats["stalls"])
+            # One series per producer, the current status as a label
+            add("producer_status", "gauge", "Producer status", {**labels, "status": stats["status"] or "unknown"}, 1)
+            if name in producers:
+                add_histogram(
+                    "producer_latency_ms", "Exchange timestamp to receive latency (sampled)",
+                    labels, producers[name].latency
+                )
+
+        consumers = self.consumer_pipeline.consumers if self.consumer_pipeline else {}
+        for name, stats in snapshot["consumers"].items():
+            labels = {"consumer": name}
+            queue = stats["queue"]
+            add("consumer_messages_total", "counter", "Messages consumed", labels, stats["consumed"])
+            add("consumer_messages_per_second", "gauge", "Messages consumed per second", labels, stats["rate"])
+            add("consumer_queue_size", "gauge", "Messages waiting in the consumer queue", labels, queue.get("size", 0))
+            if "high_water" in queue:
+                add("consumer_queue_high_water", "gauge", "Largest consumer queue size seen", labels, queue["high_water"])
+            if "dropped_oldest" in queue:
+                add(
+                    "consumer_dropped_total", "counter", "Messages dropped by the consumer queue overflow policy",
+                    labels, queue["dropped_oldest"] + queue["dropped_newest"]
+                )
+                add("consumer_conflated_total", "counter", "Messages conflated", labels, queue["conflated"])
+            if "spilled" in queue:
+                add("consumer_queue_spilled", "gauge", "Pending messages held on disk only", labels, queue["spilled"])
+                add("consumer_queue_disk_bytes", "gauge", "Bytes in the consumer queue segments", labels, queue["disk_bytes"])
+            if "lagged" in queue:
+                add("consumer_lagged_total", "counter", "Messages skipped after being lapped by the ring", labels, queue["lagged"])
+            if name in consumers:
+                add_histogram(
+                    "consumer_latency_ms", "Receive to consume latency (sampled)", labels, consumers[name].latency
+                )
+
+        queue = snapshot["queue"]
+        if queue:
+            add("queue_size", "gauge", "Messages waiting in the main queue", {}, queue.get("size", 0))
+            if "high_water" in queue:
+                add("queue_high_water", "gauge", "Largest main queue size seen", {}, queue["high_water"])
+                add(
+                    "queue_dropped_total", "counter", "Messages dropped by the main queue overflow policy",
+                    {}, queue["dropped_oldest"] + queue["dropped_newest"]
+                )
+                add("queue_conflated_total", "counter", "Messages conflated in the main queue", {}, queue["conflated"])
+
+        for name, (kind, help_text, samples) in families.items():
+            lines.append(f"# HELP {ns}_{name} {help_text}")
+            lines.append(f"# TYPE {ns}_{name} {kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def metrics_handler(self, request: Request) -> Response:
+        return Response.text(self.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+    def stats_handler(self, request: Request) -> Response:
+        return Response.json(self.snapshot())
+
+    def add_routes(self, server: HttpServer) -> None:
+        server.route("GET", "/metrics", self.metrics_handler)
+        server.route("GET", "/stats", self.stats_handler)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 9464) -> HttpServer:
+        """
+        Start an HTTP server with GET /metrics (Prometheus) and GET /stats (JSON)
+        """
+        self.server = HttpServer(host, port)
+        self.add_routes(self.server)
+        await self.server.start()
+        return self.server
@@ -0,0 +1,336 @@
+"""
+Local order books for watchOrderBook streams.
+
+ccxt hands every watchOrderBook caller the full book on each update. The
+OrderBookEngine stage keeps a sorted local copy per producer and replaces
+those messages with compact OrderBookDelta records (only the levels that
+changed), plus a full OrderBookRecord snapshot every snapshot_interval
+updates or after a sequence error. Consumers rebuild the book from the
+snapshot and deltas with OrderBookReplica, each delta carries a checksum
+of the resulting top of book to validate against.
+"""
+import zlib
+import logging
+
+from array import array
+from bisect import bisect_left, insort
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from crypto_data_collector.helpers import producer_name_parser
+from crypto_data_collector.records import OrderBookRecord, Record
+from crypto_data_collector.stages import BaseStage
+
+logger = logging.getLogger(__name__)
+
+BID = 0.0
+ASK = 1.0
+
+
+class BookSide:
+    """
+    One side of a book. Prices are kept in a sorted list with the best
+    level first, sizes in a dict keyed by price.
+    Best level O(1), top N O(N), size changes of a known level O(1).
+    Adding or removing a level is an O(log n) bisect plus an O(n) list
+    shift, a memmove that stays cheap at the depths exchanges send.
+    """
+    __slots__ = ("sign", "keys", "sizes")
+
+    def __init__(self, descending: bool) -> None:
+        # Bids are stored as negative prices so both sides sort best first
+        self.sign = -1.0 if descending else 1.0
+        self.keys: List[float] = []
+        self.sizes: Dict[float, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def set(self, price: float, size: float) -> None:
+        if size == 0:
+            if self.sizes.pop(price, None) is not None:
+                key = self.sign * price
+                del self.keys[bisect_left(self.keys, key)]
+            return
+        if price not in self.sizes:
+            insort(self.keys, self.sign * price)
+        self.sizes[price] = size
+
+    def clear(self) -> None:
+        self.keys.clear()
+        self.sizes.clear()
+
+    def best(self) -> Optional[Tuple[float, float]]:
+        if not self.keys:
+            return None
+        price = self.sign * self.keys[0]
+        return price, self.sizes[price]
+
+    def top(self, n: int) -> List[Tuple[float, float]]:
+        sign, sizes = self.sign, self.sizes
+        return [(sign * k, sizes[sign * k]) for k in self.keys[:n]]
+
+    def packed(self, n: Optional[int] = None) -> array:
+        sign, sizes = self.sign, self.sizes
+        return array("d", [x for k in self.keys[:n] for x in (sign * k, sizes[sign * k])])
+
+
+class LocalOrderBook:
+    def __init__(self, producer: str = "") -> None:
+        self.producer = producer
+        self.bids = BookSide(descending=True)
+        self.asks = BookSide(descending=False)
+        self.nonce: Optional[int] = None
+        self.timestamp: Optional[int] = None
+
+    def best_bid(self) -> Optional[Tuple[float, float]]:
+        return self.bids.best()
+
+    def best_ask(self) -> Optional[Tuple[float, float]]:
+        return self.asks.best()
+
+    def mid(self) -> Optional[float]:
+        if not self.bids.keys or not self.asks.keys:
+            return None
+        return (-self.bids.keys[0] + self.asks.keys[0]) / 2
+
+    def spread(self) -> Optional[float]:
+        if not self.bids.keys or not self.asks.keys:
+            return None
+        return self.asks.keys[0] + self.bids.keys[0]
+
+    def top(self, n: int) -> Dict[str, List[Tuple[float, float]]]:
+        return {"bids": self.bids.top(n), "asks": self.asks.top(n)}
+
+    def checksum(self, depth: int = 25) -> int:
+        """
+        crc32 over the top depth levels of both sides, "price:size" joined by "|"
+        """
+        levels = [f"{p!r}:{s!r}" for p, s in self.bids.top(depth)]
+        levels += [f"{p!r}:{s!r}" for p, s in self.asks.top(depth)]
+        return zlib.crc32("|".join(levels).encode())
+
+    def apply_changes(self, changes: Iterable[float]) -> None:
+        """
+        Apply flat (side, price, size) triplets, size 0 removes the level
+        """
+        it = iter(changes)
+        for side, price, size in zip(it, it, it):
+            (self.bids if side == BID else self.asks).set(price, size)
+
+    def load(self, bids: Iterable[Tuple[float, float]], asks: Iterable[Tuple[float, float]]) -> None:
+        self.bids.clear()
+        self.asks.clear()
+        for price, size in bids:
+            self.bids.set(price, size)
+        for price, size in asks:
+            self.asks.set(price, size)
+
+    def diff(self, bids: Iterable[Tuple[float, float]], asks: Iterable[Tuple[float, float]]) -> array:
+        """
+        Update the book to a new full snapshot, returns the changed levels
+        as flat (side, price, size) triplets
+        """
+        changes = array("d")
+        for side_id, side, levels in ((BID, self.bids, bids), (ASK, self.asks, asks)):
+            sizes = side.sizes
+            seen = {}
+            for price, size in levels:
+                seen[price] = size
+                if sizes.get(price) != size:
+                    changes.extend((side_id, price, size))
+            for price in [p for p in sizes if p not in seen]:
+                changes.extend((side_id, price, 0.0))
+        self.apply_changes(changes)
+        return changes
+
+
+class OrderBookDelta(Record):
+    """
+    Changed levels since the previous message of the same producer.
+    changes = array('d', [side, price, size, ...]), side 0 bid / 1 ask, size 0 removes the level
+    checksum is LocalOrderBook.checksum of the book after applying the changes
+    """
+    __slots__ = ("producer", "timestamp", "received", "nonce", "prev_nonce", "changes", "checksum")
+    array_fields = ("changes",)
+
+    def __init__(
+        self,
+        producer: str,
+        timestamp: Optional[int],
+        received: float,
+        nonce: Optional[int],
+        prev_nonce: Optional[int],
+        changes: array,
+        checksum: int
+        ) -> None:
+        self.producer = producer
+        self.timestamp = timestamp
+        self.received = received
+        self.nonce = nonce
+        self.prev_nonce = prev_nonce
+        self.changes = changes
+        self.checksum = checksum
+
+
+def _levels(data: Any, side: str) -> Iterable[Tuple[float, float]]:
+    if isinstance(data, OrderBookRecord):
+        flat = getattr(data, side)
+        return zip(flat[0::2], flat[1::2])
+    return ((level[0], level[1]) for level in data.get(side, ()))
+
+
+def _field(data: Any, name: str) -> Any:
+    if isinstance(data, OrderBookRecord):
+        return getattr(data, name)
+    return data.get(name)
+
+
+class OrderBookEngine(BaseStage):
+    """
+    Stage that turns full watchOrderBook messages into deltas.
+
+    Accepts raw ccxt order books or OrderBookRecord. The first message of a
+    producer, every snapshot_interval-th message and the first message after
+    a sequence error are sent as a full OrderBookRecord snapshot, every other
+    message as an OrderBookDelta. Messages with no changes are dropped.
+
+    Sequence validation: a nonce lower or equal to the previous one is out
+    of order and dropped, the next accepted message is sent as a snapshot.
+
+    Args:
+        snapshot_interval (int): Updates between full snapshots, at least 1
+        checksum_depth (int): Levels per side covered by delta checksums, 0 disables
+        depth (int, optional): Max levels per side kept in the local book
+        streams (tuple): Stream names handled by the engine
+    """
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        snapshot_interval: int = 1000,
+        checksum_depth: int = 25,
+        depth: Optional[int] = None,
+        streams: Tuple[str, ...] = ("watchOrderBook",)
+        ) -> None:
+        super().__init__(name)
+        if snapshot_interval < 1:
+            raise ValueError("snapshot_interval must be at least 1")
+        self.snapshot_interval = snapshot_interval
+        self.checksum_depth = checksum_depth
+        self.depth = depth
+        self.streams = streams
+        self.books: Dict[str, LocalOrderBook] = {}
+        self._updates: Dict[str, int] = {}
+        self._handled: Dict[str, bool] = {}
+        self._resync: set = set()
+
+        self.deltas = 0
+        self.snapshots = 0
+        self.out_of_order = 0
+        self.unchanged = 0
+
+    def book(self, producer: str) -> Optional[LocalOrderBook]:
+        return self.books.get(producer)
+
+    def delta_streams(self) -> Tuple[str, ...]:
+        return tuple(self.streams)
+
+    def resync(self) -> None:
+        # Next message of every book goes out as a snapshot
+        self._resync.update(self.books)
+
+    def process(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        producer = message["producer"]
+        handled = self._handled.get(producer)
+        if handled is None:
+            handled = producer_name_parser(producer)[-1] in self.streams
+            self._handled[producer] = handled
+        if not handled:
+            return message
+
+        data = message["data"]
+        if isinstance(data, OrderBookDelta):
+            return message
+        nonce = _field(data, "nonce")
+        book = self.books.get(producer)
+        if book is None:
+            book = self.books[producer] = LocalOrderBook(producer)
+            self._resync.add(producer)
+        elif nonce is not None and book.nonce is not None and nonce <= book.nonce:
+            self.out_of_order += 1
+            self._resync.add(producer)
+            logger.warning(
+                "Out of order book update for [%s]: nonce %s after %s, resyncing", producer, nonce, book.nonce
+            )
+            return None
+
+        bids, asks = _levels(data, "bids"), _levels(data, "asks")
+        if self.depth is not None:
+            bids, asks = list(bids)[:self.depth], list(asks)[:self.depth]
+        prev_nonce, prev_timestamp = book.nonce, book.timestamp
+        book.nonce = nonce
+        book.timestamp = _field(data, "timestamp")
+        received = message.get("received", 0.0)
+
+        count = self._updates.get(producer, 0) + 1
+        self._updates[producer] = count
+        if producer in self._resync or count % self.snapshot_interval == 0:
+            self._resync.discard(producer)
+            book.load(bids, asks)
+            self.snapshots += 1
+            snapshot = OrderBookRecord(producer, book.timestamp, received, nonce, book.bids.packed(), book.asks.packed())
+            return {"data": snapshot, "producer": producer, "received": received}
+
+        changes = book.diff(bids, asks)
+        if not changes:
+            # Nothing sent downstream, keep the nonce replicas last saw
+            book.nonce, book.timestamp = prev_nonce, prev_timestamp
+            self.unchanged += 1
+            return None
+        self.deltas += 1
+        checksum = book.checksum(self.checksum_depth) if self.checksum_depth else 0
+        delta = OrderBookDelta(producer, book.timestamp, received, nonce, prev_nonce, changes, checksum)
+        return {"data": delta, "producer": producer, "received": received}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "books": len(self.books),
+            "deltas": self.deltas,
+            "snapshots": self.snapshots,
+            "out_of_order": self.out_of_order,
+            "unchanged": self.unchanged,
+        }
+
+
+class OrderBookReplica(LocalOrderBook):
+    """
+    Consumer side book rebuilt from OrderBookEngine snapshots and deltas.
+
+    apply() returns False when the book cannot be trusted: a delta arrived
+    before any snapshot, it does not follow the last applied nonce, or the
+    checksum does not match. The replica then waits for the next snapshot.
+    """
+
+    def __init__(self, producer: str = "", checksum_depth: int = 25) -> None:
+        super().__init__(producer)
+        self.checksum_depth = checksum_depth
+        self.synced = False
+        self.checksum_errors = 0
+
+    def apply(self, data: Any) -> bool:
+        if isinstance(data, OrderBookRecord):
+            self.load(_levels(data, "bids"), _levels(data, "asks"))
+            self.nonce, self.timestamp = data.nonce, data.timestamp
+            self.synced = True
+            return True
+        if not self.synced or data.prev_nonce != self.nonce:
+            self.synced = False
+            return False
+        self.apply_changes(data.changes)
+        self.nonce, self.timestamp = data.nonce, data.timestamp
+        if self.checksum_depth and data.checksum != self.checksum(self.checksum_depth):
+            self.checksum_errors += 1
+            self.synced = False
+            logger.warning("Checksum mismatch on book [%s] at nonce %s", self.producer, data.nonce)
+            return False
+        return True
@@ -1,10 +1,16 @@
+import sys
+import time
 import logging
 import ccxt.pro
 import asyncio
 
-from typing import List, Callable, Union, Tuple, Optional, Dict, Any, TYPE_CHECKING
+from typing import List, Callable, Iterable, Union, Tuple, Optional, Dict, Any, TYPE_CHECKING
 
 from crypto_data_collector.helpers import State, Status
+from crypto_data_collector.metrics import SAMPLE_EVERY, SAMPLE_MASK, Histogram, exchange_timestamp, payload_size
+from crypto_data_collector.reconnect import CircuitBreaker, ReconnectScheduler, backoff_delay
+from crypto_data_collector.watchdog import StallWatchdog
+from crypto_data_collector.records import Normalizer
 
 if TYPE_CHECKING:
     from crypto_data_collector.consumer import BaseConsumer
@@ -12,14 +18,57 @@ if TYPE_CHECKING:
 logger = logging.getLogger(__name__)
 
 class ProducerPipeline:
-    def __init__(self, data_queue:asyncio.Queue) -> None:
+    """
+    Owns the producer tasks.
+
+    Producers of the same exchange share the exchange's CircuitBreaker of
+    the reconnect scheduler. With auto_restart, a producer that gives up
+    (ERRORED after max_tries) is restarted after a jittered delay doubling
+    from restart_delay up to max_restart_delay, the delay resets once the
+    producer stays up for stable_after seconds.
+
+    With watch_stalls, a StallWatchdog restarts the subscriptions of
+    producers that went silent, see watchdog.py.
+
+    Args:
+        data_queue (asyncio.Queue): Queue the producers push to
+        scheduler (ReconnectScheduler, optional): Shared reconnect scheduler, one is created by default
+        auto_restart (bool): Restart ERRORED producers
+        restart_delay (float): First restart delay in seconds
+        max_restart_delay (float): Longest restart delay
+        stable_after (float): Uptime after which the restart delay resets
+        watch_stalls (bool): Run the stall watchdog
+        watchdog (StallWatchdog, optional): Watchdog settings, a default one is created
+    """
+    def __init__(
+        self,
+        data_queue:asyncio.Queue,
+        scheduler: Optional[ReconnectScheduler] = None,
+        auto_restart: bool = True,
+        restart_delay: float = 1.0,
+        max_restart_delay: float = 60.0,
+        stable_after: float = 60.0,
+        watch_stalls: bool = True,
+        watchdog: Optional[StallWatchdog] = None
+        ) -> None:
         # Producer pipeline owns the tasks
         self.producers : Dict[str, DataProducer] = {}
         self.data_queue: asyncio.Queue = data_queue
+        self.scheduler = scheduler if scheduler is not None else ReconnectScheduler()
+        self.auto_restart = auto_restart
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self.watchdog = (watchdog if watchdog is not None else StallWatchdog()) if watch_stalls else None
+        self._watchdog_task: Optional[asyncio.Task] = None
     
     async def stop_pipeline(self) -> None:
-        for name, producer in self.producers.items():
-            self.remove_producer(name)
+        # remove_producer pops from self.producers
+        for name in list(self.producers):
+            await self.remove_producer(name)
+        if self._watchdog_task is not None:
+            self._watchdog_task.cancel()
+            self._watchdog_task = None
 
     def get_data_queue(self) -> asyncio.Queue:
         return self.data_queue
@@ -36,9 +85,58 @@ class ProducerPipeline:
             return
         
         self.producers[producer_name] = producer
-        task = asyncio.create_task(producer.start_loop(), name=producer.producer_name)
+        # Replay producers have no exchange to reconnect to
+        if producer.exchange is not None and producer.breaker is None:
+            producer.breaker = self.scheduler.breaker(producer.exchange_name)
+        task = asyncio.create_task(self._supervise(producer), name=producer.producer_name)
         producer.task = task
         logger.info("Task [%s] created", producer_name)
+        if self.watchdog is not None and self._watchdog_task is None:
+            self._watchdog_task = asyncio.create_task(self.watchdog.run(self), name="stall_watchdog")
+
+    def restart_producer(self, producer_name: str, status: Status = Status.STALLED) -> None:
+        """
+        Restart the subscription of a running producer, its task, metrics
+        and queue stay the same
+        """
+        producer = self.producers.get(producer_name)
+        if producer is None or producer.runner is None or producer.runner.done():
+            return
+        producer.state.status = status
+        producer.runner.cancel()
+
+    async def _supervise(self, producer: "DataProducer") -> None:
+        loop = asyncio.get_running_loop()
+        restarts = 0
+        while True:
+            started = loop.time()
+            # The subscription runs in its own task, restart_producer cancels only this one
+            producer.runner = asyncio.create_task(producer.start_loop(), name=f"{producer.producer_name}:run")
+            try:
+                await producer.runner
+                return
+            except asyncio.CancelledError:
+                # Producers give up with CancelledError and status ERRORED,
+                # restart_producer sets STALLED, anything else is a
+                # cancellation from outside
+                if producer.state.status is Status.STALLED:
+                    producer.stalls += 1
+                    if producer.breaker is not None:
+                        await producer.breaker.acquire()
+                    continue
+                if producer.state.status is not Status.ERRORED or not self.auto_restart:
+                    raise
+            if loop.time() - started >= self.stable_after:
+                restarts = 0
+            delay = backoff_delay(restarts, self.restart_delay, self.max_restart_delay)
+            restarts += 1
+            producer.restarts += 1
+            logger.error("Producer [%s] errored, restarting in %.1fs (restart #%d)", producer.producer_name, delay, restarts)
+            await asyncio.sleep(delay)
+            if producer.breaker is not None:
+                await producer.breaker.acquire()
+            producer.state.tries = 0
+            producer.state.timeout = producer.base_delay
     
     async def remove_producer(self, producer_name: str) -> None:
         # Do not cancel task willy nilly, use this method
@@ -59,9 +157,15 @@ class ProducerPipeline:
             producer.state.status = Status.ERRORED
         
         self.producers.pop(producer_name, None)
+        if self.watchdog is not None:
+            self.watchdog.forget(producer_name)
+        if not self.producers and self._watchdog_task is not None:
+            self._watchdog_task.cancel()
+            self._watchdog_task = None
         exch = producer.exchange
 
-        if not any(p.exchange is exch for p in self.producers.values()):
+        # Replay producers have no exchange to close
+        if exch is not None and not any(p.exchange is exch for p in self.producers.values()):
             logger.info("Closing exchange [%s]", exch.name)
             try:
                 await exch.close()
@@ -82,12 +186,14 @@ class DataProducer:
         stream_name:str,
         stream_method: Callable[..., Any],
         stream_options: Dict[str, Any],
-        data_queue: asyncio.Queue) -> None:
+        data_queue: asyncio.Queue,
+        normalizer: Optional[Normalizer] = None) -> None:
 
         # A Unique Producer name
         # These are names passed by you, not the ccxt names
         # Must be unique
-        self.producer_name = f"{exchange_name}|{symbol}|{stream_name}"
+        # Interned, every message and record shares this one string
+        self.producer_name = sys.intern(f"{exchange_name}|{symbol}|{stream_name}")
         
         # Statuses are only for information, they are not used for loop control
         self.state = State()
@@ -102,9 +208,34 @@ class DataProducer:
         self.stream_options = stream_options
 
         self.data_queue = data_queue
+        # Supervising task owned by ProducerPipeline, and the task running
+        # the subscription inside it
         self.task: Optional[asyncio.Task] = None
+        self.runner: Optional[asyncio.Task] = None
+
+        # Optional, converts raw ccxt output to compact records
+        self.normalizer = normalizer
 
         self.max_tries = 4
+        # Jittered exponential backoff between tries, see reconnect.backoff_delay
+        self.base_delay = 1.0
+        self.max_delay = 30.0
+        self.state.timeout = self.base_delay
+        # Shared by the producers of an exchange, set by ProducerPipeline
+        self.breaker: Optional[CircuitBreaker] = None
+        self.restarts = 0
+        # Receive time (ms) of the last message and subscription restarts by the watchdog
+        self.last_message = 0.0
+        self.stalls = 0
+        # Set (ms) while emit waits on a full BLOCK queue, the watchdog
+        # does not count that wait as silence
+        self.blocked_since: Optional[float] = None
+
+        # Metrics, read by MetricsCollector. Only the count is updated on
+        # every message, see sample()
+        self.messages = 0
+        self.bytes = 0
+        self.latency = Histogram()
 
     async def start_loop(self) -> None:
         self.state.status = Status.RUNNING
@@ -117,30 +248,185 @@ class DataProducer:
         while True:
             try:
                 # Blocking await
-                data = await self.stream_method(self.symbol, **self.stream_options)
+                data = await self.fetch()
             except ccxt.OperationFailed as e:
                 # Transient Error handle with exponential backoff
-                self.state.status = Status.BACKOFF
-                self.state.tries += 1
-                logger.error('OperationFailed for producer [%s] msg: %s', self.producer_name, repr(e))
-                
-                if self.state.tries >= self.max_tries:
-                    logger.critical("Max retries exceeded in producer [%s]. Cancelling ... ", self.producer_name)
-                    self.state.status = Status.ERRORED
-                    raise asyncio.CancelledError()
-                
-                logger.info("Backing off for %.1f seconds (try #%d)", self.state.timeout, self.state.tries)
-                await asyncio.sleep(self.state.timeout)
-
-                self.state.timeout *= 2
+                await self.backoff(e)
                 continue
             
-            self.state.status = Status.RUNNING
-            # Inject Metadata
+            received = time.time() * 1000
+            self.last_message = received
+            if self.state.tries:
+                self.recovered()
+            await self.publish(data, received)
+
+    async def backoff(self, error: Exception) -> None:
+        """
+        Wait out a transient error: jittered exponential backoff, then the
+        exchange's circuit breaker and resubscription stagger. Gives up with
+        status ERRORED after max_tries.
+        """
+        state = self.state
+        state.status = Status.BACKOFF
+        state.tries += 1
+        state.last_error = repr(error)
+        logger.error('OperationFailed for producer [%s] msg: %s', self.producer_name, repr(error))
+        if self.breaker is not None:
+            self.breaker.record_failure()
+
+        if state.tries >= self.max_tries:
+            logger.critical("Max retries exceeded in producer [%s]. Cancelling ... ", self.producer_name)
+            state.status = Status.ERRORED
+            raise asyncio.CancelledError()
+
+        state.timeout = backoff_delay(state.tries - 1, self.base_delay, self.max_delay)
+        logger.info("Backing off for %.1f seconds (try #%d)", state.timeout, state.tries)
+        await asyncio.sleep(state.timeout)
+        if self.breaker is not None:
+            await self.breaker.acquire()
+
+    def recovered(self) -> None:
+        """
+        First data after failed tries
+        """
+        logger.info("Producer [%s] recovered after %d tries", self.producer_name, self.state.tries)
+        self.state.status = Status.RUNNING
+        self.state.tries = 0
+        self.state.timeout = self.base_delay
+        self.state.last_error = None
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+    async def fetch(self) -> Any:
+        return await self.stream_method(self.symbol, **self.stream_options)
+
+    async def publish(self, data: Any, received: float) -> None:
+        await self.emit(self.producer_name, self.stream_name, data, received)
+
+    async def emit(self, producer_name: str, stream_name: str, data: Any, received: float) -> None:
+        """
+        Normalize, wrap and queue one message under producer_name
+        """
+        if self.normalizer is not None:
+            data = self.normalizer.normalize(stream_name, producer_name, data, received)
+
+        # Inject Metadata
+        full_data = {"data": data, "producer": producer_name, "received": received}
+
+        queue = self.data_queue
+        if queue.full():
+            # Waits when the policy for this producer is BLOCK
+            self.blocked_since = time.time() * 1000
+            try:
+                await queue.put(full_data)
+            finally:
+                self.blocked_since = None
+        else:
+            await queue.put(full_data)
+
+        self.messages += 1
+        if not self.messages & SAMPLE_MASK:
+            self.sample(data, received)
+
+    def sample(self, data: Any, received: float) -> None:
+        """
+        Runs on every SAMPLE_EVERY-th message, the byte count is extrapolated
+        """
+        self.bytes += payload_size(data) * SAMPLE_EVERY
+        timestamp = exchange_timestamp(data)
+        if timestamp is not None:
+            self.latency.record(received - timestamp)
+
+
+# Stream name -> ccxt method subscribing to many symbols over one connection
+GROUPED_METHODS = {
+    "watchTrades": "watchTradesForSymbols",
+    "watchOrderBook": "watchOrderBookForSymbols",
+    "watchTicker": "watchTickers",
+    "watchOHLCV": "watchOHLCVForSymbols",
+}
+
+
+def grouped_method_name(exchange: ccxt.pro.Exchange, stream_name: str) -> Optional[str]:
+    """
+    Name of the multi symbol variant of a stream, if the exchange supports it
+    """
+    method_name = GROUPED_METHODS.get(stream_name)
+    if method_name and exchange.has.get(method_name):
+        return method_name
+    return None
+
+
+class GroupedDataProducer(DataProducer):
+    """
+    One producer for a stream of many symbols, using the ccxt
+    watch*ForSymbols / watchTickers methods so every symbol shares one
+    subscription loop. Results are demultiplexed to the per symbol producer
+    names ("exchange|symbol|stream"), consumers see the same messages as
+    with one DataProducer per symbol.
+
+    The producer itself is named "exchange|*|stream".
+    """
+
+    def __init__(
+        self,
+        exchange_name: str,
+        exchange: ccxt.pro.Exchange,
+        symbols: List[str],
+        stream_name: str,
+        stream_method: Callable[..., Any],
+        stream_options: Dict[str, Any],
+        data_queue: asyncio.Queue,
+        normalizer: Optional[Normalizer] = None) -> None:
+        super().__init__(
+            exchange_name=exchange_name,
+            exchange=exchange,
+            symbol="*",
+            stream_name=stream_name,
+            stream_method=stream_method,
+            stream_options=stream_options,
+            data_queue=data_queue,
+            normalizer=normalizer
+        )
+        self.symbols = list(symbols)
+        self.symbol_producers: Dict[str, str] = {
+            symbol: sys.intern(f"{exchange_name}|{symbol}|{stream_name}") for symbol in self.symbols
+        }
+        self._demux = {
+            "watchTrades": self._demux_trades,
+            "watchOrderBook": self._demux_single,
+            "watchTicker": self._demux_mapping,
+            "watchOHLCV": self._demux_ohlcv,
+        }[stream_name]
+
+    async def fetch(self) -> Any:
+        if self.stream_name == "watchOHLCV":
+            options = dict(self.stream_options)
+            timeframe = options.pop("timeframe", "1m")
+            return await self.stream_method([[symbol, timeframe] for symbol in self.symbols], **options)
+        return await self.stream_method(self.symbols, **self.stream_options)
+
+    async def publish(self, data: Any, received: float) -> None:
+        for symbol, symbol_data in self._demux(data):
+            producer_name = self.symbol_producers.get(symbol)
+            if producer_name is not None:
+                await self.emit(producer_name, self.stream_name, symbol_data, received)
+
+    @staticmethod
+    def _demux_trades(data: List[Dict[str, Any]]) -> Iterable[Tuple[str, Any]]:
+        by_symbol: Dict[str, list] = {}
+        for trade in data:
+            by_symbol.setdefault(trade["symbol"], []).append(trade)
+        return by_symbol.items()
 
-            full_data = {"data": data, "producer": self.producer_name}
+    @staticmethod
+    def _demux_single(data: Dict[str, Any]) -> Iterable[Tuple[str, Any]]:
+        return ((data["symbol"], data),)
 
-            self.data_queue.put_nowait(full_data)
+    @staticmethod
+    def _demux_mapping(data: Dict[str, Any]) -> Iterable[Tuple[str, Any]]:
+        return data.items()
 
-            self.state.timeout = 1.0
-            self.state.tries = 0
\ No newline at end of file
+    @staticmethod
+    def _demux_ohlcv(data: Dict[str, Dict[str, list]]) -> Iterable[Tuple[str, Any]]:
+        return ((symbol, candles) for symbol, timeframes in data.items() for candles in timeframes.values())
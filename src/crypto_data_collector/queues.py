@@ -0,0 +1,346 @@
+import asyncio
+import logging
+
+from collections import Counter
+from enum import Enum
+from typing import Any, Callable, Dict, Hashable, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class OverflowPolicy(Enum):
+    """
+    What a bounded queue does with a new message when it is full.
+
+    BLOCK:      put() waits for a free slot (put_nowait raises QueueFull)
+    DROP_OLDEST: evict the oldest queued message to make room
+    DROP_NEWEST: discard the incoming message
+    CONFLATE:   keep at most one pending message per key, newer overwrites older
+    """
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    CONFLATE = "conflate"
+
+
+def producer_key(item: Any) -> Hashable:
+    """
+    Default key function, the producer name injected by DataProducer
+    """
+    if isinstance(item, dict):
+        return item.get("producer")
+    return None
+
+
+async def get_batch(
+    queue: asyncio.Queue,
+    max_items: int,
+    timeout: float,
+    batch: Optional[List[Any]] = None
+    ) -> List[Any]:
+    """
+    Wait for one item, then collect up to max_items items or whatever
+    arrives within timeout seconds of the first one.
+
+    Items are appended to batch as they are taken, so a caller cancelled
+    mid batch still holds every item it took off the queue.
+    """
+    if batch is None:
+        batch = []
+    if not batch:
+        batch.append(await queue.get())
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while len(batch) < max_items:
+        try:
+            batch.append(queue.get_nowait())
+            continue
+        except asyncio.QueueEmpty:
+            pass
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+class _Conflated:
+    # Placeholder held in the deque for a conflated message,
+    # the message itself lives in BoundedQueue._latest
+    __slots__ = ("key",)
+
+    def __init__(self, key: Hashable) -> None:
+        self.key = key
+
+
+class BoundedQueue(asyncio.Queue):
+    """
+    asyncio.Queue with a selectable overflow policy and drop counters.
+
+    The default policy applies to every message. Per producer or per stream
+    overrides can be set with set_policy(), they are matched against the
+    producer name ("exchange|symbol|stream") first and then the stream name.
+
+    Drop-in replacement for asyncio.Queue, put() and put_nowait() only
+    diverge from the stdlib behaviour when the queue is full.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 0,
+        policy: Union[OverflowPolicy, str] = OverflowPolicy.BLOCK,
+        key: Callable[[Any], Hashable] = producer_key,
+        ) -> None:
+        super().__init__(maxsize=maxsize)
+        self.policy: OverflowPolicy = OverflowPolicy(policy)
+        self.key = key
+        self.overrides: Dict[str, OverflowPolicy] = {}
+        # Resolved policy per producer name, filled on first message
+        self._policy_cache: Dict[Hashable, OverflowPolicy] = {}
+        self._latest: Dict[Hashable, Any] = {}
+
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.conflated = 0
+        self.dropped_by_key: Counter = Counter()
+        self.conflated_by_key: Counter = Counter()
+        self.high_water = 0
+
+    def set_policy(self, name: str, policy: Union[OverflowPolicy, str]) -> None:
+        """
+        Override the overflow policy for a producer name or a stream name
+
+        Args:
+            name (str): Producer name ("exchange|symbol|stream") or stream name ("watchTicker")
+            policy (OverflowPolicy | str): Policy to apply
+        """
+        self.overrides[name] = OverflowPolicy(policy)
+        self._policy_cache.clear()
+
+    def clear_policy(self, name: str) -> None:
+        """
+        Remove the override of a producer name or a stream name, the queue policy applies again
+        """
+        if self.overrides.pop(name, None) is not None:
+            self._policy_cache.clear()
+
+    def policy_for(self, key: Hashable) -> OverflowPolicy:
+        policy = self._policy_cache.get(key)
+        if policy is None:
+            policy = self.overrides.get(key)
+            if policy is None and isinstance(key, str):
+                policy = self.overrides.get(key.rsplit("|", 1)[-1])
+            policy = policy or self.policy
+            self._policy_cache[key] = policy
+        return policy
+
+    @property
+    def dropped(self) -> int:
+        return self.dropped_oldest + self.dropped_newest
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.qsize(),
+            "maxsize": self.maxsize,
+            "high_water": self.high_water,
+            "dropped_oldest": self.dropped_oldest,
+            "dropped_newest": self.dropped_newest,
+            "conflated": self.conflated,
+            "dropped_by_key": dict(self.dropped_by_key),
+            "conflated_by_key": dict(self.conflated_by_key),
+        }
+
+    async def put(self, item: Any) -> None:
+        if self.policy_for(self.key(item)) is OverflowPolicy.BLOCK:
+            await super().put(item)
+        else:
+            self.put_nowait(item)
+
+    def put_nowait(self, item: Any) -> None:
+        key = self.key(item)
+        policy = self.policy_for(key)
+
+        if policy is OverflowPolicy.CONFLATE and key in self._latest:
+            # Overwrite in place, the queue position of the older message is kept
+            self._latest[key] = item
+            self.conflated += 1
+            self.conflated_by_key[key] += 1
+            return
+
+        if self.full():
+            if policy is OverflowPolicy.BLOCK:
+                raise asyncio.QueueFull
+            if policy is OverflowPolicy.DROP_NEWEST:
+                self.dropped_newest += 1
+                self.dropped_by_key[key] += 1
+                return
+            # DROP_OLDEST and CONFLATE with a new key both evict the head
+            evicted = self.get_nowait()
+            self.task_done()
+            self.dropped_oldest += 1
+            self.dropped_by_key[self.key(evicted)] += 1
+
+        if policy is OverflowPolicy.CONFLATE:
+            self._latest[key] = item
+            super().put_nowait(_Conflated(key))
+        else:
+            super().put_nowait(item)
+
+        size = self.qsize()
+        if size > self.high_water:
+            self.high_water = size
+
+    def _get(self) -> Any:
+        item = self._queue.popleft()
+        if type(item) is _Conflated:
+            return self._latest.pop(item.key)
+        return item
+
+
+class BroadcastRing:
+    """
+    Single writer, multi reader ring buffer for fanning out messages.
+
+    The delegator publishes each message once, every consumer reads through
+    its own RingCursor. The writer never waits for readers: a reader that
+    falls a full lap behind skips ahead to the oldest retained message and
+    the skipped count is recorded on its cursor as lag.
+
+    Readers filter at their cursor (accept), the ring holds every message,
+    so traffic a reader does not want still moves the writer toward lapping
+    it. Size the ring for the total message rate, not the subscribed one.
+    """
+
+    def __init__(self, capacity: int = 4096) -> None:
+        if capacity <= 0:
+            raise ValueError("Ring capacity must be positive")
+        # Round up to a power of two so the slot index is a mask, not a modulo
+        self.capacity: int = 1 << (capacity - 1).bit_length()
+        self._mask: int = self.capacity - 1
+        self._buffer: list = [None] * self.capacity
+        # Sequence number of the next write, total messages published
+        self.seq: int = 0
+        self._waiters: list = []
+        self.cursors: Dict[str, "RingCursor"] = {}
+
+    def publish(self, item: Any) -> None:
+        self._buffer[self.seq & self._mask] = item
+        self.seq += 1
+        if self._waiters:
+            for waiter in self._waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self._waiters.clear()
+
+    def cursor(
+        self,
+        name: str,
+        accept: Optional[Callable[[Any], bool]] = None
+        ) -> "RingCursor":
+        """
+        Create a cursor positioned at the next message to be published
+
+        Args:
+            name (str): Unique cursor name, usually the consumer name
+            accept (Callable, optional): Messages for which this returns False are skipped
+        """
+        if name in self.cursors:
+            raise ValueError(f"Cursor [{name}] already exists")
+        cursor = RingCursor(self, name, accept)
+        self.cursors[name] = cursor
+        return cursor
+
+    def remove_cursor(self, name: str) -> None:
+        self.cursors.pop(name, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "published": self.seq,
+            "cursors": {name: c.stats() for name, c in self.cursors.items()},
+        }
+
+    async def _wait(self) -> None:
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+
+class RingCursor:
+    """
+    A reader position in a BroadcastRing.
+
+    Exposes the consuming half of the asyncio.Queue interface (get,
+    get_nowait, task_done, qsize, empty) so consumer run loops work
+    unchanged whether they are fed by a queue or a ring. on_lag, when set,
+    is called with the skipped count each time the writer laps the cursor.
+    """
+
+    def __init__(
+        self,
+        ring: BroadcastRing,
+        name: str,
+        accept: Optional[Callable[[Any], bool]] = None
+        ) -> None:
+        self.ring = ring
+        self.name = name
+        self.accept = accept
+        self.seq: int = ring.seq
+        self.lagged: int = 0
+        self.lag_events: int = 0
+        self.on_lag: Optional[Callable[[int], None]] = None
+
+    def qsize(self) -> int:
+        return min(self.ring.seq - self.seq, self.ring.capacity)
+
+    def empty(self) -> bool:
+        return self.seq >= self.ring.seq
+
+    def get_nowait(self) -> Any:
+        ring = self.ring
+        accept = self.accept
+        while True:
+            if self.seq >= ring.seq:
+                raise asyncio.QueueEmpty
+            behind = ring.seq - self.seq
+            if behind > ring.capacity:
+                skipped = behind - ring.capacity
+                self.lagged += skipped
+                self.lag_events += 1
+                self.seq += skipped
+                logger.warning("Cursor [%s] lapped by ring writer, skipped %d messages", self.name, skipped)
+                if self.on_lag is not None:
+                    self.on_lag(skipped)
+            item = ring._buffer[self.seq & ring._mask]
+            self.seq += 1
+            if accept is None or accept(item):
+                return item
+
+    async def get(self) -> Any:
+        while True:
+            while self.seq >= self.ring.seq:
+                await self.ring._wait()
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                # Everything published since the last read was filtered out
+                continue
+
+    def task_done(self) -> None:
+        # Nothing to acknowledge, the slot is reclaimed when the writer laps it
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.qsize(),
+            "lagged": self.lagged,
+            "lag_events": self.lag_events,
+        }
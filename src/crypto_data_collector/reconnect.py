@@ -0,0 +1,178 @@
+"""
+Reconnect scheduling shared by the producers of an exchange.
+
+When an exchange drops, all of its producers fail within moments of each
+other. Backing off independently with the same delays, they all hit the
+exchange again at the same moment. The producers of an exchange share a
+CircuitBreaker instead:
+
+  - Every producer backs off with jittered exponential delays (backoff_delay),
+    the jitter spreads out producers that failed together.
+  - After failure_threshold failures without a recovery in between the
+    breaker opens, no producer of the exchange retries until the cool down
+    is over. The cool down is jittered too and grows on every trip in a
+    row, up to max_open_s.
+  - Once the cool down is over the breaker is half open. Retries are handed
+    out stagger_s apart, so subscriptions come back one after the other,
+    and the first failure opens the breaker again.
+  - The first producer that receives data again closes the breaker.
+
+ReconnectScheduler holds one breaker per exchange name, ProducerPipeline
+attaches them to the producers it runs.
+"""
+import random
+import asyncio
+import logging
+
+from enum import Enum
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delay(attempt: int, base: float, cap: float, rng: Any = random) -> float:
+    """
+    Jittered exponential backoff, uniform in the upper half of
+    min(cap, base * 2 ** attempt)
+
+    Args:
+        attempt (int): Failed attempts before this one, 0 for the first retry
+        base (float): Delay of the first retry
+        cap (float): Largest delay
+    """
+    ceiling = min(cap, base * 2 ** min(attempt, 32))
+    return ceiling / 2 + rng.uniform(0, ceiling / 2)
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker and resubscription stagger of one exchange, see the
+    module docstring
+
+    Args:
+        name (str): Exchange name, for logs
+        failure_threshold (int): Failures without a recovery that open the breaker
+        open_s (float): Cool down of the first trip
+        max_open_s (float): Longest cool down
+        stagger_s (float): Spacing of retries
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        open_s: float = 5.0,
+        max_open_s: float = 120.0,
+        stagger_s: float = 0.25
+        ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.open_s = open_s
+        self.max_open_s = max_open_s
+        self.stagger_s = stagger_s
+
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        # Trips in a row without a recovery, drives the cool down
+        self.trips = 0
+        self.total_trips = 0
+        self.open_until = 0.0
+        self._next_slot = 0.0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state is BreakerState.HALF_OPEN or (
+            self.state is BreakerState.CLOSED and self.failures >= self.failure_threshold
+        ):
+            self.trip()
+
+    def record_success(self) -> None:
+        if self.state is not BreakerState.CLOSED:
+            logger.info("Circuit breaker of exchange [%s] closed", self.name)
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.trips = 0
+
+    def trip(self) -> None:
+        cool_down = backoff_delay(self.trips, self.open_s, self.max_open_s)
+        self.open_until = asyncio.get_running_loop().time() + cool_down
+        self.state = BreakerState.OPEN
+        self.trips += 1
+        self.total_trips += 1
+        self.failures = 0
+        logger.warning(
+            "Circuit breaker of exchange [%s] open for %.1fs (trip #%d)", self.name, cool_down, self.trips
+        )
+
+    async def acquire(self) -> None:
+        """
+        Wait until this producer may retry: the breaker is not open and
+        the producer's stagger slot came up
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.state is BreakerState.OPEN:
+                if now < self.open_until:
+                    await asyncio.sleep(self.open_until - now)
+                    continue
+                self.state = BreakerState.HALF_OPEN
+                logger.info("Circuit breaker of exchange [%s] half open", self.name)
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.stagger_s
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # The breaker may have opened again while waiting for the slot
+            if self.state is not BreakerState.OPEN:
+                return
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state.value, "failures": self.failures, "trips": self.total_trips}
+
+
+class ReconnectScheduler:
+    """
+    One CircuitBreaker per exchange name, created on first use with the
+    given settings
+
+    Args:
+        failure_threshold (int): See CircuitBreaker
+        open_s (float): See CircuitBreaker
+        max_open_s (float): See CircuitBreaker
+        stagger_s (float): See CircuitBreaker
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        open_s: float = 5.0,
+        max_open_s: float = 120.0,
+        stagger_s: float = 0.25
+        ) -> None:
+        self.failure_threshold = failure_threshold
+        self.open_s = open_s
+        self.max_open_s = max_open_s
+        self.stagger_s = stagger_s
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, exchange_name: str) -> CircuitBreaker:
+        breaker = self.breakers.get(exchange_name)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                exchange_name,
+                failure_threshold=self.failure_threshold,
+                open_s=self.open_s,
+                max_open_s=self.max_open_s,
+                stagger_s=self.stagger_s
+            )
+            self.breakers[exchange_name] = breaker
+        return breaker
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: breaker.stats() for name, breaker in self.breakers.items()}
@@ -0,0 +1,303 @@
+"""
+Raw message recorder.
+
+RecorderConsumer appends every message it receives, with its producer name
+and receive time, to a segmented append-only log:
+
+    <root>/<start ms>-<n>.log    segment, header then blocks
+    <root>/<start ms>-<n>.idx    sparse time index of the segment
+
+Segment header: MAGIC, codec byte (0 none, 1 zstd), serializer byte (0 json, 1 msgpack)
+Block:          BLOCK header (payload length, frame count, first received, last received) + payload
+Payload:        frames, each a uint32 length + serialized [producer, received, data],
+                the whole payload compressed with the segment codec
+
+Records (records.py) are serialized with their type (records.tagged_default)
+and read back as the same record classes, raw ccxt data as plain values.
+
+One block is written per consumer batch, so compression works on many
+messages at once. After every block the index gets one (running max
+received, block offset) entry, readers binary search it to seek to a time
+without scanning the segment.
+
+msgpack and zstd are optional (poetry install -E recorder), json and no
+compression are used without them.
+"""
+import os
+import json
+import time
+import struct
+import asyncio
+import logging
+
+from bisect import bisect_left
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+from crypto_data_collector.consumer import BatchConsumer
+from crypto_data_collector.records import from_tagged, tagged_default
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CDCLOG1\n"
+SEGMENT_HEADER = struct.Struct("<8sBB")
+BLOCK = struct.Struct("<IIdd")
+FRAME = struct.Struct("<I")
+INDEX_ENTRY = struct.Struct("<dQ")
+
+CODECS = {None: 0, "zstd": 1}
+SERIALIZERS = {"json": 0, "msgpack": 1}
+
+
+def _dumps(serializer: int, value: Any) -> bytes:
+    if serializer == 1:
+        return msgpack.packb(value, default=tagged_default, use_bin_type=True)
+    return json.dumps(value, default=tagged_default, separators=(",", ":")).encode()
+
+
+def _loads(serializer: int, payload: bytes) -> Any:
+    if serializer == 1:
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(bytes(payload))
+
+
+def read_index(path: Union[str, Path]) -> List[Tuple[float, int]]:
+    """
+    (running max received, block offset) entries of a segment index,
+    a missing or truncated index reads as the entries written so far
+    """
+    try:
+        raw = Path(path).read_bytes()
+    except FileNotFoundError:
+        return []
+    usable = len(raw) - len(raw) % INDEX_ENTRY.size
+    return list(INDEX_ENTRY.iter_unpack(raw[:usable]))
+
+
+def read_segment(path: Union[str, Path], start: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate the messages of one segment in recorded order, from the first
+    message received at or after start (ms). A truncated last block, e.g.
+    after a crash, ends the segment.
+    """
+    path = Path(path)
+    offset = None
+    if start is not None:
+        index = read_index(path.with_suffix(".idx"))
+        if index:
+            position = bisect_left([high for high, _ in index], start)
+            if position == len(index):
+                return
+            offset = index[position][1]
+
+    with open(path, "rb") as f:
+        magic, codec, serializer = SEGMENT_HEADER.unpack(f.read(SEGMENT_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"Not a recorder segment: [{path}]")
+        if codec == 1 and zstandard is None:
+            raise ImportError("Segment is zstd compressed, install zstandard to read it")
+        if serializer == 1 and msgpack is None:
+            raise ImportError("Segment is msgpack serialized, install msgpack to read it")
+        decompressor = zstandard.ZstdDecompressor() if codec == 1 else None
+        if offset is not None:
+            f.seek(offset)
+
+        while True:
+            header = f.read(BLOCK.size)
+            if not header:
+                return
+            if len(header) < BLOCK.size:
+                logger.warning("Truncated block header at the end of segment [%s]", path)
+                return
+            length, count, _, last = BLOCK.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                logger.warning("Truncated block at the end of segment [%s]", path)
+                return
+            if start is not None and last < start:
+                continue
+            if decompressor is not None:
+                payload = decompressor.decompress(payload)
+            view = memoryview(payload)
+            position = 0
+            for _ in range(count):
+                (size,) = FRAME.unpack_from(view, position)
+                position += FRAME.size
+                producer, received, data = _loads(serializer, view[position:position + size])
+                position += size
+                if start is not None and received < start:
+                    continue
+                yield {"data": from_tagged(data), "producer": producer, "received": received}
+
+
+def segment_paths(root_dir: Union[str, Path]) -> List[Path]:
+    """
+    Segments of a recording directory in recorded order
+    """
+    return sorted(Path(root_dir).glob("*.log"), key=lambda p: tuple(int(x) for x in p.stem.split("-")))
+
+
+def read_log(root_dir: Union[str, Path], start: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate every segment of a recording directory, seeking to start (ms)
+    """
+    paths = segment_paths(root_dir)
+    if start is not None:
+        # Segments are named after their first message, skip to the last one starting before start
+        firsts = [int(p.stem.split("-")[0]) for p in paths]
+        first = max(bisect_left(firsts, start) - 1, 0)
+        paths = paths[first:]
+    for path in paths:
+        yield from read_segment(path, start)
+
+
+class RecorderConsumer(BatchConsumer):
+    """
+    Records every message to a segmented append-only log, see the module
+    docstring for the format. Serialization, compression and file writes
+    run in a worker thread, one block per batch.
+
+    A new segment is started on every run, and whenever the current one
+    reaches max_segment_bytes or has been open for max_segment_age_s.
+
+    Args:
+        root_dir (str | Path): Directory of the recording
+        serializer (str): "msgpack" or "json", defaults to msgpack when installed
+        compression (str, optional): "zstd" or None, defaults to zstd when installed
+        compression_level (int): zstd level
+        max_segment_bytes (int): Roll the segment at this size
+        max_segment_age_s (float): Roll the segment after this long
+        fsync (bool): fsync the segment and index after every block
+    """
+
+    def __init__(
+        self,
+        root_dir: Union[str, Path],
+        name: Optional[str] = None,
+        serializer: Optional[str] = None,
+        compression: Optional[str] = "default",
+        compression_level: int = 3,
+        max_segment_bytes: int = 256 * 1024 * 1024,
+        max_segment_age_s: float = 3600.0,
+        fsync: bool = False,
+        **kwargs: Any
+        ):
+        if serializer is None:
+            serializer = "msgpack" if msgpack is not None else "json"
+        if compression == "default":
+            compression = "zstd" if zstandard is not None else None
+        if serializer not in SERIALIZERS:
+            raise ValueError(f"Unsupported serializer: {serializer}")
+        if compression not in CODECS:
+            raise ValueError(f"Unsupported compression: {compression}")
+        if serializer == "msgpack" and msgpack is None:
+            raise ImportError("msgpack serialization requires msgpack, install with: poetry install -E recorder")
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("zstd compression requires zstandard, install with: poetry install -E recorder")
+        super().__init__(name, **kwargs)
+        self.root_dir = Path(root_dir)
+        self.serializer = SERIALIZERS[serializer]
+        self.codec = CODECS[compression]
+        self.compression_level = compression_level
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age_s = max_segment_age_s
+        self.fsync = fsync
+
+        self.segments_written = 0
+        self.messages_written = 0
+        self.bytes_written = 0
+        # Open segment, only touched from the writer thread
+        self.segment_path: Optional[Path] = None
+        self._segment: Optional[BinaryIO] = None
+        self._index: Optional[BinaryIO] = None
+        self._segment_bytes = 0
+        self._opened_at = 0.0
+        self._high = float("-inf")
+        self._compressor = zstandard.ZstdCompressor(level=compression_level) if self.codec == 1 else None
+
+    async def run(self) -> None:
+        try:
+            await super().run()
+        finally:
+            await self.close()
+
+    async def run_batch(self, batch: List[Dict[str, Any]]) -> None:
+        await asyncio.to_thread(self._write_block, batch)
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._close_segment)
+        logger.info("Consumer [%s] recording closed, %d messages written", self.name, self.messages_written)
+
+    # Writer thread
+    # -------------------------------------------------------------------------
+    def _write_block(self, batch: List[Dict[str, Any]]) -> None:
+        if not batch:
+            return
+        serializer = self.serializer
+        frames = bytearray()
+        first = last = batch[0].get("received", 0.0)
+        for message in batch:
+            received = message.get("received", 0.0)
+            if received > last:
+                last = received
+            frame = _dumps(serializer, (message["producer"], received, message["data"]))
+            frames += FRAME.pack(len(frame))
+            frames += frame
+        payload = self._compressor.compress(bytes(frames)) if self._compressor is not None else bytes(frames)
+
+        if self._segment is not None and (
+            self._segment_bytes >= self.max_segment_bytes or time.time() - self._opened_at >= self.max_segment_age_s
+        ):
+            self._close_segment()
+        if self._segment is None:
+            self._open_segment(first)
+
+        offset = self._segment_bytes
+        self._segment.write(BLOCK.pack(len(payload), len(batch), first, last))
+        self._segment.write(payload)
+        self._segment.flush()
+        self._high = max(self._high, last)
+        self._index.write(INDEX_ENTRY.pack(self._high, offset))
+        self._index.flush()
+        if self.fsync:
+            os.fsync(self._segment.fileno())
+            os.fsync(self._index.fileno())
+        written = BLOCK.size + len(payload)
+        self._segment_bytes += written
+        self.bytes_written += written
+        self.messages_written += len(batch)
+
+    def _open_segment(self, first: float) -> None:
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        n = 0
+        while (self.root_dir / f"{int(first)}-{n}.log").exists():
+            n += 1
+        self.segment_path = self.root_dir / f"{int(first)}-{n}.log"
+        self._segment = open(self.segment_path, "xb")
+        self._index = open(self.segment_path.with_suffix(".idx"), "wb")
+        self._segment.write(SEGMENT_HEADER.pack(MAGIC, self.codec, self.serializer))
+        self._segment_bytes = SEGMENT_HEADER.size
+        self._opened_at = time.time()
+        self._high = float("-inf")
+        self.segments_written += 1
+        logger.info("Consumer [%s] opened segment [%s]", self.name, self.segment_path)
+
+    def _close_segment(self) -> None:
+        if self._segment is None:
+            return
+        self._segment.close()
+        self._index.close()
+        logger.info("Consumer [%s] closed segment [%s], %d bytes", self.name, self.segment_path, self._segment_bytes)
+        self._segment = None
+        self._index = None
+        self.segment_path = None
@@ -0,0 +1,331 @@
+"""
+Compact typed records for normalized ccxt stream data.
+
+ccxt returns large dicts per trade / ticker / candle / order book, most of
+which are redundant copies of the raw exchange payload (info, fee, fees,
+datetime strings). The Normalizer converts them to __slots__ records that
+only keep the fields needed downstream.
+
+Timestamps on every record are milliseconds:
+    timestamp: exchange timestamp, as reported by ccxt (may be None)
+    received:  local wall clock time the message was received
+"""
+import logging
+import importlib
+
+from array import array
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+logger = logging.getLogger(__name__)
+
+# Key holding the record type in serialized records, see tagged_default()
+RECORD_TAG = "__record__"
+
+
+# RECORD_TAG value ("module:Class") -> record class, every Record subclass
+# registers itself when defined, see record_type()
+RECORD_TYPES: Dict[str, Type["Record"]] = {}
+# Modules of the records shipped with the package, imported before a tag is rejected
+RECORD_MODULES = (
+    "crypto_data_collector.bars",
+    "crypto_data_collector.dedupe",
+    "crypto_data_collector.orderbook",
+)
+
+
+class Record:
+    __slots__ = ()
+    # Fields holding packed array('d') values, rebuilt as arrays by from_tagged()
+    array_fields: Tuple[str, ...] = ()
+
+    def __init_subclass__(cls, **kwargs: Any) -> None:
+        super().__init_subclass__(**kwargs)
+        RECORD_TYPES[f"{cls.__module__}:{cls.__qualname__}"] = cls
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other: object) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, n) == getattr(other, n) for n in self.__slots__)
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{n}={getattr(self, n)!r}" for n in self.__slots__ if n != "info")
+        return f"{self.__class__.__name__}({fields})"
+
+
+class TradeRecord(Record):
+    __slots__ = ("producer", "id", "timestamp", "received", "price", "amount", "side", "taker_or_maker", "info")
+
+    def __init__(
+        self,
+        producer: str,
+        id: Optional[str],
+        timestamp: Optional[int],
+        received: float,
+        price: float,
+        amount: float,
+        side: Optional[str],
+        taker_or_maker: Optional[str] = None,
+        info: Optional[Dict[str, Any]] = None
+        ) -> None:
+        self.producer = producer
+        self.id = id
+        self.timestamp = timestamp
+        self.received = received
+        self.price = price
+        self.amount = amount
+        self.side = side
+        self.taker_or_maker = taker_or_maker
+        self.info = info
+
+
+class TickerRecord(Record):
+    __slots__ = (
+        "producer", "timestamp", "received", "bid", "ask", "last",
+        "bid_volume", "ask_volume", "base_volume", "quote_volume", "info",
+    )
+
+    def __init__(
+        self,
+        producer: str,
+        timestamp: Optional[int],
+        received: float,
+        bid: Optional[float],
+        ask: Optional[float],
+        last: Optional[float],
+        bid_volume: Optional[float] = None,
+        ask_volume: Optional[float] = None,
+        base_volume: Optional[float] = None,
+        quote_volume: Optional[float] = None,
+        info: Optional[Dict[str, Any]] = None
+        ) -> None:
+        self.producer = producer
+        self.timestamp = timestamp
+        self.received = received
+        self.bid = bid
+        self.ask = ask
+        self.last = last
+        self.bid_volume = bid_volume
+        self.ask_volume = ask_volume
+        self.base_volume = base_volume
+        self.quote_volume = quote_volume
+        self.info = info
+
+
+class OHLCVRecord(Record):
+    # timestamp is the candle open time
+    __slots__ = ("producer", "timestamp", "received", "open", "high", "low", "close", "volume")
+
+    def __init__(
+        self,
+        producer: str,
+        timestamp: int,
+        received: float,
+        open: float,
+        high: float,
+        low: float,
+        close: float,
+        volume: float
+        ) -> None:
+        self.producer = producer
+        self.timestamp = timestamp
+        self.received = received
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+
+
+class OrderBookRecord(Record):
+    """
+    Order book snapshot with levels packed into flat float arrays:
+    bids / asks = array('d', [price0, size0, price1, size1, ...]), best level first
+    """
+    __slots__ = ("producer", "timestamp", "received", "nonce", "bids", "asks")
+    array_fields = ("bids", "asks")
+
+    def __init__(
+        self,
+        producer: str,
+        timestamp: Optional[int],
+        received: float,
+        nonce: Optional[int],
+        bids: array,
+        asks: array
+        ) -> None:
+        self.producer = producer
+        self.timestamp = timestamp
+        self.received = received
+        self.nonce = nonce
+        self.bids = bids
+        self.asks = asks
+
+    def levels(self, side: str) -> List[tuple]:
+        """
+        Levels of one side ("bids" / "asks") as (price, size) tuples
+        """
+        flat = getattr(self, side)
+        return list(zip(flat[0::2], flat[1::2]))
+
+
+def pack_levels(levels: List[List[float]], depth: Optional[int] = None) -> array:
+    """
+    Flatten ccxt [[price, amount, ...], ...] levels into array('d', [price, amount, ...])
+    """
+    if depth is not None:
+        levels = levels[:depth]
+    return array("d", [x for level in levels for x in level[:2]])
+
+
+class Normalizer:
+    """
+    Converts raw ccxt stream output into compact records.
+
+    Streams without a known record type are passed through unchanged.
+
+    Args:
+        keep_info (bool): Keep the raw exchange payload (ccxt "info") on trades and tickers
+        depth (int, optional): Max order book levels kept per side
+    """
+
+    def __init__(self, keep_info: bool = False, depth: Optional[int] = None) -> None:
+        self.keep_info = keep_info
+        self.depth = depth
+        self._handlers: Dict[str, Callable[[str, Any, float], Any]] = {
+            "watchTrades": self.trades,
+            "watchTicker": self.ticker,
+            "watchOHLCV": self.ohlcv,
+            "watchOrderBook": self.order_book,
+        }
+
+    def normalize(self, stream_name: str, producer: str, data: Any, received: float) -> Any:
+        handler = self._handlers.get(stream_name)
+        if handler is None or is_normalized(data):
+            # Records, e.g. replayed from a recording of a normalized stream, pass through
+            return data
+        return handler(producer, data, received)
+
+    def trades(self, producer: str, data: List[Dict[str, Any]], received: float) -> List[TradeRecord]:
+        keep_info = self.keep_info
+        return [
+            TradeRecord(
+                producer,
+                t.get("id"),
+                t.get("timestamp"),
+                received,
+                t.get("price"),
+                t.get("amount"),
+                t.get("side"),
+                t.get("takerOrMaker"),
+                t.get("info") if keep_info else None,
+            )
+            for t in data
+        ]
+
+    def ticker(self, producer: str, data: Dict[str, Any], received: float) -> TickerRecord:
+        return TickerRecord(
+            producer,
+            data.get("timestamp"),
+            received,
+            data.get("bid"),
+            data.get("ask"),
+            data.get("last"),
+            data.get("bidVolume"),
+            data.get("askVolume"),
+            data.get("baseVolume"),
+            data.get("quoteVolume"),
+            data.get("info") if self.keep_info else None,
+        )
+
+    def ohlcv(self, producer: str, data: List[List[float]], received: float) -> List[OHLCVRecord]:
+        return [OHLCVRecord(producer, c[0], received, c[1], c[2], c[3], c[4], c[5]) for c in data]
+
+    def order_book(self, producer: str, data: Dict[str, Any], received: float) -> OrderBookRecord:
+        return OrderBookRecord(
+            producer,
+            data.get("timestamp"),
+            received,
+            data.get("nonce"),
+            pack_levels(data.get("bids", []), self.depth),
+            pack_levels(data.get("asks", []), self.depth),
+        )
+
+
+def json_default(obj: Any) -> Any:
+    """
+    default= hook for json / orjson dumps, serializes records and packed arrays
+    """
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    if isinstance(obj, array):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def is_normalized(data: Any) -> bool:
+    """
+    Whether data is a record or a list of records
+    """
+    if isinstance(data, Record):
+        return True
+    return type(data) is list and bool(data) and isinstance(data[0], Record)
+
+
+def tagged_default(obj: Any) -> Any:
+    """
+    default= hook like json_default, records also carry their type under
+    RECORD_TAG ("module:Class", their RECORD_TYPES key) so from_tagged() can rebuild them. Used
+    where serialized messages are read back into the pipeline, consumers
+    then see the same records as from a live feed.
+    """
+    if isinstance(obj, Record):
+        value = obj.to_dict()
+        value[RECORD_TAG] = f"{type(obj).__module__}:{type(obj).__qualname__}"
+        return value
+    return json_default(obj)
+
+
+_unknown_tags: set = set()
+
+
+def record_type(tag: str) -> Optional[Type[Record]]:
+    """
+    Record class of a RECORD_TAG value from the RECORD_TYPES registry.
+    Tags are never imported: only the package's RECORD_MODULES are loaded
+    to register their records, records of other modules resolve once their
+    module is imported. Unknown tags resolve to None.
+    """
+    cls = RECORD_TYPES.get(tag)
+    if cls is None:
+        for module_name in RECORD_MODULES:
+            importlib.import_module(module_name)
+        cls = RECORD_TYPES.get(tag)
+    if cls is None and tag not in _unknown_tags:
+        _unknown_tags.add(tag)
+        logger.warning("Unknown record type [%s], kept as a dict", tag)
+    return cls
+
+
+def from_tagged(value: Any) -> Any:
+    """
+    Rebuild the records of a value decoded from tagged_default output,
+    anything else is returned unchanged
+    """
+    if type(value) is dict:
+        tag = value.get(RECORD_TAG)
+        if tag is None:
+            return value
+        cls = record_type(tag)
+        if cls is None:
+            return value
+        fields = {name: value.get(name) for name in cls.__slots__}
+        for name in cls.array_fields:
+            if fields[name] is not None:
+                fields[name] = array("d", fields[name])
+        return cls(**fields)
+    if type(value) is list and value and type(value[0]) is dict and RECORD_TAG in value[0]:
+        return [from_tagged(item) for item in value]
+    return value
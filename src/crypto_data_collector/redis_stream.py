@@ -0,0 +1,225 @@
+"""
+Redis Streams consumer.
+
+Appends every message to a per producer Redis Stream with XADD, trimmed
+with MAXLEN, using non transactional pipelines so a whole batch is one
+round trip. Requires the optional redis dependency (poetry install -E redis).
+
+A message that cannot be written, e.g. it fails to serialize or Redis
+rejects its XADD, is logged, counted in failed and dropped, the consumer
+keeps running.
+"""
+import json
+import time
+import asyncio
+import logging
+
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from crypto_data_collector.consumer import BatchConsumer
+from crypto_data_collector.records import json_default
+
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+except ImportError:
+    aioredis = None
+    RedisConnectionError = RedisTimeoutError = ConnectionError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Errors after which the batch is kept and the write retried once the connection is back
+RETRYABLE = (RedisConnectionError, RedisTimeoutError, ConnectionError, TimeoutError, OSError)
+
+
+def dumps(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=json_default)
+    return json.dumps(data, default=json_default, separators=(",", ":")).encode()
+
+
+class RedisStreamConsumer(BatchConsumer):
+    """
+    Writes each producer's messages to the Redis Stream "<key_prefix><producer name>".
+
+    Each entry has the fields producer, received and data (JSON encoded).
+    Streams are trimmed to about maxlen entries (MAXLEN ~) on every XADD.
+
+    If Redis is unreachable, messages are kept in a bounded buffer
+    (max_buffer, oldest dropped first) and written once the connection
+    recovers. The connection pool of the redis client reconnects by itself,
+    this consumer only waits reconnect_delay (doubling up to
+    max_reconnect_delay) between attempts. Batches arriving in between are
+    buffered without waiting, the consumer keeps draining its queue and the
+    bounded buffer sheds the load. Any other error drops the messages it
+    concerns (counted in failed) instead of retrying them.
+
+    Args:
+        url (str): Redis URL, ignored when a client is passed
+        client (optional): A redis.asyncio.Redis compatible client, e.g. for tests
+        key_prefix (str): Prefix of the stream keys
+        maxlen (int): Approximate max entries kept per stream, None disables trimming
+        pipeline_size (int): Max XADD commands sent per pipeline round trip
+        max_buffer (int): Max messages held while Redis is unreachable
+        max_connections (int): Connection pool size
+    """
+
+    def __init__(
+        self,
+        url: str = "redis://localhost:6379/0",
+        name: Optional[str] = None,
+        client: Any = None,
+        key_prefix: str = "ccxt:",
+        maxlen: Optional[int] = 100_000,
+        pipeline_size: int = 1000,
+        max_buffer: int = 1_000_000,
+        max_connections: int = 8,
+        reconnect_delay: float = 0.5,
+        max_reconnect_delay: float = 30.0,
+        **kwargs: Any
+        ):
+        if client is None and aioredis is None:
+            raise ImportError("RedisStreamConsumer requires redis, install with: poetry install -E redis")
+        super().__init__(name, **kwargs)
+        self.client = client or aioredis.Redis(
+            connection_pool=aioredis.ConnectionPool.from_url(url, max_connections=max_connections)
+        )
+        self.key_prefix = key_prefix
+        self.maxlen = maxlen
+        self.pipeline_size = pipeline_size
+        self.max_buffer = max_buffer
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self.buffer: Deque[Dict[str, Any]] = deque()
+        self.written: int = 0
+        self.dropped: int = 0
+        self.failed: int = 0
+        self.connected: bool = True
+        self._delay = reconnect_delay
+        # time.monotonic() before which no write is attempted after a connection error
+        self._retry_at: float = 0.0
+        self._keys: Dict[str, str] = {}
+
+    async def run(self) -> None:
+        try:
+            await super().run()
+        finally:
+            await self.close()
+
+    async def run_batch(self, batch: List[Dict[str, Any]]) -> None:
+        overflow = len(self.buffer) + len(batch) - self.max_buffer
+        if overflow > 0:
+            for _ in range(min(overflow, len(self.buffer))):
+                self.buffer.popleft()
+            self.dropped += overflow
+            logger.warning("Consumer [%s] buffer full, dropped %d oldest messages", self.name, overflow)
+        self.buffer.extend(batch[-self.max_buffer:])
+        await self._drain()
+
+    async def get_batch(self) -> List[Any]:
+        # While messages are buffered, wake up for the next retry even if none arrive
+        while True:
+            timeout = max(self._retry_at - time.monotonic(), 0.0) if self.buffer else None
+            try:
+                return await asyncio.wait_for(super().get_batch(), timeout)
+            except asyncio.TimeoutError:
+                await self._drain()
+
+    async def _drain(self) -> None:
+        """
+        Write the buffer unless a retry is not due yet. Never waits on a
+        backoff, batches arriving meanwhile are only buffered.
+        """
+        if time.monotonic() < self._retry_at:
+            return
+        while self.buffer:
+            if not await self.flush():
+                # Redis unreachable, keep buffering until the next retry
+                self._retry_at = time.monotonic() + self._delay
+                self._delay = min(self._delay * 2, self.max_reconnect_delay)
+                return
+
+    async def flush(self) -> bool:
+        """
+        Write up to pipeline_size buffered messages in one pipeline.
+
+        Returns:
+            bool: False if the write failed with a connection error, the messages stay buffered
+        """
+        buffer = self.buffer
+        count = min(len(buffer), self.pipeline_size)
+        pipe = self.client.pipeline(transaction=False)
+        keys = self._keys
+        producers = []
+        for i in range(count):
+            message = buffer[i]
+            producer = message["producer"]
+            try:
+                data = dumps(message["data"])
+            except Exception as e:
+                self._fail(producer, e)
+                continue
+            key = keys.get(producer)
+            if key is None:
+                key = keys[producer] = f"{self.key_prefix}{producer}"
+            pipe.xadd(
+                key,
+                {"producer": producer, "received": message.get("received", 0.0), "data": data},
+                maxlen=self.maxlen,
+                approximate=True,
+            )
+            producers.append(producer)
+        try:
+            # Per command errors are returned instead of raised, the other
+            # commands of the pipeline were written
+            results = await pipe.execute(raise_on_error=False) if producers else []
+        except RETRYABLE as e:
+            if self.connected:
+                logger.error("Consumer [%s] lost connection to redis: %s", self.name, repr(e))
+            self.connected = False
+            return False
+        except Exception as e:
+            # Not a connection problem, retrying would fail the same way
+            for producer in producers:
+                self._fail(producer, e)
+            results = ()
+        else:
+            for producer, result in zip(producers, results):
+                if isinstance(result, Exception):
+                    self._fail(producer, result)
+        failed = sum(isinstance(result, Exception) for result in results)
+
+        if not self.connected:
+            logger.info("Consumer [%s] reconnected to redis, %d messages buffered", self.name, len(self.buffer))
+            self.connected = True
+            self._delay = self.reconnect_delay
+            self._retry_at = 0.0
+        for _ in range(count):
+            buffer.popleft()
+        self.written += len(results) - failed
+        return True
+
+    def _fail(self, producer: str, error: BaseException) -> None:
+        self.failed += 1
+        logger.error("Consumer [%s] dropped a message of [%s] it could not write: %s", self.name, producer, repr(error))
+
+    async def close(self) -> None:
+        """
+        Last attempt to write buffered messages, then release the connection pool
+        """
+        if self.buffer:
+            while self.buffer and await self.flush():
+                pass
+            if self.buffer:
+                logger.error("Consumer [%s] closing with %d unwritten messages", self.name, len(self.buffer))
+        try:
+            await self.client.aclose()
+        except Exception:
+            logger.exception("Error closing redis client for consumer [%s]", self.name)
@@ -1,11 +1,18 @@
 import ccxt.pro
+import asyncio
 import logging
 
 from pprint import pformat
-from typing import Callable, Optional, Dict, Any
+from typing import Callable, Optional, Dict, Any, List, TYPE_CHECKING
 
 from crypto_data_collector.exceptions import UnregisteredExchange, UnregisteredStream, UnregisteredSymbol
-from crypto_data_collector.producer import DataProducer
+from crypto_data_collector.helpers import producer_name_parser
+from crypto_data_collector.market_cache import MarketCache
+from crypto_data_collector.producer import DataProducer, GroupedDataProducer, grouped_method_name
+from crypto_data_collector.runtime import use_fast_json
+
+if TYPE_CHECKING:
+    from crypto_data_collector.records import Normalizer
 
 logger = logging.getLogger(__name__)
 
@@ -19,10 +26,29 @@ class Registry:
     Registered streams do not need to be running or even created,
     this is simply a helper class to hold config data for verifying 
     valid producer data and creating producer instances
+
+    Registered streams are also indexed flat by producer key
+    "exchange|symbol|stream" (streams), and by exchange and by stream name
+    (exchange_streams, stream_types), lookups by key and bulk queries by
+    exchange or stream do not walk the nested dict
+
+    With fast_json (default) registered exchanges decode JSON with orjson
+    when it is installed, see runtime.use_fast_json
+
+    With a market_cache, exchanges load their markets from the cache when
+    it holds a fresh entry instead of calling load_markets() over the
+    network, and store them after a network load
     """
 
-    def __init__(self) -> None:
+    def __init__(self, fast_json: bool = True, market_cache: Optional[MarketCache] = None) -> None:
         self.registered = {"exchanges":{}}
+        # Producer key -> stream entry, the same dicts as in self.registered
+        self.streams: Dict[str, Dict[str, Any]] = {}
+        # Exchange name / stream name -> producer keys, dicts as ordered sets
+        self.exchange_streams: Dict[str, Dict[str, None]] = {}
+        self.stream_types: Dict[str, Dict[str, None]] = {}
+        self.fast_json = fast_json
+        self.market_cache = market_cache
         logger.info("Registry created")
 
 # Register methods
@@ -35,6 +61,8 @@ class Registry:
         ) -> None:
         """
         Register an exchange by name, optionally with custom initialization parameters.
+        Markets come from the market cache when the registry has a fresh
+        entry for the exchange and its overrides.
 
         Args:
             exchange_name (str): The ccxt.pro exchange name (e.g., 'binance').
@@ -52,11 +80,16 @@ class Registry:
         
         logger.info("Registering exchange [%s] with overrides: %s", exchange_name, exchange_overrides)
         exchange_class = getattr(ccxt.pro, exchange_name)
+        exchange_obj = None
         try:
             exchange_obj = exchange_class(exchange_overrides)
-            await exchange_obj.load_markets()
+            if self.fast_json:
+                use_fast_json(exchange_obj)
+            await self._load_markets(exchange_name, exchange_obj, exchange_overrides)
         except Exception as e:
             logger.exception("Failed to register exchange: [%s]: %s", exchange_name, e)
+            if exchange_obj is not None:
+                await exchange_obj.close()
             raise e
 
         self.registered["exchanges"][exchange_name] = {
@@ -67,6 +100,29 @@ class Registry:
         logger.info("Exchange [%s] registered", exchange_name)
 
 
+    async def _load_markets(
+        self,
+        exchange_name: str,
+        exchange_obj: ccxt.pro.Exchange,
+        exchange_overrides: Dict[str, Any]
+        ) -> None:
+        cache = self.market_cache
+        if cache is not None:
+            cached = await asyncio.to_thread(cache.load, exchange_name, exchange_overrides)
+            if cached is not None:
+                exchange_obj.set_markets(cached["markets"], cached["currencies"])
+                return
+
+        await exchange_obj.load_markets()
+        if cache is not None:
+            try:
+                await asyncio.to_thread(
+                    cache.store, exchange_name, exchange_overrides, exchange_obj.markets, exchange_obj.currencies
+                )
+            except (OSError, TypeError, ValueError) as e:
+                logger.warning("Failed to cache markets of exchange [%s]: %s", exchange_name, e)
+
+
     async def register_symbol(
         self,
         exchange_name:str,
@@ -147,14 +203,195 @@ class Registry:
 
         stream_method = getattr(exchange_obj, stream_name)
         
-        self.registered["exchanges"][exchange_name]["symbols"][symbol]["streams"][stream_name] = {
+        entry = {
             "stream_method" : stream_method,
             "stream_options" : stream_options or {},
             "consumer_options" : consumer_options or {}
             }
+        self.registered["exchanges"][exchange_name]["symbols"][symbol]["streams"][stream_name] = entry
+        self._index_stream(exchange_name, symbol, stream_name, entry)
         logger.info("Stream: [%s] for Symbol: [%s] registered to exchange [%s]", stream_name, symbol, exchange_name)
 
 
+    async def register_config(self, config: Dict[str, Any], concurrency: Optional[int] = None) -> List[str]:
+        """
+        Register every exchange, symbol and stream of a config with the
+        structure of config/producers.yaml
+
+        Exchanges are registered concurrently, their load_markets() round
+        trips overlap. Every exchange is attempted, if any fails the exchanges
+        this call registered are unregistered and closed, then the first
+        failure is raised.
+
+        Args:
+            config (Dict[str, Any]): Config with an "exchanges" key
+            concurrency (int, optional): Most exchanges registering at once, unlimited by default
+        
+        Returns:
+            List[str]: Producer names of the registered streams, in config order
+        """
+        semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        existing = set(self.registered["exchanges"])
+
+        async def register(exchange_name: str, exch_data: Dict[str, Any]) -> List[str]:
+            if semaphore is None:
+                return await self._register_exchange_config(exchange_name, exch_data)
+            async with semaphore:
+                return await self._register_exchange_config(exchange_name, exch_data)
+
+        results = await asyncio.gather(
+            *(register(exchange_name, exch_data) for exchange_name, exch_data in config["exchanges"].items()),
+            return_exceptions=True
+        )
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if failures:
+            for exchange_name in config["exchanges"]:
+                if exchange_name in existing or not self.exchange_registered(exchange_name):
+                    continue
+                exchange_obj = self.get_exchange_object(exchange_name)
+                self.unregister_exchange(exchange_name, force=True)
+                await exchange_obj.close()
+            raise failures[0]
+        producer_names = []
+        for result in results:
+            producer_names.extend(result)
+        return producer_names
+
+
+    async def _register_exchange_config(self, exchange_name: str, exch_data: Dict[str, Any]) -> List[str]:
+        producer_names = []
+        await self.register_exchange(exchange_name, exch_data.get("properties", {}))
+        for symbol, symbol_data in exch_data["symbols"].items():
+            await self.register_symbol(exchange_name, symbol)
+            for stream_name, stream_info in symbol_data["streams"].items():
+                stream_info = stream_info or {}
+                await self.register_stream(exchange_name, symbol, stream_name, stream_info.get("options", {}))
+                producer_names.append(f"{exchange_name}|{symbol}|{stream_name}")
+        return producer_names
+
+
+    def create_producer(
+        self,
+        exchange_name: str,
+        symbol: str,
+        stream_name: str,
+        data_queue: asyncio.Queue,
+        normalizer: Optional["Normalizer"] = None
+        ) -> DataProducer:
+        """
+        Create a (not yet started) DataProducer for a registered stream
+
+        Args:
+            exchange_name (str): Exchange name
+            symbol (str): Symbol name
+            stream_name (str): Stream name
+            data_queue (asyncio.Queue): Queue the producer pushes to
+            normalizer (Normalizer, optional): Converts raw ccxt output to records
+
+        Raises:
+            UnregisteredExchange / UnregisteredSymbol / UnregisteredStream: If the stream is not registered
+
+        Returns:
+            DataProducer
+        """
+        entry = self._stream_entry(exchange_name, symbol, stream_name)
+        return self._make_producer(
+            exchange_name, self.get_exchange_object(exchange_name), symbol, stream_name, entry, data_queue, normalizer
+        )
+
+    @staticmethod
+    def _make_producer(
+        exchange_name: str,
+        exchange_obj: ccxt.pro.Exchange,
+        symbol: str,
+        stream_name: str,
+        entry: Dict[str, Any],
+        data_queue: asyncio.Queue,
+        normalizer: Optional["Normalizer"]
+        ) -> DataProducer:
+        return DataProducer(
+            exchange_name=exchange_name,
+            exchange=exchange_obj,
+            symbol=symbol,
+            stream_name=stream_name,
+            stream_method=entry["stream_method"],
+            stream_options=entry["stream_options"],
+            data_queue=data_queue,
+            normalizer=normalizer
+        )
+
+
+    def create_producers(
+        self,
+        data_queue: asyncio.Queue,
+        normalizer: Optional["Normalizer"] = None,
+        grouped: bool = False,
+        min_symbols: int = 2
+        ) -> List[DataProducer]:
+        """
+        Create (not yet started) producers for every registered stream.
+
+        With grouped=True, symbols of an exchange sharing a stream and its
+        stream options are served by one GroupedDataProducer over the
+        exchange's watch*ForSymbols / watchTickers method, when the exchange
+        supports it and at least min_symbols symbols qualify. Every other
+        stream gets its own DataProducer.
+
+        Args:
+            data_queue (asyncio.Queue): Queue the producers push to
+            normalizer (Normalizer, optional): Converts raw ccxt output to records
+            grouped (bool, optional): Multiplex symbols per stream where supported
+            min_symbols (int, optional): Smallest group served by a GroupedDataProducer
+
+        Returns:
+            List[DataProducer]
+        """
+        producers: List[DataProducer] = []
+        for exchange_name, exch_data in self.registered["exchanges"].items():
+            exchange_obj = exch_data["object"]
+            # (stream name, options) -> (symbol, stream entry), insertion ordered
+            groups: Dict[tuple, List[tuple]] = {}
+            for symbol, symbol_data in exch_data["symbols"].items():
+                for stream_name, stream_data in symbol_data["streams"].items():
+                    if grouped and grouped_method_name(exchange_obj, stream_name):
+                        key = (stream_name, repr(sorted(stream_data["stream_options"].items())))
+                        groups.setdefault(key, []).append((symbol, stream_data))
+                    else:
+                        producers.append(self._make_producer(
+                            exchange_name, exchange_obj, symbol, stream_name, stream_data, data_queue, normalizer
+                        ))
+
+            for (stream_name, _), members in groups.items():
+                if len(members) < min_symbols:
+                    producers.extend(
+                        self._make_producer(
+                            exchange_name, exchange_obj, symbol, stream_name, stream_data, data_queue, normalizer
+                        )
+                        for symbol, stream_data in members
+                    )
+                    continue
+                symbols = [symbol for symbol, _ in members]
+                producer = GroupedDataProducer(
+                    exchange_name=exchange_name,
+                    exchange=exchange_obj,
+                    symbols=symbols,
+                    stream_name=stream_name,
+                    stream_method=getattr(exchange_obj, grouped_method_name(exchange_obj, stream_name)),
+                    stream_options=members[0][1]["stream_options"],
+                    data_queue=data_queue,
+                    normalizer=normalizer
+                )
+                # Groups of the same stream with different options need distinct names
+                taken = sum(1 for p in producers if p.producer_name.startswith(producer.producer_name))
+                if taken:
+                    producer.producer_name = f"{producer.producer_name}#{taken + 1}"
+                producers.append(producer)
+                logger.info(
+                    "Grouped [%d] symbols of stream [%s] on exchange [%s]", len(symbols), stream_name, exchange_name
+                )
+        return producers
+
+
 # Registry checks
 # -----------------------------------------------------------------------------
 # -----------------------------------------------------------------------------
@@ -185,14 +422,11 @@ class Registry:
         Returns:
             Bool
         """
-        if not self.exchange_registered(exchange_name):
+        exch_data = self.registered["exchanges"].get(exchange_name)
+        if exch_data is None:
             logger.exception("Exchange: [%s] not registered", exchange_name)
             raise UnregisteredExchange(exchange_name)
-
-        if self.registered["exchanges"][exchange_name]["symbols"].get(symbol, None) is not None:
-            return True
-        else:
-            return False
+        return exch_data["symbols"].get(symbol, None) is not None
 
     def stream_registered(self, stream_name:str, symbol:str, exchange_name:str) -> bool:
         """
@@ -206,18 +440,97 @@ class Registry:
         Returns:
             Bool
         """
-        if not self.exchange_registered(exchange_name):
-            logger.exception("Exchange: [%s] not registered", exchange_name)
-            raise UnregisteredExchange(exchange_name)
-        
+        if f"{exchange_name}|{symbol}|{stream_name}" in self.streams:
+            return True
         if not self.symbol_registered(symbol, exchange_name):
-            logger.exception("Symbol: [%s] already registered to exchange: [%s]", symbol, exchange_name)
+            logger.exception("Symbol: [%s] of exchange: [%s] not registered", symbol, exchange_name)
             raise UnregisteredSymbol(symbol, exchange_name)
+        return False
 
-        if self.registered["exchanges"][exchange_name]["symbols"][symbol]["streams"].get(stream_name, None) is not None:
-            return True
-        else:
-            return False
+
+# Registry index
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+    def _index_stream(self, exchange_name: str, symbol: str, stream_name: str, entry: Dict[str, Any]) -> None:
+        key = f"{exchange_name}|{symbol}|{stream_name}"
+        self.streams[key] = entry
+        self.exchange_streams.setdefault(exchange_name, {})[key] = None
+        self.stream_types.setdefault(stream_name, {})[key] = None
+
+    def _unindex_stream(self, exchange_name: str, symbol: str, stream_name: str) -> None:
+        key = f"{exchange_name}|{symbol}|{stream_name}"
+        self.streams.pop(key, None)
+        for index, name in ((self.exchange_streams, exchange_name), (self.stream_types, stream_name)):
+            keys = index.get(name)
+            if keys is not None:
+                keys.pop(key, None)
+                if not keys:
+                    del index[name]
+
+    def _stream_entry(self, exchange_name: str, symbol: str, stream_name: str) -> Dict[str, Any]:
+        """
+        Indexed stream entry, on a miss the exception names the first
+        unregistered level
+        """
+        entry = self.streams.get(f"{exchange_name}|{symbol}|{stream_name}")
+        if entry is not None:
+            return entry
+        if not self.symbol_registered(symbol, exchange_name):
+            logger.exception("Symbol: [%s] of exchange: [%s] not registered", symbol, exchange_name)
+            raise UnregisteredSymbol(symbol, exchange_name)
+        logger.exception(
+            "Stream: [%s] of Symbol: [%s] of Exchange: [%s] not registered", stream_name, symbol, exchange_name
+            )
+        raise UnregisteredStream(stream_name, symbol, exchange_name)
+
+    def get_stream(self, producer_key: str) -> Dict[str, Any]:
+        """
+        Stream entry (stream_method, stream_options, consumer_options) of a
+        registered stream by producer key
+
+        Args:
+            producer_key (str): "exchange|symbol|stream"
+
+        Raises:
+            ValueError: If the key is not in producer key format
+            UnregisteredExchange / UnregisteredSymbol / UnregisteredStream: If the stream is not registered
+
+        Returns:
+            Dict[str, Any]
+        """
+        entry = self.streams.get(producer_key)
+        if entry is not None:
+            return entry
+        parts = producer_name_parser(producer_key)
+        if len(parts) != 3:
+            raise ValueError(f"Invalid producer key: {producer_key}, expected exchange|symbol|stream")
+        exchange_name, symbol, stream_name = parts
+        return self._stream_entry(exchange_name, symbol, stream_name)
+
+    def producer_keys(self, exchange_name: Optional[str] = None, stream_name: Optional[str] = None) -> List[str]:
+        """
+        Producer keys of the registered streams in registration order,
+        optionally only those of an exchange and / or a stream name
+
+        Args:
+            exchange_name (str, optional): Exchange name
+            stream_name (str, optional): Stream name, e.g. watchTrades
+
+        Returns:
+            List[str]
+        """
+        if exchange_name is None and stream_name is None:
+            return list(self.streams)
+        if stream_name is None:
+            return list(self.exchange_streams.get(exchange_name, ()))
+        by_stream = self.stream_types.get(stream_name, {})
+        if exchange_name is None:
+            return list(by_stream)
+        by_exchange = self.exchange_streams.get(exchange_name, {})
+        # Iterate the smaller index
+        if len(by_exchange) < len(by_stream):
+            return [key for key in by_exchange if key in by_stream]
+        return [key for key in by_stream if key in by_exchange]
 
 
 # Registry helper methods
@@ -234,13 +547,7 @@ class Registry:
         if not self.exchange_registered(exchange_name):
             logger.exception("Exchange: [%s] not registered", exchange_name)
             raise UnregisteredExchange(exchange_name)
-        
-        symbols = self.registered["exchanges"][exchange_name]["symbols"]
-        for symbol_info in symbols.values():
-            streams = symbol_info.get("streams", {})
-            if streams:
-                return True
-        return False
+        return bool(self.exchange_streams.get(exchange_name))
     
     def get_exchange_object(self, exchange_name:str) -> ccxt.pro.Exchange:
         """
@@ -253,10 +560,11 @@ class Registry:
         Return:
             bool
         """
-        if not self.exchange_registered(exchange_name):
+        exch_data = self.registered["exchanges"].get(exchange_name)
+        if exch_data is None:
             logger.exception("Exchange: [%s] not registered", exchange_name)
             raise UnregisteredExchange(exchange_name)
-        return self.registered["exchanges"][exchange_name]["object"]
+        return exch_data["object"]
     
     def get_stream_method(
         self,
@@ -273,20 +581,7 @@ class Registry:
         Return:
             Callable
         """
-        if not self.exchange_registered(exchange_name):
-            logger.exception("Exchange: [%s] not registered", exchange_name)
-            raise UnregisteredExchange(exchange_name)
-        
-        if not self.symbol_registered(symbol, exchange_name):
-            logger.exception("Symbol: [%s] of exchange: [%s] not registered", symbol, exchange_name)
-            raise UnregisteredSymbol(symbol, exchange_name)  
-        
-        if not self.stream_registered(stream_name, symbol, exchange_name):
-            logger.exception(
-                "Stream: [%s] of Symbol: [%s] of Exchange: [%s] not registered", stream_name, symbol, exchange_name 
-                )
-            raise UnregisteredStream(stream_name, symbol, exchange_name)
-        return self.registered["exchanges"][exchange_name]["symbols"][symbol]["streams"][stream_name]["stream_method"]
+        return self._stream_entry(exchange_name, symbol, stream_name)["stream_method"]
     
     def get_stream_options(
         self,
@@ -294,21 +589,7 @@ class Registry:
         symbol,
         stream_name
         ):
-        if not self.exchange_registered(exchange_name):
-            logger.exception("Exchange: [%s] not registered", exchange_name)
-            raise UnregisteredExchange(exchange_name)
-        
-        if not self.symbol_registered(symbol, exchange_name):
-            logger.exception("Symbol: [%s] of exchange: [%s] not registered", symbol, exchange_name)
-            raise UnregisteredSymbol(symbol, exchange_name)  
-        
-        if not self.stream_registered(stream_name, symbol, exchange_name):
-            logger.exception(
-                "Stream: [%s] of Symbol: [%s] of Exchange: [%s] not registered", stream_name, symbol, exchange_name 
-                )
-            raise UnregisteredStream(stream_name, symbol, exchange_name)
-
-        return self.registered["exchanges"][exchange_name]["symbols"][symbol]["streams"][stream_name]["stream_options"]
+        return self._stream_entry(exchange_name, symbol, stream_name)["stream_options"]
 
     def get_stream_consumer_options(
         self,
@@ -316,21 +597,7 @@ class Registry:
         symbol,
         stream_name
         ):
-        if not self.exchange_registered(exchange_name):
-            logger.exception("Exchange: [%s] not registered", exchange_name)
-            raise UnregisteredExchange(exchange_name)
-        
-        if not self.symbol_registered(symbol, exchange_name):
-            logger.exception("Symbol: [%s] of exchange: [%s] not registered", symbol, exchange_name)
-            raise UnregisteredSymbol(symbol, exchange_name)  
-        
-        if not self.stream_registered(stream_name, symbol, exchange_name):
-            logger.exception(
-                "Stream: [%s] of Symbol: [%s] of Exchange: [%s] not registered", stream_name, symbol, exchange_name 
-                )
-            raise UnregisteredStream(stream_name, symbol, exchange_name)
-        print(self.registered["exchanges"][exchange_name]["symbols"][symbol]["streams"][stream_name])
-        return self.registered["exchanges"][exchange_name]["symbols"][symbol]["streams"][stream_name]["consumer_options"]
+        return self._stream_entry(exchange_name, symbol, stream_name)["consumer_options"]
 
 
 # Registry Unregister methods
@@ -367,6 +634,7 @@ class Registry:
             raise UnregisteredStream(stream_name, symbol, exchange_name)
         
         self.registered["exchanges"][exchange_name]["symbols"][symbol]["streams"].pop(stream_name)
+        self._unindex_stream(exchange_name, symbol, stream_name)
         logger.info("Unregistered stream [%s.%s.%s]", exchange_name, symbol, stream_name)
 
 
@@ -407,7 +675,9 @@ class Registry:
             )
             raise RuntimeError(f"Exchange [{exchange_name}] still has streams registered to symbol [{symbol}]. Use force=True to override.")
 
-        self.registered["exchanges"][exchange_name]["symbols"].pop(symbol)
+        symbol_data = self.registered["exchanges"][exchange_name]["symbols"].pop(symbol)
+        for stream_name in symbol_data["streams"]:
+            self._unindex_stream(exchange_name, symbol, stream_name)
         logger.info("Unregistered symbol [%s] on exchange [%s]", symbol, exchange_name)
 
 
@@ -443,7 +713,10 @@ class Registry:
                 )
             raise RuntimeError(f"Exchange [{exchange_name}] still has symbols registered. Use force=True to override.")
 
-        self.registered["exchanges"].pop(exchange_name)
+        exch_data = self.registered["exchanges"].pop(exchange_name)
+        for symbol, symbol_data in exch_data["symbols"].items():
+            for stream_name in symbol_data["streams"]:
+                self._unindex_stream(exchange_name, symbol, stream_name)
         logger.info("Unregistered Exchange [%s]", exchange_name)
 
     def __str__(self) -> str:
@@ -0,0 +1,319 @@
+"""
+Hot reload of config/producers.yaml.
+
+ConfigReloader watches the config file, re-reads it through ConfigHandler
+when it changes and applies only the difference to the Registry and the
+ProducerPipeline:
+
+  - Streams new to the config are registered and their producers started,
+    new exchanges and symbols are registered first.
+  - Streams gone from the config are stopped and unregistered, symbols and
+    exchanges left without streams are unregistered, the pipeline closes
+    an exchange once its last producer is removed.
+  - Streams whose options or overflow policy changed are restarted with
+    the new ones.
+  - Exchanges whose properties changed are re-created, every stream of
+    such an exchange is restarted.
+
+The reloader only owns the streams and exchanges of the config: it keeps
+the last applied config and only removes what disappeared from it.
+Streams added at runtime, e.g. through the control API (control.py),
+survive reloads, and an exchange still serving such streams is kept
+registered when it leaves the config.
+
+Every other producer keeps running on its open connection, untouched
+streams see no gap. New producers are started before any old one is
+stopped, an exchange that only swaps streams is never closed.
+
+Only per symbol producers are reloaded, grouped producers and sharded
+runs are not.
+"""
+import asyncio
+import logging
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, TYPE_CHECKING
+
+from crypto_data_collector.helpers import ConfigHandler, producer_name_parser
+
+if TYPE_CHECKING:
+    from crypto_data_collector.producer import ProducerPipeline
+    from crypto_data_collector.records import Normalizer
+    from crypto_data_collector.registry import Registry
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ConfigDiff():
+    # Producer keys ("exchange|symbol|stream")
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    # Options or exchange properties changed, restarted
+    changed: List[str] = field(default_factory=list)
+    # Exchange names
+    exchanges_added: List[str] = field(default_factory=list)
+    exchanges_removed: List[str] = field(default_factory=list)
+    exchanges_changed: List[str] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(
+            self.added or self.removed or self.changed
+            or self.exchanges_added or self.exchanges_removed or self.exchanges_changed
+        )
+
+
+def config_streams(config: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    Producer key -> stream info ({"options": ..., "overflow": ...}) of every
+    stream of a config, in config order
+    """
+    streams = {}
+    for exchange_name, exch_data in (config.get("exchanges") or {}).items():
+        for symbol, symbol_data in ((exch_data or {}).get("symbols") or {}).items():
+            for stream_name, stream_info in ((symbol_data or {}).get("streams") or {}).items():
+                streams[f"{exchange_name}|{symbol}|{stream_name}"] = stream_info or {}
+    return streams
+
+
+def diff_config(
+    registry: "Registry",
+    config: Dict[str, Any],
+    owned_streams: Optional[Dict[str, Dict[str, Any]]] = None,
+    owned_exchanges: Optional[Iterable[str]] = None
+    ) -> ConfigDiff:
+    """
+    What has to change for the registry to match a config
+
+    Args:
+        registry (Registry): Registry to compare against
+        config (dict): New config
+        owned_streams (dict, optional): Producer key -> stream info of the previously applied
+            config, only these streams are removed. Every registered stream by default
+        owned_exchanges (iterable, optional): Exchanges of the previously applied config,
+            only these exchanges are removed. Every registered exchange by default
+    """
+    diff = ConfigDiff()
+    exchanges = config.get("exchanges") or {}
+    registered = registry.registered["exchanges"]
+    if owned_streams is None:
+        owned_streams = {key: {"options": entry["stream_options"]} for key, entry in registry.streams.items()}
+    owned_exchanges = set(registered if owned_exchanges is None else owned_exchanges)
+    for exchange_name, exch_data in exchanges.items():
+        if exchange_name not in registered:
+            diff.exchanges_added.append(exchange_name)
+        elif registered[exchange_name]["overrides"] != ((exch_data or {}).get("properties") or {}):
+            diff.exchanges_changed.append(exchange_name)
+
+    streams = config_streams(config)
+    for key, stream_info in streams.items():
+        entry = registry.streams.get(key)
+        if entry is None:
+            diff.added.append(key)
+        elif (
+            producer_name_parser(key)[0] in diff.exchanges_changed
+            or entry["stream_options"] != (stream_info.get("options") or {})
+            or stream_info.get("overflow") != (owned_streams.get(key) or {}).get("overflow")
+        ):
+            diff.changed.append(key)
+    diff.removed = [key for key in owned_streams if key in registry.streams and key not in streams]
+    # An exchange left without config streams stays while runtime streams use it
+    diff.exchanges_removed = [
+        name for name in registered
+        if name in owned_exchanges and name not in exchanges
+        and all(key in owned_streams for key in registry.producer_keys(exchange_name=name))
+    ]
+    return diff
+
+
+class ConfigReloader:
+    """
+    Applies config changes to a running registry and producer pipeline,
+    see the module docstring. run() checks the config file every interval
+    seconds, reload() applies it once.
+
+    The streams and exchanges of config (the config the collector started
+    with, read from the file by default) are owned by the reloader, later
+    reloads only stop what it owns.
+
+    Args:
+        registry (Registry): Registry the running producers were created from
+        pipeline (ProducerPipeline): Pipeline running the producers
+        project_root (Path): Root holding config/producers.yaml, read through ConfigHandler
+        normalizer (Normalizer, optional): Passed to new producers
+        interval (float): Seconds between checks of the file's modification time
+        config (dict, optional): Config the running producers were created from
+    """
+
+    def __init__(
+        self,
+        registry: "Registry",
+        pipeline: "ProducerPipeline",
+        project_root: Path,
+        normalizer: Optional["Normalizer"] = None,
+        interval: float = 2.0,
+        config: Optional[Dict[str, Any]] = None
+        ) -> None:
+        self.registry = registry
+        self.pipeline = pipeline
+        self.project_root = Path(project_root)
+        self.config_path = self.project_root / "config" / "producers.yaml"
+        self.normalizer = normalizer
+        self.interval = interval
+        self._mtime = self._stat()
+        if config is None:
+            config = ConfigHandler(project_root=self.project_root).get_config()
+        # Last applied config, the streams and exchanges the reloader may remove
+        self.owned_streams = config_streams(config)
+        self.owned_exchanges = set(config.get("exchanges") or {})
+
+        self.reloads = 0
+        self.failures = 0
+
+    def _stat(self) -> Optional[int]:
+        try:
+            return self.config_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            mtime = self._stat()
+            if mtime is None or mtime == self._mtime:
+                continue
+            self._mtime = mtime
+            await self.reload()
+
+    async def reload(self) -> Optional[ConfigDiff]:
+        """
+        Re-read the config and apply it, a config that fails to load is
+        logged and ignored
+        """
+        try:
+            config = ConfigHandler(project_root=self.project_root).get_config()
+        except Exception:
+            self.failures += 1
+            logger.exception("Failed to read config [%s], keeping the running config", self.config_path)
+            return None
+        return await self.apply(config)
+
+    async def apply(self, config: Dict[str, Any]) -> ConfigDiff:
+        """
+        Add, restart and remove producers until the registry matches config.
+        A stream that fails to register is logged and skipped, the rest of
+        the config is still applied.
+        """
+        registry = self.registry
+        pipeline = self.pipeline
+        diff = diff_config(registry, config, self.owned_streams, self.owned_exchanges)
+        streams = config_streams(config)
+        exchanges = config["exchanges"]
+        self.owned_streams = streams
+        self.owned_exchanges = set(exchanges)
+        if not diff:
+            logger.info("Config reloaded, nothing changed")
+            return diff
+        logger.info(
+            "Config reloaded: %d streams added, %d removed, %d restarted, exchanges added %s, removed %s, re-created %s",
+            len(diff.added), len(diff.removed), len(diff.changed),
+            diff.exchanges_added, diff.exchanges_removed, diff.exchanges_changed
+        )
+        self.reloads += 1
+
+        # Re-created exchanges stop every producer first, their connections go.
+        # Runtime streams of those exchanges are restarted with their options
+        runtime = {}
+        for exchange_name in diff.exchanges_changed:
+            for key in registry.producer_keys(exchange_name=exchange_name):
+                if key not in streams and key in pipeline.producers:
+                    runtime[key] = {"options": registry.streams[key]["stream_options"]}
+                await pipeline.remove_producer(key)
+            await self._close_exchange(exchange_name)
+            registry.unregister_exchange(exchange_name, force=True)
+
+        results = await asyncio.gather(
+            *(
+                registry.register_exchange(name, (exchanges[name] or {}).get("properties") or {})
+                for name in diff.exchanges_added + diff.exchanges_changed
+            ),
+            return_exceptions=True
+        )
+        failed = set()
+        for name, result in zip(diff.exchanges_added + diff.exchanges_changed, results):
+            if isinstance(result, BaseException):
+                # register_exchange logged it
+                failed.add(name)
+                self.failures += 1
+
+        # New streams before removals, an exchange swapping streams stays connected
+        recreated = set(diff.exchanges_changed)
+        restarted = [key for key in diff.changed if producer_name_parser(key)[0] not in recreated]
+        for key in diff.added + [key for key in diff.changed if key not in restarted]:
+            if producer_name_parser(key)[0] not in failed:
+                await self._start(key, streams[key])
+        for key, stream_info in runtime.items():
+            if producer_name_parser(key)[0] not in failed:
+                await self._start(key, stream_info)
+        for key in restarted:
+            await pipeline.remove_producer(key)
+            exchange_name, symbol, stream_name = producer_name_parser(key)
+            registry.unregister_stream(exchange_name, symbol, stream_name)
+            await self._start(key, streams[key])
+
+        for key in diff.removed:
+            exchange_name, symbol, stream_name = producer_name_parser(key)
+            if exchange_name in recreated:
+                # Already gone with its exchange
+                continue
+            await pipeline.remove_producer(key)
+            registry.unregister_stream(exchange_name, symbol, stream_name)
+            self._clear_overflow(key)
+            symbols = (exchanges.get(exchange_name) or {}).get("symbols") or {}
+            if symbol not in symbols and not registry.registered["exchanges"][exchange_name]["symbols"][symbol]["streams"]:
+                registry.unregister_symbol(exchange_name, symbol)
+
+        for exchange_name in diff.exchanges_removed:
+            await self._close_exchange(exchange_name)
+            registry.unregister_exchange(exchange_name, force=True)
+        return diff
+
+    async def _start(self, key: str, stream_info: Dict[str, Any]) -> None:
+        registry = self.registry
+        exchange_name, symbol, stream_name = producer_name_parser(key)
+        try:
+            await registry.register_symbol(exchange_name, symbol)
+            await registry.register_stream(exchange_name, symbol, stream_name, stream_info.get("options") or {})
+        except Exception as e:
+            self.failures += 1
+            logger.error("Failed to register stream [%s] from the reloaded config: %s", key, e)
+            return
+        queue = self.pipeline.get_data_queue()
+        if stream_info.get("overflow") and hasattr(queue, "set_policy"):
+            queue.set_policy(key, stream_info["overflow"])
+        elif key in self.owned_streams:
+            self._clear_overflow(key)
+        producer = registry.create_producer(
+            exchange_name, symbol, stream_name, data_queue=queue, normalizer=self.normalizer
+        )
+        self.pipeline.add_producer(producer.producer_name, producer)
+
+    def _clear_overflow(self, key: str) -> None:
+        queue = self.pipeline.get_data_queue()
+        if hasattr(queue, "clear_policy"):
+            queue.clear_policy(key)
+
+    async def _close_exchange(self, exchange_name: str) -> None:
+        # The pipeline closes an exchange with its last producer, this
+        # covers exchanges that had none running
+        exchange = self.registry.get_exchange_object(exchange_name)
+        if any(p.exchange is exchange for p in self.pipeline.producers.values()):
+            return
+        try:
+            await exchange.close()
+        except Exception:
+            logger.exception("Error closing exchange [%s]", exchange_name)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"reloads": self.reloads, "failures": self.failures}
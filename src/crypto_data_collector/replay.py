@@ -0,0 +1,210 @@
+"""
+Replay of recorded streams.
+
+ReplayProducer reads recorded messages ({"data", "producer", "received"}
+envelopes, one JSON object per line, optionally gzipped, or RecorderConsumer
+segments / recording directories) and pushes them
+into the pipeline queue under their original producer names, so consumers
+cannot tell a replay from a live feed. Files are streamed in chunks from a
+worker thread, memory use does not depend on the recording size.
+
+Records written by RecorderConsumer come back as the same record classes,
+a normalizer only converts raw ccxt data and passes records through.
+
+Playback speed:
+    speed=1.0   original timing, from the recorded "received" timestamps
+    speed=N     N times faster
+    speed=None  as fast as the queue accepts messages
+"""
+import sys
+import gzip
+import json
+import time
+import asyncio
+import logging
+
+from itertools import islice
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+from crypto_data_collector.helpers import Status, Subscription, producer_name_parser
+from crypto_data_collector.producer import DataProducer
+from crypto_data_collector.records import Normalizer
+from crypto_data_collector.recorder import read_log, read_segment
+
+logger = logging.getLogger(__name__)
+
+
+def read_jsonl(path: Union[str, Path], start: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate the messages of a JSON lines recording, .gz files are decompressed.
+    Messages received before start (ms) are skipped.
+    """
+    path = Path(path)
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Skipping malformed line %d of recording [%s]", line_number, path)
+                continue
+            if start is not None and message.get("received", 0.0) < start:
+                continue
+            yield message
+
+
+# Suffix -> reader, a reader takes (path, start) and yields messages in recorded order
+READERS: Dict[str, Callable[..., Iterator[Dict[str, Any]]]] = {
+    ".jsonl": read_jsonl,
+    ".json": read_jsonl,
+    ".gz": read_jsonl,
+    ".log": read_segment,
+}
+
+
+def read_recording(path: Union[str, Path], start: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+    path = Path(path)
+    if path.is_dir():
+        # A RecorderConsumer directory
+        return read_log(path, start)
+    reader = READERS.get(path.suffix)
+    if reader is None:
+        raise ValueError(f"No reader for recording [{path}], known suffixes: {sorted(READERS)}")
+    return reader(path, start)
+
+
+class ReplayProducer(DataProducer):
+    """
+    A DataProducer that re-feeds recorded messages.
+
+    The replay finishes (state FINISHED, self.done set) at the end of the
+    last file, or starts over forever with repeat=True.
+
+    Args:
+        paths (str | Path | list): Recording files or directories, replayed in the given order
+        data_queue (asyncio.Queue): Queue the messages are pushed to
+        speed (float, optional): Playback speed multiplier, None replays as fast as possible
+        subscriptions (list, optional): Only replay producers matching these patterns
+        start (float, optional): Skip messages received before this time (ms)
+        end (float, optional): Stop at the first message received after this time (ms)
+        max_gap_ms (float, optional): Longest pause between two messages, caps recording gaps
+        rewrite_received (bool): Stamp messages with the replay time instead of the recorded one
+        repeat (bool): Start over after the last file
+        normalizer (Normalizer, optional): Normalize raw ccxt payloads while replaying
+        name (str): Producer name of the replay itself, messages keep their recorded names
+        chunk_size (int): Messages read per trip to the reader thread
+    """
+
+    def __init__(
+        self,
+        paths: Union[str, Path, Iterable[Union[str, Path]]],
+        data_queue: asyncio.Queue,
+        speed: Optional[float] = 1.0,
+        subscriptions: Optional[Iterable[Union[Subscription, str]]] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        max_gap_ms: Optional[float] = None,
+        rewrite_received: bool = False,
+        repeat: bool = False,
+        normalizer: Optional[Normalizer] = None,
+        name: str = "replay",
+        chunk_size: int = 1000
+        ) -> None:
+        super().__init__(
+            exchange_name=name,
+            exchange=None,
+            symbol="*",
+            stream_name="*",
+            stream_method=None,
+            stream_options={},
+            data_queue=data_queue,
+            normalizer=normalizer
+        )
+        if speed is not None and speed <= 0:
+            raise ValueError("speed must be positive, or None to replay as fast as possible")
+        self.paths: List[Path] = [Path(paths)] if isinstance(paths, (str, Path)) else [Path(p) for p in paths]
+        self.speed = speed
+        self.subscriptions = None
+        if subscriptions is not None:
+            self.subscriptions = tuple(Subscription.parse(s) if isinstance(s, str) else s for s in subscriptions)
+        self.start = start
+        self.end = end
+        self.max_gap_ms = max_gap_ms
+        self.rewrite_received = rewrite_received
+        self.repeat = repeat
+        self.chunk_size = chunk_size
+
+        self.done = asyncio.Event()
+        self.skipped = 0
+        # producer name -> (interned name, stream name) or None when filtered out
+        self._producers: Dict[str, Optional[tuple]] = {}
+
+    def _resolve(self, producer_name: str) -> Optional[tuple]:
+        resolved = self._producers.get(producer_name, False)
+        if resolved is False:
+            resolved = None
+            if self.subscriptions is None or any(s.matches(producer_name) for s in self.subscriptions):
+                parts = producer_name_parser(producer_name)
+                resolved = (sys.intern(producer_name), parts[-1])
+            self._producers[producer_name] = resolved
+        return resolved
+
+    async def run(self) -> None:
+        self.state.status = Status.RUNNING
+        while True:
+            await self.replay()
+            if not self.repeat:
+                break
+        self.state.status = Status.FINISHED
+        self.done.set()
+        logger.info("Replay [%s] finished after %d messages", self.producer_name, self.messages)
+
+    async def replay(self) -> None:
+        """
+        One pass over every file
+        """
+        loop = asyncio.get_running_loop()
+        # (recorded time, wall clock time) of the first message, anchors the schedule
+        anchor = None
+        previous = None
+        for path in self.paths:
+            logger.info("Replay [%s] reading [%s]", self.producer_name, path)
+            messages = read_recording(path, self.start)
+            try:
+                while True:
+                    chunk = await asyncio.to_thread(lambda: list(islice(messages, self.chunk_size)))
+                    if not chunk:
+                        break
+                    for message in chunk:
+                        recorded = message.get("received", 0.0)
+                        if self.end is not None and recorded > self.end:
+                            return
+                        resolved = self._resolve(message["producer"])
+                        if resolved is None:
+                            self.skipped += 1
+                            continue
+
+                        if self.speed is not None:
+                            if anchor is None:
+                                anchor = (recorded, loop.time())
+                            elif self.max_gap_ms is not None and recorded - previous > self.max_gap_ms:
+                                # Shift the schedule so the gap lasts max_gap_ms
+                                anchor = (anchor[0] + recorded - previous - self.max_gap_ms, anchor[1])
+                            delay = anchor[1] + (recorded - anchor[0]) / 1000 / self.speed - loop.time()
+                            if delay > 0:
+                                await asyncio.sleep(delay)
+                        previous = recorded
+
+                        received = time.time() * 1000 if self.rewrite_received else recorded
+                        producer_name, stream_name = resolved
+                        await self.emit(producer_name, stream_name, message["data"], received)
+            finally:
+                try:
+                    messages.close()
+                except ValueError:
+                    # Cancelled while the reader thread was still in the generator,
+                    # the file is closed when the generator is collected
+                    pass
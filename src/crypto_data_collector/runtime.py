@@ -0,0 +1,83 @@
+"""
+Event loop and JSON decoder selection.
+
+uvloop and orjson are optional (poetry install -E speedups). Without them
+the stdlib asyncio loop and json module are used.
+
+ccxt picks orjson by itself when it is importable at ccxt import time, for
+REST responses (Exchange.on_json_response) and websocket frames
+(ccxt.async_support.base.ws.client.json_parser). use_fast_json() checks
+that and plugs orjson in where ccxt did not, e.g. when orjson was
+installed after ccxt was imported or for ccxt versions without the
+fallback.
+"""
+import asyncio
+import logging
+
+from typing import Any, Callable, Coroutine, Optional
+
+from ccxt.async_support.base.ws import client as ws_client
+from ccxt.base.exchange import Exchange
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+LOOPS = ("auto", "uvloop", "asyncio")
+
+
+def loop_factory(loop: str = "auto") -> Optional[Callable[[], asyncio.AbstractEventLoop]]:
+    """
+    Event loop factory for asyncio.Runner, None is the default asyncio loop
+
+    Args:
+        loop (str): "auto" (uvloop if installed), "uvloop" or "asyncio"
+    """
+    if loop not in LOOPS:
+        raise ValueError(f"Unknown event loop: {loop}, expected one of {LOOPS}")
+    if loop == "asyncio":
+        return None
+    if uvloop is None:
+        if loop == "uvloop":
+            logger.warning("uvloop requested but not installed, using the asyncio event loop")
+        return None
+    return uvloop.new_event_loop
+
+
+def run(main: Coroutine[Any, Any, Any], loop: str = "auto", debug: bool = False) -> Any:
+    """
+    asyncio.run with a selectable event loop
+    """
+    factory = loop_factory(loop)
+    logger.info("Running on the %s event loop", "uvloop" if factory is not None else "asyncio")
+    with asyncio.Runner(loop_factory=factory, debug=debug) as runner:
+        return runner.run(main)
+
+
+def use_fast_json(exchange: Any = None) -> bool:
+    """
+    Make ccxt decode websocket frames, and the REST responses of exchange,
+    with orjson. Returns whether orjson is in use.
+    """
+    if orjson is None:
+        logger.info("orjson not installed, ccxt decodes JSON with the stdlib json module")
+        return False
+
+    if getattr(ws_client, "json_parser", None) is not orjson:
+        ws_client.json_parser = orjson
+        logger.info("Plugged orjson into the ccxt websocket client")
+
+    if exchange is not None and exchange.on_json_response is not orjson.loads:
+        # Leave exchanges with their own response parsing alone
+        if type(exchange).on_json_response is Exchange.on_json_response:
+            exchange.on_json_response = orjson.loads
+            logger.info("Plugged orjson into exchange [%s]", getattr(exchange, "id", exchange))
+    return True
@@ -0,0 +1,196 @@
+"""
+Minimal HTTP/1.1 server on asyncio streams.
+
+Serves the small local endpoints of the collector (metrics, control) from
+the event loop, without a web framework dependency. Requests are routed by
+method and path to handlers returning a Response, one request per
+connection. Handlers can be called in-process through dispatch(), which is
+what the network path uses as well.
+"""
+import json
+import asyncio
+import logging
+
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+REASONS = {
+    200: "OK",
+    201: "Created",
+    204: "No Content",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    409: "Conflict",
+    413: "Payload Too Large",
+    415: "Unsupported Media Type",
+    500: "Internal Server Error",
+}
+
+
+@dataclass
+class Request():
+    method: str
+    path: str
+    query: Dict[str, str] = field(default_factory=dict)
+    headers: Dict[str, str] = field(default_factory=dict)
+    body: bytes = b""
+    # Values of {name} segments of the matched route
+    params: Dict[str, str] = field(default_factory=dict)
+
+    def json(self) -> Any:
+        return json.loads(self.body) if self.body else None
+
+
+@dataclass
+class Response():
+    status: int = 200
+    body: bytes = b""
+    content_type: str = "text/plain; charset=utf-8"
+
+    @classmethod
+    def text(cls, text: str, status: int = 200, content_type: str = "text/plain; charset=utf-8") -> "Response":
+        return cls(status, text.encode(), content_type)
+
+    @classmethod
+    def json(cls, data: Any, status: int = 200) -> "Response":
+        return cls(status, json.dumps(data, default=str).encode(), "application/json")
+
+
+Handler = Callable[[Request], Union[Response, Awaitable[Response]]]
+
+
+class HttpServer:
+    """
+    Args:
+        host (str): Interface to bind, local only by default
+        port (int): Port to bind, 0 picks a free one (see self.port after start)
+        max_body (int): Largest accepted request body in bytes
+        read_timeout (float): Seconds a client has to send the whole request, 408 after
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        max_body: int = 1 << 20,
+        read_timeout: float = 5.0
+        ) -> None:
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.read_timeout = read_timeout
+        # (method, path split on "/") -> handler, "{name}" segments match anything
+        self.routes: Dict[Tuple[str, Tuple[str, ...]], Handler] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def route(self, method: str, path: str, handler: Handler) -> None:
+        self.routes[(method.upper(), tuple(path.strip("/").split("/")))] = handler
+
+    def match(self, method: str, path: str) -> Tuple[Optional[Handler], Dict[str, str], bool]:
+        """
+        Find the handler of a request, returns (handler, params, path_exists)
+        """
+        parts = tuple(path.strip("/").split("/"))
+        path_exists = False
+        for (route_method, route_parts), handler in self.routes.items():
+            if len(route_parts) != len(parts):
+                continue
+            params = {}
+            for route_part, part in zip(route_parts, parts):
+                if route_part.startswith("{") and route_part.endswith("}"):
+                    params[route_part[1:-1]] = part
+                elif route_part != part:
+                    break
+            else:
+                path_exists = True
+                if route_method == method:
+                    return handler, params, True
+        return None, {}, path_exists
+
+    async def dispatch(self, request: Request) -> Response:
+        handler, params, path_exists = self.match(request.method, request.path)
+        if handler is None:
+            if path_exists:
+                return Response.json({"error": "method not allowed"}, 405)
+            return Response.json({"error": "not found"}, 404)
+        request.params = params
+        try:
+            response = handler(request)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except LookupError as e:
+            return Response.json({"error": f"not found: {e}"}, 404)
+        except (ValueError, TypeError) as e:
+            return Response.json({"error": str(e)}, 400)
+        except Exception as e:
+            logger.exception("Error handling [%s %s]", request.method, request.path)
+            return Response.json({"error": str(e)}, 500)
+        return response
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("HTTP server listening on [%s:%d]", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            logger.info("HTTP server on [%s:%d] stopped", self.host, self.port)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                # Only reading is bounded, a handler may take longer
+                request = await asyncio.wait_for(self._read_request(reader), self.read_timeout)
+            except asyncio.TimeoutError:
+                request = Response.json({"error": "request timeout"}, 408)
+            response = request if isinstance(request, Response) else await self.dispatch(request)
+            head = (
+                f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}\r\n"
+                f"Content-Type: {response.content_type}\r\n"
+                f"Content-Length: {len(response.body)}\r\n"
+                "Connection: close\r\n\r\n"
+            )
+            writer.write(head.encode() + response.body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Union[Request, Response]:
+        """
+        Read one request, or the error response of a malformed one
+        """
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            method, target = request_line[0].upper(), request_line[1]
+        except (IndexError, UnicodeDecodeError):
+            return Response.json({"error": "malformed request line"}, 400)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0) or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return Response.json({"error": "invalid content-length"}, 400)
+        if length > self.max_body:
+            return Response.json({"error": "body too large"}, 413)
+        body = await reader.readexactly(length) if length else b""
+        url = urlsplit(target)
+        return Request(method, url.path, dict(parse_qsl(url.query)), headers, body)
@@ -0,0 +1,311 @@
+"""
+Multi process sharding of producers.
+
+The exchange / symbol / stream tree of a config is partitioned across
+worker processes. Each shard runs its own event loop, Registry and
+ProducerPipeline, and forwards its messages in pickled batches over a
+pipe to the main process, where they are pushed into the main queue
+feeding the ConsumerPipeline. The supervisor restarts shards that die.
+"""
+import sys
+import pickle
+import asyncio
+import logging
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from crypto_data_collector.market_cache import MarketCache
+from crypto_data_collector.producer import ProducerPipeline
+from crypto_data_collector.queues import BoundedQueue, get_batch
+from crypto_data_collector.records import Normalizer
+from crypto_data_collector.registry import Registry
+from crypto_data_collector import runtime
+
+logger = logging.getLogger(__name__)
+
+ShardFactory = Callable[[Dict[str, Any], asyncio.Queue, Optional[Normalizer]], Awaitable[Any]]
+
+
+def partition_config(config: Dict[str, Any], shards: int) -> List[Dict[str, Any]]:
+    """
+    Split a config into at most `shards` configs, balanced by stream count.
+
+    The unit of partitioning is an exchange / symbol pair, all streams of a
+    symbol stay together. Units are placed heaviest first on the least
+    loaded shard, preferring shards that already hold the same exchange so
+    exchange connections are not duplicated needlessly.
+
+    Args:
+        config (Dict[str, Any]): Config with the structure of config/producers.yaml
+        shards (int): Number of shards
+
+    Returns:
+        List[Dict[str, Any]]: One config per non empty shard
+    """
+    if shards < 1:
+        raise ValueError("shards must be at least 1")
+    units = []
+    for exchange_name, exch_data in config["exchanges"].items():
+        for symbol, symbol_data in exch_data["symbols"].items():
+            units.append((len(symbol_data["streams"]), exchange_name, symbol))
+    units.sort(key=lambda unit: (-unit[0], unit[1], unit[2]))
+
+    loads = [0] * shards
+    parts: List[Dict[str, Any]] = [{} for _ in range(shards)]
+    for weight, exchange_name, symbol in units:
+        index = min(range(shards), key=lambda i: (loads[i], exchange_name not in parts[i], i))
+        loads[index] += weight
+        exch_data = config["exchanges"][exchange_name]
+        part = parts[index].setdefault(
+            exchange_name,
+            {**{k: v for k, v in exch_data.items() if k != "symbols"}, "symbols": {}}
+        )
+        part["symbols"][symbol] = exch_data["symbols"][symbol]
+
+    base = {k: v for k, v in config.items() if k != "exchanges"}
+    return [{**base, "exchanges": part} for part in parts if part]
+
+
+async def start_producers(
+    config: Dict[str, Any],
+    data_queue: asyncio.Queue,
+    normalizer: Optional[Normalizer] = None
+    ) -> ProducerPipeline:
+    """
+    Default shard factory, registers the config with ccxt and starts one
+    producer per stream, or per stream of an exchange when "grouped" is set
+    """
+    cache_config = config.get("market_cache") or {}
+    market_cache = MarketCache(**cache_config) if cache_config.get("cache_dir") else None
+    registry = Registry(market_cache=market_cache)
+    await registry.register_config(config)
+    pipeline = ProducerPipeline(data_queue=data_queue)
+    for producer in registry.create_producers(data_queue, normalizer, grouped=config.get("grouped", False)):
+        pipeline.add_producer(producer_name=producer.producer_name, producer=producer)
+    return pipeline
+
+
+def shard_main(
+    shard_id: int,
+    config: Dict[str, Any],
+    conn: Any,
+    factory: ShardFactory,
+    normalize: bool,
+    batch_size: int,
+    flush_interval: float,
+    queue_size: int
+    ) -> None:
+    """
+    Entry point of a shard process
+    """
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s %(levelname)s [shard {shard_id}] [%(name)s] %(message)s")
+    try:
+        runtime.run(_run_shard(shard_id, config, conn, factory, normalize, batch_size, flush_interval, queue_size))
+    except (BrokenPipeError, EOFError):
+        logger.warning("Shard [%d] lost its pipe to the main process, exiting", shard_id)
+    except KeyboardInterrupt:
+        pass
+
+
+async def _run_shard(
+    shard_id: int,
+    config: Dict[str, Any],
+    conn: Any,
+    factory: ShardFactory,
+    normalize: bool,
+    batch_size: int,
+    flush_interval: float,
+    queue_size: int
+    ) -> None:
+    queue = BoundedQueue(maxsize=queue_size)
+    # Keep a reference, the pipeline owns the producer tasks
+    pipeline = await factory(config, queue, Normalizer() if normalize else None)
+    logger.info("Shard [%d] started", shard_id)
+
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard-{shard_id}-send") as executor:
+        while True:
+            batch = await get_batch(queue, batch_size, flush_interval)
+            payload = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+            # send_bytes blocks when the pipe is full, keep it off the event loop
+            await loop.run_in_executor(executor, conn.send_bytes, payload)
+            for _ in batch:
+                queue.task_done()
+
+
+@dataclass
+class Shard():
+    shard_id: int
+    config: Dict[str, Any]
+    process: Any = None
+    conn: Any = None
+    reader: Optional[asyncio.Task] = None
+    # Consecutive restarts, drives the restart delay
+    restarts: int = 0
+    total_restarts: int = 0
+    started_at: float = 0.0
+    messages: int = 0
+    batches: int = 0
+
+
+class ShardSupervisor:
+    """
+    Runs producers in `shards` worker processes and forwards their messages
+    into data_queue, normally the main queue of the ConsumerPipeline.
+
+    Shards are checked every check_interval seconds, a dead shard is
+    restarted after restart_delay seconds, doubling on every restart up to
+    max_restart_delay. The delay resets once a shard stays up for
+    stable_after seconds.
+
+    Args:
+        config (Dict[str, Any]): Config with the structure of config/producers.yaml
+        shards (int): Number of worker processes
+        data_queue (asyncio.Queue): Queue messages are forwarded to
+        factory (ShardFactory): Coroutine function creating the producers of a shard,
+            must be importable from the worker (module level)
+        normalize (bool): Normalize in the workers, records are smaller to send
+        batch_size (int): Max messages per pipe write
+        flush_interval_ms (float): Max time a message waits for its batch to fill
+    """
+
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        shards: int,
+        data_queue: asyncio.Queue,
+        factory: ShardFactory = start_producers,
+        normalize: bool = True,
+        batch_size: int = 500,
+        flush_interval_ms: float = 10.0,
+        shard_queue_size: int = 100_000,
+        check_interval: float = 1.0,
+        restart_delay: float = 1.0,
+        max_restart_delay: float = 60.0,
+        stable_after: float = 60.0
+        ) -> None:
+        self.data_queue = data_queue
+        self.factory = factory
+        self.normalize = normalize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.shard_queue_size = shard_queue_size
+        self.check_interval = check_interval
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+
+        self.shards: Dict[int, Shard] = {
+            shard_id: Shard(shard_id, part)
+            for shard_id, part in enumerate(partition_config(config, shards))
+        }
+        self._ctx = multiprocessing.get_context("spawn")
+        self._executor = ThreadPoolExecutor(max_workers=len(self.shards) or 1, thread_name_prefix="shard-recv")
+        self._supervisor: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def start(self) -> None:
+        for shard in self.shards.values():
+            self._spawn(shard)
+        self._supervisor = asyncio.create_task(self.supervise(), name="shard_supervisor")
+
+    def _spawn(self, shard: Shard) -> None:
+        recv_conn, send_conn = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(
+            target=shard_main,
+            args=(
+                shard.shard_id, shard.config, send_conn, self.factory, self.normalize,
+                self.batch_size, self.flush_interval, self.shard_queue_size,
+            ),
+            name=f"shard-{shard.shard_id}",
+            daemon=True,
+        )
+        process.start()
+        # Only the child writes, closing our copy lets the reader see EOF when it dies
+        send_conn.close()
+        shard.process = process
+        shard.conn = recv_conn
+        shard.started_at = asyncio.get_running_loop().time()
+        shard.reader = asyncio.create_task(self._read(shard), name=f"shard-{shard.shard_id}-reader")
+        logger.info("Shard [%d] started with pid %s", shard.shard_id, process.pid)
+
+    async def _read(self, shard: Shard) -> None:
+        loop = asyncio.get_running_loop()
+        conn = shard.conn
+        intern = sys.intern
+        while True:
+            try:
+                payload = await loop.run_in_executor(self._executor, conn.recv_bytes)
+            except (EOFError, OSError):
+                if not self._stopping:
+                    logger.warning("Shard [%d] pipe closed", shard.shard_id)
+                return
+            batch = pickle.loads(payload)
+            shard.batches += 1
+            shard.messages += len(batch)
+            for message in batch:
+                message["producer"] = intern(message["producer"])
+                await self.data_queue.put(message)
+
+    async def supervise(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            await asyncio.sleep(self.check_interval)
+            for shard in self.shards.values():
+                if shard.process.is_alive() or self._stopping:
+                    continue
+                uptime = loop.time() - shard.started_at
+                if uptime >= self.stable_after:
+                    shard.restarts = 0
+                delay = min(self.restart_delay * 2 ** shard.restarts, self.max_restart_delay)
+                logger.error(
+                    "Shard [%d] died with exit code %s after %.1fs, restarting in %.1fs",
+                    shard.shard_id, shard.process.exitcode, uptime, delay
+                )
+                if shard.reader is not None:
+                    await shard.reader
+                shard.conn.close()
+                await asyncio.sleep(delay)
+                shard.restarts += 1
+                shard.total_restarts += 1
+                if not self._stopping:
+                    self._spawn(shard)
+
+    async def stop(self) -> None:
+        self._stopping = True
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            try:
+                await self._supervisor
+            except asyncio.CancelledError:
+                pass
+        for shard in self.shards.values():
+            if shard.process is not None and shard.process.is_alive():
+                shard.process.terminate()
+        for shard in self.shards.values():
+            if shard.process is not None:
+                await asyncio.get_running_loop().run_in_executor(None, shard.process.join, 5)
+            if shard.reader is not None:
+                await shard.reader
+            if shard.conn is not None:
+                shard.conn.close()
+        self._executor.shutdown(wait=False)
+        logger.info("All shards stopped")
+
+    def stats(self) -> Dict[int, Dict[str, Any]]:
+        return {
+            shard.shard_id: {
+                "pid": shard.process.pid if shard.process else None,
+                "alive": bool(shard.process and shard.process.is_alive()),
+                "restarts": shard.total_restarts,
+                "messages": shard.messages,
+                "batches": shard.batches,
+                "producers": sum(
+                    len(s["streams"]) for e in shard.config["exchanges"].values() for s in e["symbols"].values()
+                ),
+            }
+            for shard in self.shards.values()
+        }
@@ -0,0 +1,66 @@
+import logging
+
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class BaseStage(ABC):
+    """
+    A synchronous processing step run by the consumer delegator on every
+    message before it is routed to consumers.
+
+    process() returns the message to pass on (the same one, a replacement,
+    or None to drop it). Additional messages can be queued with emit(),
+    they are passed through the remaining stages right after the current
+    message. Stages run on the event loop and must not block.
+    """
+
+    def __init__(self, name: Optional[str] = None) -> None:
+        self.name = name or self.__class__.__name__
+        self.outbox: List[Dict[str, Any]] = []
+
+    def emit(self, message: Dict[str, Any]) -> None:
+        self.outbox.append(message)
+
+    @abstractmethod
+    def process(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        pass
+
+    def delta_streams(self) -> Tuple[str, ...]:
+        """
+        Streams this stage turns into deltas on top of earlier messages,
+        consumers must receive every message of them
+        """
+        return ()
+
+    def resync(self) -> None:
+        """
+        Called when a consumer lost messages of delta_streams, the next
+        message of every producer should let it rebuild its state
+        """
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {}
+
+
+def run_stages(stages: List[BaseStage], message: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Pass a message through stages in order, returns every message to route
+    """
+    messages = [message]
+    for stage in stages:
+        out = []
+        for item in messages:
+            result = stage.process(item)
+            if result is not None:
+                out.append(result)
+            if stage.outbox:
+                out.extend(stage.outbox)
+                stage.outbox.clear()
+        if not out:
+            return out
+        messages = out
+    return messages
@@ -0,0 +1,167 @@
+"""
+Stall detection for producers.
+
+A producer awaiting its stream method on a half-dead websocket stays
+RUNNING forever without receiving anything. StallWatchdog, run by the
+ProducerPipeline, checks every producer every check_interval seconds:
+
+  - The expected gap between messages is learned per producer as an
+    exponential moving average of the observed gaps, quiet streams learn
+    long gaps and busy streams short ones.
+  - A RUNNING producer is stalled when it has been silent for more than
+    stall_factor expected gaps, clamped to [min_stall_s, max_stall_s]
+    (max_stall_s until a gap has been learned).
+  - A stalled producer's subscription is restarted. When every running
+    producer of an exchange is stalled at once, the exchange's websocket
+    connections are closed first, the resubscriptions reconnect.
+
+A producer waiting on a full queue with the BLOCK policy is not silent,
+its consumers are slow, it is never restarted while it waits.
+
+Only the message counter, the time of the last message and the queue wait
+flag are read, the producers do no extra work per message.
+"""
+import time
+import asyncio
+import logging
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, TYPE_CHECKING
+
+from crypto_data_collector.helpers import Status
+
+if TYPE_CHECKING:
+    from crypto_data_collector.producer import DataProducer, ProducerPipeline
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class StreamActivity():
+    # Message count and time (ms) when the count last changed
+    count: int
+    mark: float
+    # Silence is counted from here at the earliest, e.g. after a restart
+    since: float
+    # Learned gap between messages (ms), None until the first messages
+    gap: Optional[float] = None
+
+
+class StallWatchdog:
+    """
+    Args:
+        check_interval (float): Seconds between checks
+        stall_factor (float): Silence of this many expected gaps is a stall
+        min_stall_s (float): Shortest silence considered a stall
+        max_stall_s (float): Longest silence tolerated, also used before a gap is learned
+        alpha (float): Weight of a new gap in the moving average
+    """
+
+    def __init__(
+        self,
+        check_interval: float = 1.0,
+        stall_factor: float = 10.0,
+        min_stall_s: float = 5.0,
+        max_stall_s: float = 120.0,
+        alpha: float = 0.2
+        ) -> None:
+        self.check_interval = check_interval
+        self.stall_factor = stall_factor
+        self.min_stall_s = min_stall_s
+        self.max_stall_s = max_stall_s
+        self.alpha = alpha
+        self.streams: Dict[str, StreamActivity] = {}
+        self.stalls = 0
+        self.connection_restarts = 0
+
+    def threshold_ms(self, activity: StreamActivity) -> float:
+        if activity.gap is None:
+            return self.max_stall_s * 1000
+        return min(max(self.stall_factor * activity.gap, self.min_stall_s * 1000), self.max_stall_s * 1000)
+
+    async def run(self, pipeline: "ProducerPipeline") -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.check(pipeline)
+            except Exception:
+                logger.exception("Stall check failed")
+
+    def find_stalled(self, producers: Dict[str, "DataProducer"], now: Optional[float] = None) -> List["DataProducer"]:
+        """
+        Update the learned gaps and return the stalled producers
+        """
+        if now is None:
+            now = time.time() * 1000
+        alpha = self.alpha
+        stalled = []
+        for name, producer in producers.items():
+            # Replay producers are not fed by a socket
+            if producer.exchange is None:
+                continue
+            activity = self.streams.get(name)
+            if activity is None:
+                self.streams[name] = StreamActivity(producer.messages, now, now)
+                continue
+            if producer.messages > activity.count:
+                gap = (now - activity.mark) / (producer.messages - activity.count)
+                activity.gap = gap if activity.gap is None else activity.gap + alpha * (gap - activity.gap)
+                activity.count = producer.messages
+                activity.mark = now
+                continue
+            if producer.state.status is not Status.RUNNING or producer.blocked_since is not None:
+                # Backing off, restarting or waiting on a full queue (slow
+                # consumers, not a dead socket), silence counts from when it runs again
+                activity.since = activity.mark = now
+                continue
+            silent = now - max(producer.last_message, activity.since)
+            if silent > self.threshold_ms(activity):
+                stalled.append(producer)
+        return stalled
+
+    async def check(self, pipeline: "ProducerPipeline") -> List["DataProducer"]:
+        producers = dict(pipeline.producers)
+        stalled = self.find_stalled(producers)
+        if not stalled:
+            return stalled
+
+        now = time.time() * 1000
+        by_exchange: Dict[int, List["DataProducer"]] = {}
+        for producer in stalled:
+            by_exchange.setdefault(id(producer.exchange), []).append(producer)
+        for exchange_stalled in by_exchange.values():
+            exchange = exchange_stalled[0].exchange
+            running = [
+                p for p in producers.values() if p.exchange is exchange and p.state.status is Status.RUNNING
+            ]
+            for producer in exchange_stalled:
+                activity = self.streams[producer.producer_name]
+                logger.warning(
+                    "Producer [%s] silent for %.1fs, expected a message every %s, restarting its subscription",
+                    producer.producer_name, (now - max(producer.last_message, activity.since)) / 1000,
+                    f"{activity.gap / 1000:.2f}s" if activity.gap is not None else "(not learned yet)"
+                )
+                activity.since = activity.mark = now
+                self.stalls += 1
+                pipeline.restart_producer(producer.producer_name, Status.STALLED)
+            if len(exchange_stalled) == len(running):
+                await self.restart_connection(exchange_stalled[0])
+        return stalled
+
+    async def restart_connection(self, producer: "DataProducer") -> None:
+        exchange: Any = producer.exchange
+        close = getattr(exchange, "close_ws_clients", None)
+        if close is None:
+            return
+        logger.warning("Every producer of exchange [%s] stalled, closing its websocket connections", producer.exchange_name)
+        self.connection_restarts += 1
+        try:
+            await close()
+        except Exception:
+            logger.exception("Error closing websocket connections of exchange [%s]", producer.exchange_name)
+
+    def forget(self, producer_name: str) -> None:
+        self.streams.pop(producer_name, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"stalls": self.stalls, "connection_restarts": self.connection_restarts}
@@ -0,0 +1,80 @@
+import asyncio
+
+import ccxt.pro
+import pytest
+
+from crypto_data_collector.producer import DataProducer
+from crypto_data_collector.queues import BoundedQueue
+
+PRODUCER = "binance|BTC/USDT|watchTrades"
+
+MARKETS = {
+    symbol: {
+        "id": symbol.replace("/", ""), "symbol": symbol, "base": symbol.split("/")[0], "quote": "USDT",
+        "baseId": symbol.split("/")[0], "quoteId": "USDT", "type": "spot", "spot": True, "active": True,
+    }
+    for symbol in ("BTC/USDT", "ETH/USDT")
+}
+
+
+def msg(data, producer=PRODUCER, received=5.0):
+    return {"data": data, "producer": producer, "received": received}
+
+
+def make_producer(
+    exchange=None, symbol="BTC/USDT", queue=None, stream_name="watchTicker", stream_method=None, normalizer=None,
+    **attributes
+):
+    """
+    DataProducer on a fake exchange, stream_method defaults to the exchange's
+    stream_name method. Extra keyword arguments are set on the producer,
+    e.g. base_delay=0.01
+    """
+    producer = DataProducer(
+        exchange_name=exchange.name if exchange is not None else "fake",
+        exchange=exchange,
+        symbol=symbol,
+        stream_name=stream_name,
+        stream_method=stream_method or getattr(exchange, stream_name),
+        stream_options={},
+        data_queue=queue if queue is not None else BoundedQueue(),
+        normalizer=normalizer,
+    )
+    for name, value in attributes.items():
+        setattr(producer, name, value)
+    return producer
+
+
+@pytest.fixture
+def load_markets_delay():
+    """
+    Seconds each offline load_markets takes, override in a test module to change it
+    """
+    return 0.0
+
+
+@pytest.fixture
+def offline(monkeypatch, load_markets_delay):
+    """
+    binance / kraken without network: load_markets returns MARKETS, tickers
+    and trades come every 10ms. Returns the exchange ids load_markets was called for
+    """
+    calls = []
+
+    async def load_markets(self, reload=False, params={}):
+        calls.append(self.id)
+        if load_markets_delay:
+            await asyncio.sleep(load_markets_delay)
+        return self.set_markets(MARKETS)
+
+    async def watch(self, symbol, params={}):
+        await asyncio.sleep(0.01)
+        return {"symbol": symbol, "last": 1.0}
+
+    for name in ("binance", "kraken"):
+        exchange_class = getattr(ccxt.pro, name)
+        monkeypatch.setattr(exchange_class, "load_markets", load_markets)
+        # ccxt adds the camelCase aliases to the class on first use
+        for method in ("watch_ticker", "watchTicker", "watch_trades", "watchTrades"):
+            monkeypatch.setattr(exchange_class, method, watch, raising=False)
+    return calls
@@ -0,0 +1,113 @@
+import asyncio
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.parquet as pq
+
+from crypto_data_collector.archival import ArchivalConsumer, sanitize
+from crypto_data_collector.dedupe import TradeGap
+from crypto_data_collector.orderbook import OrderBookEngine
+from crypto_data_collector.records import Normalizer
+
+DAY = 1_700_000_000_000
+PRODUCER = "binance|BTC/USDT:USDT|watchTrades"
+
+
+def trades_message(start, count, timestamp=DAY):
+    raw = [
+        {"id": str(i), "timestamp": timestamp + i, "price": 100.0 + i, "amount": 1.0, "side": "buy", "info": {}}
+        for i in range(start, start + count)
+    ]
+    return {"data": raw, "producer": PRODUCER, "received": float(timestamp)}
+
+
+def partition_files(root, stream="watchTrades", suffix="parquet"):
+    return sorted(root.glob(f"exchange=binance/symbol=BTC_USDT_USDT/stream={stream}/date=*/*.{suffix}"))
+
+
+async def test_writes_partitioned_parquet(tmp_path):
+    consumer = ArchivalConsumer(tmp_path, row_group_size=10)
+    await consumer.run_batch([trades_message(0, 25)])
+    await consumer.close()
+    [path] = partition_files(tmp_path)
+    assert path.parent.name == "date=2023-11-14"
+    table = pq.read_table(path)
+    assert table.num_rows == 25
+    assert table.column("id").to_pylist()[:3] == ["0", "1", "2"]
+    assert table.schema.field("price").type == pa.float64()
+
+
+async def test_rolls_by_row_count(tmp_path):
+    consumer = ArchivalConsumer(tmp_path, row_group_size=10, max_rows=20)
+    for start in range(0, 50, 10):
+        await consumer.run_batch([trades_message(start, 10)])
+    await consumer.close()
+    files = partition_files(tmp_path)
+    assert len(files) == 3
+    assert sum(pq.read_metadata(f).num_rows for f in files) == 50
+
+
+async def test_order_books_to_arrow_ipc(tmp_path):
+    consumer = ArchivalConsumer(tmp_path, file_format="arrow")
+    book = {"bids": [[100.0, 1.0]], "asks": [[101.0, 2.0], [102.0, 3.0]], "timestamp": DAY, "nonce": 1}
+    record = Normalizer().order_book("binance|BTC/USDT:USDT|watchOrderBook", book, float(DAY))
+    await consumer.run_batch([{"data": record, "producer": "binance|BTC/USDT:USDT|watchOrderBook"}])
+    await consumer.close()
+    [path] = partition_files(tmp_path, "watchOrderBook", "arrow")
+    table = pa.ipc.open_file(str(path)).read_all()
+    assert table.column("asks").to_pylist() == [[101.0, 2.0, 102.0, 3.0]]
+
+
+async def test_order_book_deltas_get_their_own_partition(tmp_path):
+    producer = "binance|BTC/USDT:USDT|watchOrderBook"
+    engine = OrderBookEngine()
+    normalizer = Normalizer()
+    batch = []
+    for nonce in range(1, 4):
+        book = {"bids": [[100.0, float(nonce)]], "asks": [[101.0, 2.0]], "timestamp": DAY + nonce, "nonce": nonce}
+        data = normalizer.order_book(producer, book, float(DAY))
+        batch.append(engine.process({"data": data, "producer": producer, "received": float(DAY)}))
+    batch.append({"data": TradeGap(producer, "id", float(DAY), 1, 5, 3), "producer": producer})
+    consumer = ArchivalConsumer(tmp_path)
+    await consumer.run_batch(batch)
+    await consumer.close()
+
+    [snapshots] = partition_files(tmp_path, "watchOrderBook")
+    assert pq.read_table(snapshots).column("nonce").to_pylist() == [1]
+    [deltas] = partition_files(tmp_path, "watchOrderBook_deltas")
+    table = pq.read_table(deltas)
+    assert table.column("prev_nonce").to_pylist() == [1, 2]
+    assert table.column("changes").to_pylist() == [[0.0, 100.0, 2.0], [0.0, 100.0, 3.0]]
+    assert consumer.skipped_by_type == {"TradeGap": 1}
+
+
+async def test_flushes_on_cancel(tmp_path):
+    consumer = ArchivalConsumer(tmp_path, batch_timeout_ms=10)
+    task = asyncio.create_task(consumer.start_loop())
+    consumer.data_queue.put_nowait(trades_message(0, 5))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    [path] = partition_files(tmp_path)
+    assert pq.read_metadata(path).num_rows == 5
+
+
+async def test_quiet_streams_are_written_and_rolled(tmp_path):
+    consumer = ArchivalConsumer(tmp_path, batch_timeout_ms=10, flush_interval_s=0.05, max_age_s=0.1)
+    task = asyncio.create_task(consumer.start_loop())
+    consumer.data_queue.put_nowait(trades_message(0, 5))
+    await asyncio.sleep(0.08)
+    assert consumer.rows_written == 5
+    await asyncio.sleep(0.1)
+    # Rolled by age without another message, the closed file is readable
+    assert consumer.partitions == {}
+    [path] = partition_files(tmp_path)
+    assert pq.read_metadata(path).num_rows == 5
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+def test_sanitize():
+    assert sanitize("BTC/USDT:USDT") == "BTC_USDT_USDT"
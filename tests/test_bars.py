@@ -0,0 +1,72 @@
+import pytest
+
+from crypto_data_collector.bars import BarAggregator, BarRecord, parse_timeframe
+from crypto_data_collector.records import Normalizer
+from crypto_data_collector.stages import run_stages
+from tests.conftest import PRODUCER, msg
+
+
+def trade(timestamp, price, amount=1.0):
+    return {"id": str(timestamp), "timestamp": timestamp, "price": price, "amount": amount, "side": "buy"}
+
+
+def test_parse_timeframe():
+    assert parse_timeframe("1s") == 1000
+    assert parse_timeframe("5m") == 300_000
+    assert parse_timeframe("1h") == 3_600_000
+    for bad in ("", "m", "0m", "5x", "-1m"):
+        with pytest.raises(ValueError):
+            parse_timeframe(bad)
+
+
+def test_builds_bars_and_closes_them_on_the_next_bar():
+    stage = BarAggregator(intervals=("1s", "1m"))
+    first = msg([trade(1000, 10.0, 1.0), trade(1200, 12.0, 2.0), trade(1500, 9.0, 1.0), trade(1900, 11.0, 1.0)])
+    out = run_stages([stage], first)
+    # Trades are passed on, no bar is closed yet
+    assert out == [first]
+
+    out = run_stages([stage], msg([trade(2100, 13.0)]))
+    assert len(out) == 2
+    bar = out[1]["data"]
+    assert isinstance(bar, BarRecord)
+    assert out[1]["producer"] == "binance|BTC/USDT|bars_1s"
+    assert (bar.timestamp, bar.open, bar.high, bar.low, bar.close) == (1000, 10.0, 12.0, 9.0, 11.0)
+    assert bar.volume == 5.0
+    assert bar.vwap == pytest.approx((10 + 24 + 9 + 11) / 5)
+    assert bar.trades == 4
+
+    # The minute bar holds every trade so far
+    out = run_stages([stage], msg([trade(60_000, 14.0)]))
+    minute = [m["data"] for m in out if m["producer"] == "binance|BTC/USDT|bars_1m"]
+    assert len(minute) == 1
+    assert (minute[0].timestamp, minute[0].open, minute[0].high, minute[0].close, minute[0].trades) == (0, 10.0, 13.0, 13.0, 5)
+    assert stage.stats() == {"streams": 1, "trades": 6, "bars": 3, "late": 0}
+
+
+def test_quiet_symbols_are_closed_by_the_sweep():
+    stage = BarAggregator(intervals=("1s",), grace_ms=500, sweep_interval_ms=100)
+    run_stages([stage], msg([trade(1000, 10.0)], received=1100.0))
+    # Another stream's message moves the clock past the bar's end + grace
+    ticker = {"data": {"last": 1.0}, "producer": "binance|BTC/USDT|watchTicker", "received": 2600.0}
+    out = run_stages([stage], ticker)
+    assert out[0] is ticker
+    assert out[1]["data"].timestamp == 1000
+    assert out[1]["received"] == 2600.0
+
+    # A late trade of the closed bar does not open it again
+    out = run_stages([stage], msg([trade(1800, 20.0)], received=2700.0))
+    assert len(out) == 1
+    assert stage.stats()["late"] == 1
+    assert stage.stats()["bars"] == 1
+
+
+def test_records_and_other_streams():
+    stage = BarAggregator(intervals=("1s",))
+    records = Normalizer().trades(PRODUCER, [trade(1000, 10.0), trade(2000, 11.0)], 5.0)
+    out = run_stages([stage], msg(records))
+    assert out[0]["data"] == records
+    assert out[1]["data"].close == 10.0
+    # Bar producers are not aggregated again
+    assert stage.process(out[1]) is out[1]
+    assert list(stage.states) == [PRODUCER]
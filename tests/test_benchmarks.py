@@ -0,0 +1,20 @@
+from benchmarks.pipeline import compare, run_benchmark
+
+
+async def test_pipeline_benchmark_smoke():
+    results = await run_benchmark(symbols=2, consumers=2, duration=0.2, warmup=0.05, depth=5)
+    assert results["produced_per_second"] > 0
+    assert results["consumed_per_second"] > results["produced_per_second"]
+    assert results["latency_ms"]["count"] > 0
+    assert results["peak_rss_mb"] > 0
+
+
+def test_compare_flags_regressions():
+    def report(rate, p99):
+        return {"results": {
+            "produced_per_second": rate, "consumed_per_second": rate,
+            "latency_ms": {"p99": p99}, "peak_rss_mb": 100.0,
+        }}
+    assert compare(report(1000.0, 1.0), report(1000.0, 1.0), 0.1) == []
+    assert compare(report(800.0, 1.0), report(1000.0, 1.0), 0.1) == ["produced_per_second", "consumed_per_second"]
+    assert compare(report(1000.0, 2.0), report(1000.0, 1.0), 0.1) == ["p99_ms"]
@@ -0,0 +1,212 @@
+import asyncio
+import pytest
+
+from crypto_data_collector.consumer import BaseConsumer, BatchConsumer, ConsumerPipeline
+from crypto_data_collector.helpers import Subscription
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.stages import BaseStage
+from tests.conftest import msg
+
+
+class CollectingConsumer(BaseConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = []
+
+    async def run(self):
+        while True:
+            data = await self.data_queue.get()
+            try:
+                self.received.append(data)
+            finally:
+                self.data_queue.task_done()
+
+
+async def run_pipeline(pipeline, messages, consumers):
+    for consumer in consumers:
+        pipeline.add_consumer(name=consumer.name, consumer=consumer)
+    delegator = asyncio.create_task(pipeline.consumer_delegator())
+    for message in messages:
+        await pipeline.get_data_queue().put(message)
+    await pipeline.get_data_queue().join()
+    for _ in range(10):
+        await asyncio.sleep(0)
+    delegator.cancel()
+    for consumer in consumers:
+        await pipeline.remove_consumer(consumer.name)
+
+
+async def test_delegator_fans_out_to_queues():
+    pipeline = ConsumerPipeline(data_queue=BoundedQueue())
+    consumers = [CollectingConsumer(name=f"c{i}") for i in range(3)]
+    messages = [msg(i, "x|BTC|watchTrades") for i in range(5)]
+    await run_pipeline(pipeline, messages, consumers)
+    for consumer in consumers:
+        assert consumer.received == messages
+
+
+async def test_delegator_fans_out_through_ring():
+    pipeline = ConsumerPipeline(data_queue=BoundedQueue(), ring_capacity=16)
+    consumers = [CollectingConsumer(name=f"c{i}") for i in range(3)]
+    messages = [msg(i, "x|BTC|watchTrades") for i in range(5)]
+    await run_pipeline(pipeline, messages, consumers)
+    for consumer in consumers:
+        assert consumer.received == messages
+    assert pipeline.ring.cursors == {}
+
+
+class StuckConsumer(BaseConsumer):
+    async def run(self):
+        await asyncio.Event().wait()
+
+
+async def test_ring_warns_about_ignored_queue_settings(caplog):
+    pipeline = ConsumerPipeline(data_queue=BoundedQueue(), ring_capacity=16)
+    pipeline.add_consumer(name="bounded", consumer=CollectingConsumer(name="bounded", maxsize=10))
+    pipeline.add_consumer(name="plain", consumer=CollectingConsumer(name="plain"))
+    warnings = [r.getMessage() for r in caplog.records if "overflow_policy have no effect" in r.getMessage()]
+    assert warnings == ["Consumer [bounded] maxsize and overflow_policy have no effect when reading from a ring"]
+    for name in ("bounded", "plain"):
+        await pipeline.remove_consumer(name)
+
+
+async def test_removing_a_blocked_consumer_unblocks_the_delegator():
+    pipeline = ConsumerPipeline(data_queue=BoundedQueue())
+    slow = StuckConsumer(name="slow", maxsize=1)
+    fast = CollectingConsumer(name="fast")
+    pipeline.add_consumer(name=slow.name, consumer=slow)
+    pipeline.add_consumer(name=fast.name, consumer=fast)
+    delegator = asyncio.create_task(pipeline.consumer_delegator())
+    for i in range(3):
+        await pipeline.get_data_queue().put(msg(i, "x|BTC|watchTrades"))
+    await asyncio.sleep(0.01)
+    # The delegator waits on the full queue of slow
+    assert len(fast.received) == 1
+
+    await pipeline.remove_consumer("slow")
+    for i in range(3, 5):
+        await pipeline.get_data_queue().put(msg(i, "x|BTC|watchTrades"))
+    await asyncio.wait_for(pipeline.get_data_queue().join(), 1)
+    await asyncio.sleep(0)
+    assert [m["data"] for m in fast.received] == [0, 1, 2, 3, 4]
+    delegator.cancel()
+    await pipeline.remove_consumer("fast")
+
+
+async def test_delegator_routes_by_subscription():
+    pipeline = ConsumerPipeline(data_queue=BoundedQueue())
+    everything = CollectingConsumer(name="everything")
+    trades = CollectingConsumer(name="trades", subscriptions=["*|*|watchTrades"])
+    binance = CollectingConsumer(name="binance", subscriptions=[Subscription(exchange="binance")])
+    messages = [
+        msg(1, "binance|BTC/USDT|watchTrades"),
+        msg(2, "bitmex|BTC/USD|watchTicker"),
+        msg(3, "bitmex|BTC/USD|watchTrades"),
+    ]
+    await run_pipeline(pipeline, messages, [everything, trades, binance])
+    assert everything.received == messages
+    assert [m["data"] for m in trades.received] == [1, 3]
+    assert [m["data"] for m in binance.received] == [1]
+
+
+async def test_ring_routes_by_subscription():
+    pipeline = ConsumerPipeline(data_queue=BoundedQueue(), ring_capacity=16)
+    tickers = CollectingConsumer(name="tickers", subscriptions=["*|BTC*|ticker"])
+    messages = [
+        msg(1, "binance|BTC/USDT|watchTrades"),
+        msg(2, "bitmex|BTC/USD|watchTicker"),
+        msg(3, "bitmex|ETH/USD|watchTicker"),
+    ]
+    await run_pipeline(pipeline, messages, [tickers])
+    assert [m["data"] for m in tickers.received] == [2]
+
+
+def test_subscription_from_config():
+    subscriptions = Subscription.from_config({"valid_streams": ["orderbook", "trades"]})
+    assert subscriptions == [
+        Subscription(stream="watchOrderBook"),
+        Subscription(stream="watchTrades"),
+    ]
+    assert Subscription.from_config(None) is None
+    assert Subscription.from_config({}) is None
+
+
+def test_subscription_parse():
+    assert Subscription.parse("binance") == Subscription(exchange="binance")
+    assert Subscription.parse("*|BTC/*|trades") == Subscription(symbol="BTC/*", stream="watchTrades")
+    assert Subscription.parse("binance|BTC/USDT").matches("binance|BTC/USDT|watchTicker")
+    assert not Subscription.parse("binance|BTC/USDT").matches("binance|BTC/USD|watchTicker")
+
+
+class CollectingBatchConsumer(BatchConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = []
+
+    async def run_batch(self, batch):
+        self.batches.append([m["data"] for m in batch])
+
+
+async def test_batch_consumer_batches_by_size():
+    consumer = CollectingBatchConsumer(batch_size=3, batch_timeout_ms=1000)
+    for i in range(7):
+        consumer.data_queue.put_nowait(msg(i, "x|BTC|watchTrades"))
+    task = asyncio.create_task(consumer.start_loop())
+    await asyncio.sleep(0.05)
+    assert consumer.batches == [[0, 1, 2], [3, 4, 5]]
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # The partial batch waiting for the timeout is handed over on cancel
+    assert consumer.batches == [[0, 1, 2], [3, 4, 5], [6]]
+    await asyncio.wait_for(consumer.data_queue.join(), 1)
+
+
+async def test_batch_consumer_flushes_on_timeout():
+    consumer = CollectingBatchConsumer(batch_size=100, batch_timeout_ms=20)
+    task = asyncio.create_task(consumer.start_loop())
+    consumer.data_queue.put_nowait(msg(0, "x|BTC|watchTrades"))
+    consumer.data_queue.put_nowait(msg(1, "x|BTC|watchTrades"))
+    await asyncio.sleep(0.1)
+    assert consumer.batches == [[0, 1]]
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+class DoublingStage(BaseStage):
+    def process(self, message):
+        if message["data"] == 0:
+            return None
+        self.emit(msg(message["data"] * 10, message["producer"]))
+        return message
+
+
+async def test_stages_transform_before_routing():
+    pipeline = ConsumerPipeline(data_queue=BoundedQueue())
+    pipeline.add_stage(DoublingStage())
+    consumer = CollectingConsumer(name="c")
+    messages = [msg(i, "x|BTC|watchTrades") for i in range(3)]
+    await run_pipeline(pipeline, messages, [consumer])
+    assert [m["data"] for m in consumer.received] == [1, 10, 2, 20]
+
+
+async def test_consumer_conflates_selected_streams():
+    pipeline = ConsumerPipeline(data_queue=BoundedQueue())
+    consumer = CollectingConsumer(name="latest", conflate_streams=["ticker", "watchOrderBook"])
+    pipeline.add_consumer(name=consumer.name, consumer=consumer)
+    # Pause the consumer so updates pile up behind it
+    consumer.task.cancel()
+    await asyncio.sleep(0)
+    for i in range(5):
+        await pipeline.dispatch(msg(i, "x|BTC|watchTicker"))
+        await pipeline.dispatch(msg(i, "x|BTC|watchTrades"))
+        await pipeline.dispatch(msg(i, "x|BTC|watchOrderBook"))
+    queue = consumer.data_queue
+    items = [queue.get_nowait() for _ in range(queue.qsize())]
+    # One pending ticker and book, holding the latest update, every trade kept
+    assert [(m["producer"].split("|")[-1], m["data"]) for m in items] == [
+        ("watchTicker", 4), ("watchTrades", 0), ("watchOrderBook", 4),
+        ("watchTrades", 1), ("watchTrades", 2), ("watchTrades", 3), ("watchTrades", 4),
+    ]
+    assert queue.stats()["conflated_by_key"] == {"x|BTC|watchTicker": 4, "x|BTC|watchOrderBook": 4}
@@ -0,0 +1,153 @@
+import json
+import asyncio
+
+import pytest
+
+from crypto_data_collector.consumer import BaseConsumer, ConsumerPipeline
+from crypto_data_collector.control import ControlPlane
+from crypto_data_collector.producer import ProducerPipeline
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.registry import Registry
+from crypto_data_collector.server import Request
+
+
+KEY = "binance%7CBTC%2FUSDT%7CwatchTicker"
+
+
+class NullConsumer(BaseConsumer):
+    async def run(self):
+        while True:
+            self.mark_consumed(await self.data_queue.get())
+            self.data_queue.task_done()
+
+
+@pytest.fixture
+async def control(offline):
+    queue = BoundedQueue()
+    producer_pipeline = ProducerPipeline(queue, watch_stalls=False)
+    consumer_pipeline = ConsumerPipeline(queue)
+    delegator = asyncio.create_task(consumer_pipeline.consumer_delegator())
+    control = ControlPlane(
+        Registry(fast_json=False), producer_pipeline, consumer_pipeline, consumer_factories={"null": NullConsumer}
+    )
+    control.build_server()
+    yield control
+    delegator.cancel()
+    for name in list(consumer_pipeline.consumers):
+        await consumer_pipeline.remove_consumer(name)
+    await producer_pipeline.stop_pipeline()
+
+
+async def call(control, method, path, body=None, headers=None):
+    path, _, query = path.partition("?")
+    if headers is None:
+        headers = {"content-type": "application/json"}
+    request = Request(
+        method, path, dict(q.split("=") for q in query.split("&") if q),
+        headers=headers, body=json.dumps(body).encode() if body else b""
+    )
+    response = await control.server.dispatch(request)
+    return response.status, json.loads(response.body)
+
+
+async def test_add_list_and_remove_producers(control):
+    status, body = await call(
+        control, "POST", "/producers", {"exchange": "binance", "symbol": "BTC/USDT", "stream": "watchTicker"}
+    )
+    assert status == 201
+    assert body["producer"] == "binance|BTC/USDT|watchTicker"
+    status, _ = await call(
+        control, "POST", "/producers", {"exchange": "binance", "symbol": "BTC/USDT", "stream": "watchTicker"}
+    )
+    assert status == 409
+
+    await asyncio.sleep(0.1)
+    status, [producer] = await call(control, "GET", "/producers")
+    assert status == 200
+    assert producer["state"]["status"] == "running"
+    assert producer["messages"] > 0
+    assert producer["idle_ms"] is not None
+    status, body = await call(control, "GET", f"/producers/{KEY}")
+    assert body["messages"] >= producer["messages"]
+
+    status, streams = await call(control, "GET", "/streams?exchange=binance")
+    assert streams == [{"producer": "binance|BTC/USDT|watchTicker", "running": True, "options": {}}]
+
+    status, body = await call(control, "DELETE", f"/producers/{KEY}")
+    assert status == 200
+    assert control.producer_pipeline.producers == {}
+    assert not control.registry.stream_registered("watchTicker", "BTC/USDT", "binance")
+    assert (await call(control, "GET", f"/producers/{KEY}"))[0] == 404
+    assert (await call(control, "DELETE", f"/producers/{KEY}"))[0] == 404
+
+
+async def test_invalid_producer_requests(control):
+    assert (await call(control, "POST", "/producers", {"exchange": "binance"}))[0] == 400
+    status, body = await call(
+        control, "POST", "/producers", {"exchange": "binance", "symbol": "DOGE/USDT", "stream": "watchTicker"}
+    )
+    assert status == 400
+    assert "DOGE/USDT" in body["error"]
+    assert control.producer_pipeline.producers == {}
+
+
+async def test_add_and_remove_consumers(control):
+    status, _ = await call(
+        control, "POST", "/consumers", {"name": "trades", "factory": "null", "options": {"subscriptions": ["*|*|trades"]}}
+    )
+    assert status == 201
+    assert (await call(control, "POST", "/consumers", {"name": "trades", "factory": "null"}))[0] == 409
+    assert (await call(control, "POST", "/consumers", {"name": "x", "factory": "nope"}))[0] == 400
+
+    status, [consumer] = await call(control, "GET", "/consumers")
+    assert consumer["consumer"] == "trades"
+    assert consumer["subscriptions"] == ["*|*|watchTrades"]
+    assert consumer["queue"]["size"] == 0
+
+    assert (await call(control, "DELETE", "/consumers/trades"))[0] == 200
+    assert control.consumer_pipeline.consumers == {}
+    assert (await call(control, "DELETE", "/consumers/trades"))[0] == 404
+
+
+async def test_refuses_unsafe_requests(control):
+    ticker = {"exchange": "binance", "symbol": "BTC/USDT", "stream": "watchTicker"}
+    assert (await call(control, "POST", "/producers", ticker, headers={"content-type": "text/plain"}))[0] == 415
+    status, _ = await call(
+        control, "POST", "/producers", ticker,
+        headers={"content-type": "application/json", "origin": "https://example.com"}
+    )
+    assert status == 403
+    assert (await call(control, "DELETE", f"/producers/{KEY}", headers={"origin": "https://example.com"}))[0] == 403
+
+    status, body = await call(
+        control, "POST", "/producers", {**ticker, "properties": {"hostname": "example.com"}}
+    )
+    assert status == 400
+    assert "hostname" in body["error"]
+    status, body = await call(
+        control, "POST", "/consumers", {"name": "x", "factory": "null", "options": {"root_dir": "/tmp"}}
+    )
+    assert status == 400
+    assert "root_dir" in body["error"]
+    assert control.producer_pipeline.producers == {}
+    assert control.consumer_pipeline.consumers == {}
+
+
+async def test_properties_of_a_registered_exchange_conflict(control):
+    ticker = {"exchange": "binance", "symbol": "BTC/USDT", "stream": "watchTicker", "properties": {"timeout": 5000}}
+    assert (await call(control, "POST", "/producers", ticker))[0] == 201
+    trades = {**ticker, "stream": "watchTrades"}
+    assert (await call(control, "POST", "/producers", trades))[0] == 201
+    status, body = await call(control, "POST", "/producers", {**ticker, "symbol": "ETH/USDT", "properties": {"timeout": 1}})
+    assert status == 409
+    assert "binance" in body["error"]
+    assert sorted(control.producer_pipeline.producers) == ["binance|BTC/USDT|watchTicker", "binance|BTC/USDT|watchTrades"]
+
+
+async def test_token_is_required_when_set(control):
+    control.token = "secret"
+    assert (await call(control, "GET", "/producers"))[0] == 401
+    headers = {"content-type": "application/json", "authorization": "Bearer wrong"}
+    assert (await call(control, "GET", "/producers", headers=headers))[0] == 401
+    headers["authorization"] = "Bearer secret"
+    assert (await call(control, "GET", "/producers", headers=headers)) == (200, [])
@@ -0,0 +1,74 @@
+from crypto_data_collector.dedupe import TradeDeduplicator, TradeGap
+from crypto_data_collector.records import Normalizer
+from crypto_data_collector.stages import run_stages
+from tests.conftest import PRODUCER, msg
+
+
+def trade(trade_id, timestamp=None, price=100.0):
+    return {"id": None if trade_id is None else str(trade_id), "timestamp": timestamp or 1000 + int(trade_id or 0),
+            "price": price, "amount": 1.0, "side": "buy"}
+
+
+def test_drops_repeated_trades():
+    stage = TradeDeduplicator()
+    first = msg([trade(1), trade(2), trade(3)])
+    assert stage.process(first) is first
+
+    # Overlap after a re-subscribe, only the new trade is passed on
+    out = stage.process(msg([trade(2), trade(3), trade(4)]))
+    assert [t["id"] for t in out["data"]] == ["4"]
+    assert stage.process(msg([trade(3), trade(4)])) is None
+    assert stage.stats()["duplicates"] == 4
+
+    # Trades without id are keyed by their fields
+    assert stage.process(msg([trade(None, 5000)]))["data"]
+    assert stage.process(msg([trade(None, 5000)])) is None
+
+
+def test_records_and_other_streams():
+    stage = TradeDeduplicator()
+    records = Normalizer().trades(PRODUCER, [trade(1), trade(2)], 5.0)
+    assert stage.process(msg(records))["data"] == records
+    assert stage.process(msg(records)) is None
+    ticker = {"data": {"last": 1.0}, "producer": "binance|BTC/USDT|watchTicker", "received": 5.0}
+    assert stage.process(ticker) is ticker
+
+
+def test_window_is_bounded():
+    stage = TradeDeduplicator(window=10, learn_ids=0)
+    for i in range(1000):
+        stage.process(msg([trade(i)]))
+    window = stage.windows[PRODUCER]
+    assert len(window.keys) == len(window.order) == 10
+    # Evicted ids are not remembered anymore
+    assert stage.process(msg([trade(5)])) is not None
+    assert stage.process(msg([trade(995)])) is None
+
+
+def test_reports_id_gaps_once_ids_are_sequential():
+    stage = TradeDeduplicator(learn_ids=3, max_time_gap_ms=None)
+    # Not yet learned, a jump is not a gap
+    out = run_stages([stage], msg([trade(1), trade(2), trade(3), trade(4)]))
+    assert len(out) == 1
+    out = run_stages([stage], msg([trade(5), trade(9)]))
+    assert len(out) == 2
+    gap = out[1]["data"]
+    assert isinstance(gap, TradeGap)
+    assert (gap.kind, gap.first, gap.last, gap.missing) == ("id", 5, 9, 3)
+    assert out[1]["producer"] == PRODUCER
+    assert stage.stats()["missing_ids"] == 3
+
+    # Non consecutive ids never report id gaps
+    other = "kraken|BTC/USD|watchTrades"
+    out = run_stages([stage], msg([trade(10), trade(20), trade(21), trade(22), trade(23), trade(40)], producer=other))
+    assert len(out) == 1
+    assert stage.windows[other].sequential is False
+
+
+def test_reports_time_gaps():
+    stage = TradeDeduplicator(max_time_gap_ms=1000, learn_ids=0)
+    out = run_stages([stage], msg([trade(1, 1000), trade(2, 1500), trade(3, 4000)]))
+    assert len(out) == 2
+    gap = out[1]["data"]
+    assert (gap.kind, gap.first, gap.last, gap.missing) == ("time", 1500, 4000, None)
+    assert stage.stats()["time_gaps"] == 1
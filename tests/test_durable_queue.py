@@ -0,0 +1,163 @@
+import asyncio
+
+from array import array
+
+import pytest
+
+from crypto_data_collector.consumer import BatchConsumer
+from crypto_data_collector.durable_queue import RECORD, SEGMENT_HEADER, DurableQueue
+from crypto_data_collector.records import Normalizer, TickerRecord
+from tests.conftest import msg
+
+
+def drain(queue, count):
+    return [queue.get_nowait()["data"] for _ in range(count)]
+
+
+@pytest.mark.parametrize("serializer", ["json", "msgpack"])
+def test_spills_past_memory_items_in_order(tmp_path, serializer):
+    pytest.importorskip(serializer)
+    queue = DurableQueue(tmp_path, memory_items=3, serializer=serializer)
+    for i in range(10):
+        queue.put_nowait(msg(i))
+    stats = queue.stats()
+    assert (stats["size"], stats["memory"], stats["spilled"]) == (10, 3, 7)
+    assert drain(queue, 5) == [0, 1, 2, 3, 4]
+    # Memory is only used again once the spilled messages are read back
+    queue.put_nowait(msg(10))
+    assert queue.stats()["memory"] == 0
+    assert drain(queue, 6) == [5, 6, 7, 8, 9, 10]
+    assert queue.empty()
+    queue.close()
+
+
+def test_recovers_unacknowledged_messages(tmp_path):
+    queue = DurableQueue(tmp_path, memory_items=2)
+    for i in range(6):
+        queue.put_nowait(msg(i))
+    assert drain(queue, 3) == [0, 1, 2]
+    queue.task_done()
+    queue.task_done()
+    assert queue.committed == 2
+    queue.close()
+
+    # Offset 2 was handed out but not acknowledged, it is delivered again
+    queue = DurableQueue(tmp_path, memory_items=2)
+    assert queue.recovered == 4
+    queue.put_nowait(msg(6))
+    assert drain(queue, 5) == [2, 3, 4, 5, 6]
+    assert queue.last_offset == 6
+    queue.ack(4)
+    queue.close()
+
+    queue = DurableQueue(tmp_path)
+    assert drain(queue, 2) == [5, 6]
+    with pytest.raises(ValueError):
+        queue.ack(7)
+    queue.close()
+
+
+@pytest.mark.parametrize("serializer", ["json", "msgpack"])
+def test_records_read_from_disk_are_records(tmp_path, serializer):
+    pytest.importorskip(serializer)
+    normalizer = Normalizer()
+    ticker = normalizer.ticker("binance|BTC/USDT|watchTicker", {"bid": 1.0, "bidVolume": 2.0}, 5.0)
+    book = normalizer.order_book("binance|BTC/USDT|watchOrderBook", {"bids": [[1.0, 2.0]], "asks": []}, 5.0)
+    trades = normalizer.trades("binance|BTC/USDT|watchTrades", [{"id": "1", "price": 1.0, "amount": 2.0}], 5.0)
+    queue = DurableQueue(tmp_path, memory_items=1, serializer=serializer)
+    for data in (ticker, book, trades):
+        queue.put_nowait(msg(data))
+    # The first from memory, the others spilled and read back from disk
+    assert drain(queue, 3) == [ticker, book, trades]
+    queue.close()
+
+    queue = DurableQueue(tmp_path, serializer=serializer)
+    recovered = drain(queue, 3)
+    assert recovered == [ticker, book, trades]
+    assert type(recovered[0]) is TickerRecord and recovered[0].bid_volume == 2.0
+    assert recovered[1].bids == array("d", [1.0, 2.0])
+    queue.close()
+
+
+def test_acknowledged_segments_are_deleted(tmp_path):
+    queue = DurableQueue(tmp_path, segment_bytes=256, memory_items=0)
+    for i in range(50):
+        queue.put_nowait(msg(i))
+    segments = queue.stats()["segments"]
+    assert segments > 5
+    assert drain(queue, 50) == list(range(50))
+    for _ in range(40):
+        queue.task_done()
+    assert 1 < queue.stats()["segments"] < segments
+    for _ in range(10):
+        queue.task_done()
+    assert len(list(tmp_path.glob("*.seg"))) == 1
+    queue.close()
+
+
+@pytest.mark.parametrize("serializer", ["json", "msgpack"])
+def test_drains_spilled_segments_while_acknowledging(tmp_path, serializer):
+    queue = DurableQueue(tmp_path, memory_items=0, segment_bytes=200, serializer=serializer)
+    for i in range(30):
+        queue.put_nowait(msg(i))
+    assert queue.stats()["segments"] > 3
+    received = []
+    while not queue.empty():
+        received.append(queue.get_nowait()["data"])
+        queue.task_done()
+    assert received == list(range(30))
+    assert len(list(tmp_path.glob("*.seg"))) == 1
+
+    # Spills again into the kept segment and past it
+    for i in range(30, 40):
+        queue.put_nowait(msg(i))
+    assert drain(queue, 10) == list(range(30, 40))
+    queue.close()
+
+
+def test_torn_record_ends_recovery(tmp_path):
+    queue = DurableQueue(tmp_path, serializer="json")
+    for i in range(3):
+        queue.put_nowait(msg(i))
+    segment = queue.segments[-1]
+    # Corrupt the payload of the last record, as if the process died mid write
+    position = SEGMENT_HEADER.size
+    for _ in range(2):
+        _, length, _ = RECORD.unpack_from(segment.map, position)
+        position += RECORD.size + length
+    segment.map[position + RECORD.size] ^= 0xFF
+    queue.close()
+
+    queue = DurableQueue(tmp_path)
+    assert queue.recovered == 2
+    queue.put_nowait(msg(3))
+    assert drain(queue, 3) == [0, 1, 3]
+    queue.close()
+
+
+class CollectingBatchConsumer(BatchConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = []
+
+    async def run_batch(self, batch):
+        self.batches.append([m["data"] for m in batch])
+        await asyncio.Event().wait()
+
+
+async def test_batch_consumer_resumes_after_cancel(tmp_path):
+    consumer = CollectingBatchConsumer(batch_size=3, durable_dir=tmp_path)
+    for i in range(5):
+        consumer.data_queue.put_nowait(msg(i))
+    task = asyncio.create_task(consumer.start_loop())
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    # The durable queue is not drained on cancel, the interrupted batch was never acknowledged
+    assert consumer.batches == [[0, 1, 2]]
+    consumer.data_queue.close()
+
+    restarted = CollectingBatchConsumer(batch_size=10, durable_dir=tmp_path)
+    assert drain(restarted.data_queue, 5) == [0, 1, 2, 3, 4]
+    restarted.data_queue.close()
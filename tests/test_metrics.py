@@ -0,0 +1,144 @@
+import time
+import asyncio
+
+from crypto_data_collector.consumer import BatchConsumer, ConsumerPipeline
+from crypto_data_collector.metrics import LATENCY_BUCKETS_MS, SAMPLE_EVERY, Histogram, MetricsCollector, RateMeter, exchange_timestamp
+from crypto_data_collector.producer import DataProducer, ProducerPipeline
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.records import OHLCVRecord, TradeRecord
+
+
+def test_histogram_relative_error():
+    histogram = Histogram()
+    for value in range(1, 10001):
+        histogram.record(float(value))
+    assert histogram.count == 10000
+    for q, exact in ((50, 5000), (90, 9000), (99, 9900)):
+        assert abs(histogram.percentile(q) - exact) / exact <= 1 / 8
+    assert histogram.percentile(100) == 10000
+    buckets = histogram.buckets()
+    assert buckets[-1][1] == 10000
+    assert [b for b, _ in buckets] == sorted(b for b, _ in buckets)
+
+
+def test_histogram_cumulative_fixed_bounds():
+    histogram = Histogram()
+    for value in (0.5, 1.0, 3.0, 40.0, 70000.0):
+        histogram.record(value)
+    assert histogram.cumulative((1, 2.5, 5, 10, 50)) == [2, 2, 3, 3, 4]
+    assert Histogram().cumulative((1, 10)) == [0, 0]
+
+
+def test_histogram_clamps_negative_and_merges():
+    a, b = Histogram(), Histogram()
+    a.record(-5.0)
+    b.record(2.0)
+    a.merge(b)
+    assert a.count == 2
+    assert a.percentile(50) <= 0.002
+    assert a.max == 2.0
+
+
+def test_exchange_timestamp():
+    trade = TradeRecord("p", "1", 100, 0.0, 1.0, 1.0, "buy", None)
+    assert exchange_timestamp([trade]) == 100
+    assert exchange_timestamp({"timestamp": 5}) == 5
+    assert exchange_timestamp([OHLCVRecord("p", 1, 0.0, 1.0, 1.0, 1.0, 1.0, 1.0)]) is None
+    assert exchange_timestamp([[1, 2, 3, 4, 5, 6]]) is None
+    assert exchange_timestamp([]) is None
+
+
+def test_rate_meter():
+    meter = RateMeter(min_interval=1.0)
+    assert meter.rate("a", 0, now=0.0) == 0.0
+    assert meter.rate("a", 50, now=0.5) == 0.0
+    assert meter.rate("a", 200, now=2.0) == 100.0
+    assert meter.rate("a", 300, now=2.5) == 100.0
+
+
+class NullBatchConsumer(BatchConsumer):
+    async def run_batch(self, batch):
+        pass
+
+
+async def test_collector_reads_producer_and_consumer_counters():
+    queue = BoundedQueue(maxsize=100)
+    now = time.time() * 1000
+    payloads = [{"timestamp": now - 10, "last": float(i)} for i in range(SAMPLE_EVERY * 2)]
+
+    async def stream_method(symbol, **kwargs):
+        if payloads:
+            return payloads.pop(0)
+        await asyncio.Event().wait()
+
+    producer_pipeline = ProducerPipeline(data_queue=queue)
+    consumer_pipeline = ConsumerPipeline(data_queue=queue)
+    producer = DataProducer("fake", None, "BTC/USDT", "watchTicker", stream_method, {}, queue)
+    consumer = NullBatchConsumer(name="batch", batch_size=8, batch_timeout_ms=1)
+    consumer_pipeline.add_consumer(name="batch", consumer=consumer)
+    delegator = asyncio.create_task(consumer_pipeline.consumer_delegator())
+    producer_pipeline.add_producer(producer.producer_name, producer)
+    while consumer.consumed < SAMPLE_EVERY * 2:
+        await asyncio.sleep(0.001)
+
+    collector = MetricsCollector(producer_pipeline, consumer_pipeline)
+    snapshot = collector.snapshot()
+    stats = snapshot["producers"]["fake|BTC/USDT|watchTicker"]
+    assert stats["messages"] == SAMPLE_EVERY * 2
+    assert stats["latency_ms"]["count"] == 2
+    assert 8 <= stats["latency_ms"]["p50"] <= 1000
+    assert stats["bytes"] > 0
+    assert snapshot["consumers"]["batch"]["consumed"] == SAMPLE_EVERY * 2
+    assert snapshot["consumers"]["batch"]["latency_ms"]["count"] == 2
+    assert snapshot["queue"]["high_water"] >= 1
+
+    text = collector.render()
+    assert '# TYPE crypto_collector_producer_messages_total counter' in text
+    labels = 'exchange="fake",symbol="BTC/USDT",stream="watchTicker"'
+    assert f'crypto_collector_producer_messages_total{{{labels}}} {SAMPLE_EVERY * 2}' in text
+    assert f'crypto_collector_producer_latency_ms_count{{{labels}}} 2' in text
+    assert f'crypto_collector_producer_latency_ms_bucket{{{labels},le="+Inf"}} 2' in text
+    # Every fixed bucket is exported, cumulative up to +Inf
+    buckets = [line for line in text.splitlines() if line.startswith(f"crypto_collector_producer_latency_ms_bucket{{{labels}")]
+    assert len(buckets) == len(LATENCY_BUCKETS_MS) + 1
+    counts = [int(line.rsplit(" ", 1)[1]) for line in buckets]
+    assert counts == sorted(counts)
+    assert f'crypto_collector_producer_status{{{labels},status="running"}} 1' in text
+    assert text.count("crypto_collector_producer_status{") == 1
+    assert 'crypto_collector_consumer_messages_total{consumer="batch"} 32' in text
+
+    delegator.cancel()
+    await consumer_pipeline.remove_consumer("batch")
+    producer.task.cancel()
+
+
+async def test_metrics_endpoint_over_http():
+    collector = MetricsCollector(ProducerPipeline(data_queue=BoundedQueue()))
+    server = await collector.serve(port=0)
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        assert response.startswith(b"HTTP/1.1 200 OK")
+        assert b"crypto_collector_queue_size 0" in response
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(b"GET /nope HTTP/1.1\r\n\r\n")
+        assert (await reader.read()).startswith(b"HTTP/1.1 404")
+        writer.close()
+
+        for length in (b"-1", b"abc"):
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(b"POST /metrics HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\n")
+            assert (await reader.read()).startswith(b"HTTP/1.1 400")
+            writer.close()
+
+        # A client that stops mid request is answered and disconnected
+        server.read_timeout = 0.05
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(b"POST /metrics HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc")
+        assert (await asyncio.wait_for(reader.read(), 1)).startswith(b"HTTP/1.1 408 Request Timeout")
+        writer.close()
+    finally:
+        await server.stop()
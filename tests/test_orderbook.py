@@ -0,0 +1,171 @@
+import random
+import asyncio
+
+import pytest
+
+from crypto_data_collector.consumer import BaseConsumer, ConsumerPipeline
+from crypto_data_collector.orderbook import (
+    LocalOrderBook, OrderBookDelta, OrderBookEngine, OrderBookReplica
+)
+from crypto_data_collector.queues import BoundedQueue, OverflowPolicy
+from crypto_data_collector.records import Normalizer, OrderBookRecord
+from crypto_data_collector.stages import run_stages
+from tests.conftest import msg
+
+PRODUCER = "binance|BTC/USDT|watchOrderBook"
+
+
+def book(bids, asks, nonce):
+    return {"bids": [list(l) for l in bids], "asks": [list(l) for l in asks], "nonce": nonce, "timestamp": nonce}
+
+
+def test_local_book_queries():
+    local = LocalOrderBook()
+    local.load([(100.0, 1.0), (99.0, 2.0), (101.0, 0.5)], [(103.0, 1.0), (102.0, 3.0)])
+    assert local.best_bid() == (101.0, 0.5)
+    assert local.best_ask() == (102.0, 3.0)
+    assert local.mid() == 101.5
+    assert local.spread() == 1.0
+    assert local.top(2) == {"bids": [(101.0, 0.5), (100.0, 1.0)], "asks": [(102.0, 3.0), (103.0, 1.0)]}
+    local.bids.set(101.0, 0.0)
+    assert local.best_bid() == (100.0, 1.0)
+
+
+def test_engine_emits_snapshot_then_deltas():
+    engine = OrderBookEngine(snapshot_interval=100)
+    first = engine.process(msg(book([(100.0, 1.0), (99.0, 1.0)], [(101.0, 1.0)], 1), PRODUCER))
+    assert isinstance(first["data"], OrderBookRecord)
+
+    second = engine.process(msg(book([(100.0, 2.0)], [(101.0, 1.0), (102.0, 5.0)], 2), PRODUCER))
+    delta = second["data"]
+    assert isinstance(delta, OrderBookDelta)
+    assert sorted(zip(*[iter(delta.changes)] * 3)) == [(0.0, 99.0, 0.0), (0.0, 100.0, 2.0), (1.0, 102.0, 5.0)]
+    assert delta.prev_nonce == 1 and delta.nonce == 2
+
+    # Identical book, nothing to send
+    assert engine.process(msg(book([(100.0, 2.0)], [(101.0, 1.0), (102.0, 5.0)], 3), PRODUCER)) is None
+    assert engine.stats()["unchanged"] == 1
+
+
+def test_engine_passes_other_streams():
+    engine = OrderBookEngine()
+    message = msg([{"id": 1}], "binance|BTC/USDT|watchTrades")
+    assert engine.process(message) is message
+
+
+def test_engine_drops_out_of_order_and_resyncs():
+    engine = OrderBookEngine()
+    engine.process(msg(book([(100.0, 1.0)], [(101.0, 1.0)], 5), PRODUCER))
+    assert engine.process(msg(book([(100.0, 3.0)], [(101.0, 1.0)], 4), PRODUCER)) is None
+    assert engine.out_of_order == 1
+    resync = engine.process(msg(book([(100.0, 3.0)], [(101.0, 1.0)], 6), PRODUCER))
+    assert isinstance(resync["data"], OrderBookRecord)
+
+
+def test_engine_periodic_snapshots():
+    engine = OrderBookEngine(snapshot_interval=3)
+    types = [
+        type(engine.process(msg(book([(100.0, float(i + 1))], [(101.0, 1.0)], i), PRODUCER))["data"])
+        for i in range(7)
+    ]
+    assert types == [OrderBookRecord, OrderBookDelta, OrderBookRecord, OrderBookDelta, OrderBookDelta, OrderBookRecord, OrderBookDelta]
+    with pytest.raises(ValueError):
+        OrderBookEngine(snapshot_interval=0)
+
+
+def test_replica_tracks_engine_with_checksums():
+    rng = random.Random(7)
+    engine = OrderBookEngine(snapshot_interval=50)
+    replica = OrderBookReplica(PRODUCER)
+    normalizer = Normalizer()
+    bids = {100.0 - i: 1.0 for i in range(20)}
+    asks = {101.0 + i: 1.0 for i in range(20)}
+    for nonce in range(1, 300):
+        for side in (bids, asks):
+            price = rng.choice(list(side))
+            if rng.random() < 0.2 and len(side) > 5:
+                del side[price]
+            else:
+                side[price] = round(rng.random() * 10, 3)
+        raw = book(sorted(bids.items(), reverse=True), sorted(asks.items()), nonce)
+        # Normalized and raw order books are both accepted
+        data = normalizer.order_book(PRODUCER, raw, 1.0) if nonce % 2 else raw
+        out = engine.process(msg(data, PRODUCER))
+        if out is not None:
+            assert replica.apply(out["data"])
+        assert replica.top(25) == engine.book(PRODUCER).top(25)
+    assert replica.checksum_errors == 0
+
+
+def test_replica_rejects_bad_checksum():
+    replica = OrderBookReplica()
+    engine = OrderBookEngine()
+    replica.apply(engine.process(msg(book([(100.0, 1.0)], [(101.0, 1.0)], 1), PRODUCER))["data"])
+    delta = engine.process(msg(book([(100.0, 2.0)], [(101.0, 1.0)], 2), PRODUCER))["data"]
+    delta.checksum += 1
+    assert not replica.apply(delta)
+    assert replica.checksum_errors == 1
+    assert not replica.synced
+
+
+class StoppedConsumer(BaseConsumer):
+    # Never reads, updates pile up in its queue
+    async def run(self):
+        await asyncio.Event().wait()
+
+
+async def test_consumers_never_conflate_or_drop_deltas():
+    pipeline = ConsumerPipeline(data_queue=BoundedQueue())
+    pipeline.add_stage(OrderBookEngine(snapshot_interval=1000))
+    conflating = StoppedConsumer(name="latest", conflate_streams=["ticker", "orderbook"])
+    dropping = StoppedConsumer(name="dropping", maxsize=10, overflow_policy="drop_oldest")
+    trades = StoppedConsumer(name="trades", maxsize=2, overflow_policy="drop_oldest", subscriptions=["*|*|trades"])
+    for consumer in (conflating, dropping, trades):
+        pipeline.add_consumer(name=consumer.name, consumer=consumer)
+    assert conflating.data_queue.policy_for(PRODUCER) is OverflowPolicy.BLOCK
+    assert conflating.data_queue.policy_for("binance|BTC/USDT|watchTicker") is OverflowPolicy.CONFLATE
+    assert dropping.data_queue.policy_for(PRODUCER) is OverflowPolicy.BLOCK
+    assert dropping.data_queue.policy_for("binance|BTC/USDT|watchTrades") is OverflowPolicy.DROP_OLDEST
+    assert trades.data_queue.overrides == {}
+
+    normalizer = Normalizer()
+    for nonce in range(1, 6):
+        data = normalizer.order_book(PRODUCER, book([(100.0, float(nonce))], [(101.0, 1.0)], nonce), 1.0)
+        for message in run_stages(pipeline.stages, msg(data, PRODUCER)):
+            await pipeline.dispatch(message)
+    queue = conflating.data_queue
+    replica = OrderBookReplica(PRODUCER)
+    received = [queue.get_nowait()["data"] for _ in range(queue.qsize())]
+    assert len(received) == 5
+    assert all(replica.apply(data) for data in received)
+    for consumer in (conflating, dropping, trades):
+        await pipeline.remove_consumer(consumer.name)
+
+
+async def test_lapped_ring_cursor_resyncs_deltas():
+    pipeline = ConsumerPipeline(data_queue=BoundedQueue(), ring_capacity=4)
+    engine = OrderBookEngine(snapshot_interval=1000)
+    pipeline.add_stage(engine)
+    consumer = StoppedConsumer(name="books")
+    pipeline.add_consumer(name=consumer.name, consumer=consumer)
+
+    normalizer = Normalizer()
+
+    async def publish(nonce):
+        data = normalizer.order_book(PRODUCER, book([(100.0, float(nonce))], [(101.0, 1.0)], nonce), 1.0)
+        for message in run_stages(pipeline.stages, msg(data, PRODUCER)):
+            await pipeline.dispatch(message)
+
+    for nonce in range(1, 11):
+        await publish(nonce)
+    cursor = consumer.data_queue
+    replica = OrderBookReplica(PRODUCER)
+    # The snapshot was lapped, the retained deltas cannot be applied
+    assert not any(replica.apply(cursor.get_nowait()["data"]) for _ in range(4))
+    assert cursor.lag_events == 1
+
+    await publish(11)
+    snapshot = cursor.get_nowait()["data"]
+    assert isinstance(snapshot, OrderBookRecord)
+    assert replica.apply(snapshot)
+    await pipeline.remove_consumer(consumer.name)
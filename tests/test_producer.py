@@ -0,0 +1,166 @@
+import asyncio
+
+from crypto_data_collector.producer import GroupedDataProducer, ProducerPipeline
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.records import Normalizer, TickerRecord
+from crypto_data_collector.registry import Registry
+from tests.conftest import make_producer
+
+
+def fake_stream(payloads):
+    payloads = list(payloads)
+
+    async def stream_method(symbol, **kwargs):
+        if payloads:
+            return payloads.pop(0)
+        await asyncio.Event().wait()
+    return stream_method
+
+
+async def run_until_queued(producer, count):
+    task = asyncio.create_task(producer.start_loop())
+    while producer.data_queue.qsize() < count:
+        await asyncio.sleep(0)
+    task.cancel()
+    return [producer.data_queue.get_nowait() for _ in range(count)]
+
+
+async def test_producer_wraps_raw_data():
+    producer = make_producer(stream_method=fake_stream([{"last": 1.0}]))
+    [message] = await run_until_queued(producer, 1)
+    assert message["producer"] == "fake|BTC/USDT|watchTicker"
+    assert message["data"] == {"last": 1.0}
+    assert message["received"] > 0
+
+
+async def test_producer_normalizes():
+    producer = make_producer(stream_method=fake_stream([{"last": 1.0, "timestamp": 5}]), normalizer=Normalizer())
+    [message] = await run_until_queued(producer, 1)
+    record = message["data"]
+    assert isinstance(record, TickerRecord)
+    assert record.producer is message["producer"]
+    assert record.received == message["received"]
+
+
+def make_grouped_producer(payloads, stream_name, symbols=("BTC/USDT", "ETH/USDT"), stream_options=None, calls=None):
+    payloads = list(payloads)
+
+    async def stream_method(arg, **kwargs):
+        if calls is not None:
+            calls.append((arg, kwargs))
+        if payloads:
+            return payloads.pop(0)
+        await asyncio.Event().wait()
+
+    return GroupedDataProducer(
+        exchange_name="fake",
+        exchange=None,
+        symbols=list(symbols),
+        stream_name=stream_name,
+        stream_method=stream_method,
+        stream_options=stream_options or {},
+        data_queue=BoundedQueue(),
+    )
+
+
+async def test_grouped_producer_demultiplexes_trades():
+    trades = [
+        {"symbol": "BTC/USDT", "id": "1"},
+        {"symbol": "ETH/USDT", "id": "2"},
+        {"symbol": "BTC/USDT", "id": "3"},
+    ]
+    producer = make_grouped_producer([trades], "watchTrades")
+    assert producer.producer_name == "fake|*|watchTrades"
+    messages = await run_until_queued(producer, 2)
+    by_producer = {m["producer"]: [t["id"] for t in m["data"]] for m in messages}
+    assert by_producer == {"fake|BTC/USDT|watchTrades": ["1", "3"], "fake|ETH/USDT|watchTrades": ["2"]}
+    assert messages[0]["received"] == messages[1]["received"]
+
+
+async def test_grouped_producer_tickers_and_unknown_symbols():
+    tickers = {"BTC/USDT": {"last": 1.0}, "XRP/USDT": {"last": 2.0}}
+    producer = make_grouped_producer([tickers, {"ETH/USDT": {"last": 3.0}}], "watchTicker")
+    messages = await run_until_queued(producer, 2)
+    assert [(m["producer"], m["data"]["last"]) for m in messages] == [
+        ("fake|BTC/USDT|watchTicker", 1.0),
+        ("fake|ETH/USDT|watchTicker", 3.0),
+    ]
+
+
+async def test_grouped_producer_order_book_and_ohlcv_arguments():
+    calls = []
+    producer = make_grouped_producer(
+        [{"symbol": "ETH/USDT", "bids": [], "asks": []}], "watchOrderBook", calls=calls
+    )
+    [message] = await run_until_queued(producer, 1)
+    assert message["producer"] == "fake|ETH/USDT|watchOrderBook"
+    assert calls[0] == (["BTC/USDT", "ETH/USDT"], {})
+
+    calls = []
+    candles = {"BTC/USDT": {"5m": [[1, 1.0, 1.0, 1.0, 1.0, 1.0]]}}
+    producer = make_grouped_producer(
+        [candles], "watchOHLCV", stream_options={"timeframe": "5m", "limit": 1}, calls=calls
+    )
+    [message] = await run_until_queued(producer, 1)
+    assert message["producer"] == "fake|BTC/USDT|watchOHLCV"
+    assert message["data"] == [[1, 1.0, 1.0, 1.0, 1.0, 1.0]]
+    assert calls[0] == ([["BTC/USDT", "5m"], ["ETH/USDT", "5m"]], {"limit": 1})
+
+
+class FakeGroupedExchange:
+    has = {"watchTrades": True, "watchTicker": True, "watchTradesForSymbols": True}
+
+    async def watchTrades(self, symbol, **kwargs):
+        pass
+
+    async def watchTicker(self, symbol, **kwargs):
+        pass
+
+    async def watchTradesForSymbols(self, symbols, **kwargs):
+        pass
+
+
+def test_registry_create_producers_groups_supported_streams():
+    exchange = FakeGroupedExchange()
+    registry = Registry()
+    streams = lambda *names, options=None: {
+        "streams": {
+            name: {"stream_method": getattr(exchange, name), "stream_options": options or {}, "consumer_options": {}}
+            for name in names
+        }
+    }
+    registry.registered["exchanges"]["fake"] = {
+        "object": exchange,
+        "overrides": {},
+        "symbols": {
+            "BTC/USDT": streams("watchTrades", "watchTicker"),
+            "ETH/USDT": streams("watchTrades"),
+            "XRP/USDT": streams("watchTrades", options={"limit": 5}),
+        },
+    }
+    queue = BoundedQueue()
+
+    names = sorted(p.producer_name for p in registry.create_producers(queue))
+    assert names == [
+        "fake|BTC/USDT|watchTicker", "fake|BTC/USDT|watchTrades",
+        "fake|ETH/USDT|watchTrades", "fake|XRP/USDT|watchTrades",
+    ]
+
+    producers = {p.producer_name: p for p in registry.create_producers(queue, grouped=True)}
+    # Different options are not grouped, watchTicker has no grouped method on this exchange
+    assert sorted(producers) == ["fake|*|watchTrades", "fake|BTC/USDT|watchTicker", "fake|XRP/USDT|watchTrades"]
+    assert producers["fake|*|watchTrades"].symbols == ["BTC/USDT", "ETH/USDT"]
+
+
+async def test_stop_pipeline_removes_every_producer():
+    pipeline = ProducerPipeline(BoundedQueue())
+    producers = [
+        make_producer(stream_name=s, stream_method=fake_stream([{"last": 1.0}])) for s in ("watchTicker", "watchTrades")
+    ]
+    for producer in producers:
+        pipeline.add_producer(producer.producer_name, producer)
+    await asyncio.sleep(0)
+    await pipeline.stop_pipeline()
+    assert pipeline.producers == {}
+    assert all(p.task.done() for p in producers)
+    assert pipeline._watchdog_task is None
@@ -0,0 +1,142 @@
+import asyncio
+import pytest
+
+from crypto_data_collector.queues import BoundedQueue, BroadcastRing, OverflowPolicy
+from tests.conftest import msg
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+        queue.task_done()
+    return items
+
+
+def test_block_policy_raises_on_put_nowait():
+    queue = BoundedQueue(maxsize=1)
+    queue.put_nowait(msg(1, "a|b|c"))
+    with pytest.raises(asyncio.QueueFull):
+        queue.put_nowait(msg(2, "a|b|c"))
+
+
+async def test_block_policy_waits_on_put():
+    queue = BoundedQueue(maxsize=1)
+    await queue.put(msg(1, "a|b|c"))
+    putter = asyncio.create_task(queue.put(msg(2, "a|b|c")))
+    await asyncio.sleep(0)
+    assert not putter.done()
+    queue.get_nowait()
+    await asyncio.wait_for(putter, 1)
+    assert queue.get_nowait()["data"] == 2
+
+
+def test_drop_oldest():
+    queue = BoundedQueue(maxsize=2, policy="drop_oldest")
+    for i in range(5):
+        queue.put_nowait(msg(i, "a|b|c"))
+    assert [m["data"] for m in drain(queue)] == [3, 4]
+    assert queue.dropped_oldest == 3
+    assert queue.dropped_by_key["a|b|c"] == 3
+
+
+def test_drop_newest():
+    queue = BoundedQueue(maxsize=2, policy=OverflowPolicy.DROP_NEWEST)
+    for i in range(5):
+        queue.put_nowait(msg(i, "a|b|c"))
+    assert [m["data"] for m in drain(queue)] == [0, 1]
+    assert queue.dropped_newest == 3
+    assert queue.dropped == 3
+
+
+def test_conflate_keeps_latest_per_key():
+    queue = BoundedQueue(maxsize=10, policy=OverflowPolicy.CONFLATE)
+    queue.put_nowait(msg(1, "x|BTC|watchTicker"))
+    queue.put_nowait(msg(1, "x|ETH|watchTicker"))
+    queue.put_nowait(msg(2, "x|BTC|watchTicker"))
+    queue.put_nowait(msg(3, "x|BTC|watchTicker"))
+    assert queue.qsize() == 2
+    assert queue.conflated == 2
+    items = drain(queue)
+    assert [(m["producer"], m["data"]) for m in items] == [
+        ("x|BTC|watchTicker", 3),
+        ("x|ETH|watchTicker", 1),
+    ]
+
+
+async def test_conflate_join_completes():
+    queue = BoundedQueue(policy=OverflowPolicy.CONFLATE)
+    for i in range(3):
+        await queue.put(msg(i, "x|BTC|watchTicker"))
+    drain(queue)
+    await asyncio.wait_for(queue.join(), 1)
+
+
+def test_stream_override():
+    queue = BoundedQueue(maxsize=1, policy=OverflowPolicy.BLOCK)
+    queue.set_policy("watchOrderBook", OverflowPolicy.DROP_NEWEST)
+    queue.put_nowait(msg(1, "x|BTC|watchTrades"))
+    queue.put_nowait(msg(1, "x|BTC|watchOrderBook"))
+    assert queue.dropped_by_key["x|BTC|watchOrderBook"] == 1
+    with pytest.raises(asyncio.QueueFull):
+        queue.put_nowait(msg(2, "x|BTC|watchTrades"))
+
+
+def test_producer_override_beats_stream_override():
+    queue = BoundedQueue(maxsize=1)
+    queue.set_policy("watchTicker", OverflowPolicy.DROP_NEWEST)
+    queue.set_policy("x|BTC|watchTicker", OverflowPolicy.DROP_OLDEST)
+    queue.put_nowait(msg(1, "x|BTC|watchTicker"))
+    queue.put_nowait(msg(2, "x|BTC|watchTicker"))
+    assert queue.get_nowait()["data"] == 2
+
+
+def test_ring_capacity_rounds_to_power_of_two():
+    assert BroadcastRing(1000).capacity == 1024
+    assert BroadcastRing(8).capacity == 8
+
+
+def test_ring_cursors_read_independently():
+    ring = BroadcastRing(8)
+    first = ring.cursor("first")
+    for i in range(3):
+        ring.publish(i)
+    second = ring.cursor("second")
+    ring.publish(3)
+    assert [first.get_nowait() for _ in range(4)] == [0, 1, 2, 3]
+    assert second.get_nowait() == 3
+    assert first.empty() and second.empty()
+    with pytest.raises(asyncio.QueueEmpty):
+        first.get_nowait()
+
+
+def test_ring_lag_detection():
+    ring = BroadcastRing(4)
+    cursor = ring.cursor("slow")
+    for i in range(10):
+        ring.publish(i)
+    assert cursor.qsize() == 4
+    assert cursor.get_nowait() == 6
+    assert cursor.lagged == 6
+    assert cursor.lag_events == 1
+
+
+async def test_ring_cursor_get_waits_for_publish():
+    ring = BroadcastRing(4)
+    cursors = [ring.cursor(str(i)) for i in range(3)]
+    getters = [asyncio.create_task(c.get()) for c in cursors]
+    await asyncio.sleep(0)
+    getters[0].cancel()
+    ring.publish("x")
+    results = await asyncio.gather(*getters[1:])
+    assert results == ["x", "x"]
+    assert not ring._waiters
+
+
+def test_conflated_counts_per_key():
+    queue = BoundedQueue(policy=OverflowPolicy.CONFLATE)
+    for i in range(4):
+        queue.put_nowait(msg(i, "x|BTC|watchTicker"))
+    queue.put_nowait(msg(0, "x|ETH|watchTicker"))
+    queue.put_nowait(msg(1, "x|ETH|watchTicker"))
+    assert queue.stats()["conflated_by_key"] == {"x|BTC|watchTicker": 3, "x|ETH|watchTicker": 1}
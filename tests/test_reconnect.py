@@ -0,0 +1,111 @@
+import random
+import asyncio
+
+import ccxt
+import pytest
+
+from crypto_data_collector.helpers import Status
+from crypto_data_collector.producer import ProducerPipeline
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.reconnect import BreakerState, CircuitBreaker, ReconnectScheduler, backoff_delay
+from tests.conftest import make_producer
+
+# Retry fast
+RETRY = {"base_delay": 0.01, "max_delay": 0.02}
+
+
+class FlakyExchange:
+    name = "flaky"
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    async def watchTicker(self, symbol, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise ccxt.NetworkError("connection lost")
+        await asyncio.sleep(0.001)
+        return {"symbol": symbol, "last": 1.0}
+
+    async def close(self):
+        pass
+
+
+def test_backoff_delay_is_jittered_and_capped():
+    rng = random.Random(0)
+    delays = [backoff_delay(attempt, 1.0, 10.0, rng) for attempt in range(8)]
+    for attempt, delay in enumerate(delays):
+        ceiling = min(10.0, 2 ** attempt)
+        assert ceiling / 2 <= delay <= ceiling
+    assert len({backoff_delay(3, 1.0, 10.0, rng) for _ in range(10)}) == 10
+
+
+async def test_breaker_opens_and_staggers_retries():
+    loop = asyncio.get_running_loop()
+    breaker = CircuitBreaker("flaky", failure_threshold=3, open_s=0.1, max_open_s=0.1, stagger_s=0.05)
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state is BreakerState.OPEN
+
+    started = loop.time()
+    done = []
+
+    async def retry():
+        await breaker.acquire()
+        done.append(loop.time() - started)
+
+    await asyncio.gather(*(retry() for _ in range(3)))
+    assert breaker.state is BreakerState.HALF_OPEN
+    # Cool down in [0.05, 0.1], then one retry per stagger slot
+    assert 0.05 <= done[0] <= 0.15
+    assert done[1] - done[0] >= 0.04 and done[2] - done[1] >= 0.04
+
+    # A failure while half open trips again, a success closes
+    breaker.record_failure()
+    assert breaker.state is BreakerState.OPEN and breaker.total_trips == 2
+    breaker.record_success()
+    assert breaker.state is BreakerState.CLOSED and breaker.trips == 0
+
+
+async def test_producer_recovers_through_shared_breaker():
+    exchange = FlakyExchange(failures=2)
+    queue = BoundedQueue()
+    pipeline = ProducerPipeline(queue, scheduler=ReconnectScheduler(failure_threshold=2, open_s=0.02, stagger_s=0.01))
+    producer = make_producer(exchange, queue=queue, max_tries=4, **RETRY)
+    pipeline.add_producer(producer.producer_name, producer)
+    message = await asyncio.wait_for(queue.get(), 2)
+
+    breaker = pipeline.scheduler.breakers["flaky"]
+    assert producer.breaker is breaker
+    assert message["producer"] == "flaky|BTC/USDT|watchTicker"
+    assert producer.state.status is Status.RUNNING
+    assert producer.state.tries == 0 and producer.state.last_error is None
+    assert breaker.total_trips == 1 and breaker.state is BreakerState.CLOSED
+    await pipeline.remove_producer(producer.producer_name)
+
+
+async def test_pipeline_restarts_errored_producer():
+    exchange = FlakyExchange(failures=3)
+    queue = BoundedQueue()
+    pipeline = ProducerPipeline(queue, restart_delay=0.01, max_restart_delay=0.02)
+    producer = make_producer(exchange, queue=queue, max_tries=2, **RETRY)
+    pipeline.add_producer(producer.producer_name, producer)
+    await asyncio.wait_for(queue.get(), 2)
+    assert producer.restarts == 1
+    assert producer.state.status is Status.RUNNING
+
+    await pipeline.remove_producer(producer.producer_name)
+    assert producer.state.status is Status.CANCELLED
+    assert producer.producer_name not in pipeline.producers
+
+
+async def test_pipeline_without_auto_restart_keeps_errored_producer():
+    exchange = FlakyExchange(failures=10)
+    pipeline = ProducerPipeline(BoundedQueue(), auto_restart=False)
+    producer = make_producer(exchange, max_tries=2, **RETRY)
+    pipeline.add_producer(producer.producer_name, producer)
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(producer.task, 2)
+    assert producer.state.status is Status.ERRORED
+    assert producer.restarts == 0
@@ -0,0 +1,127 @@
+import asyncio
+
+from array import array
+
+import pytest
+
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.recorder import (
+    BLOCK, RecorderConsumer, read_index, read_log, read_segment, segment_paths
+)
+from crypto_data_collector.orderbook import OrderBookDelta, OrderBookEngine, OrderBookReplica
+from crypto_data_collector.records import Normalizer, OrderBookRecord, TickerRecord, TradeRecord
+from crypto_data_collector.replay import ReplayProducer
+
+
+def messages(count, start=1000.0, producer="binance|BTC/USDT|watchTicker"):
+    return [{"data": {"last": float(i)}, "producer": producer, "received": start + i} for i in range(count)]
+
+
+async def record(recorder, batches):
+    for batch in batches:
+        await recorder.run_batch(batch)
+    await recorder.close()
+
+
+@pytest.mark.parametrize("serializer,compression", [("json", None), ("msgpack", "zstd")])
+async def test_round_trip(tmp_path, serializer, compression):
+    if serializer == "msgpack":
+        pytest.importorskip("msgpack")
+        pytest.importorskip("zstandard")
+    recorder = RecorderConsumer(tmp_path, serializer=serializer, compression=compression)
+    written = messages(250)
+    await record(recorder, [written[:100], written[100:200], written[200:]])
+    [segment] = segment_paths(tmp_path)
+    assert segment.name == "1000-0.log"
+    assert list(read_segment(segment)) == written
+    assert len(read_index(segment.with_suffix(".idx"))) == 3
+    assert recorder.messages_written == 250
+
+
+async def test_records_are_read_back_as_records(tmp_path):
+    recorder = RecorderConsumer(tmp_path, serializer="json", compression=None)
+    trade = TradeRecord("binance|BTC/USDT|watchTrades", "1", 5, 10.0, 1.5, 2.0, "buy")
+    await record(recorder, [[{"data": [trade], "producer": trade.producer, "received": 10.0}]])
+    [message] = read_log(tmp_path)
+    assert message["data"] == [trade]
+    assert isinstance(message["data"][0], TradeRecord)
+
+
+async def test_seek_by_time_across_segments(tmp_path):
+    recorder = RecorderConsumer(tmp_path, serializer="json", compression=None, max_segment_bytes=1)
+    written = messages(100)
+    # One block per 10 messages, every block rolls the segment
+    await record(recorder, [written[i:i + 10] for i in range(0, 100, 10)])
+    assert len(segment_paths(tmp_path)) == 10
+    assert list(read_log(tmp_path)) == written
+    assert list(read_log(tmp_path, start=1055.0)) == written[55:]
+    assert list(read_log(tmp_path, start=5000.0)) == []
+
+
+async def test_seek_uses_the_index(tmp_path):
+    recorder = RecorderConsumer(tmp_path, serializer="json", compression=None)
+    written = messages(1000)
+    await record(recorder, [written[i:i + 100] for i in range(0, 1000, 100)])
+    [segment] = segment_paths(tmp_path)
+    index = read_index(segment.with_suffix(".idx"))
+    # Corrupt the payload of the first block, a seek past it must not read it
+    with open(segment, "r+b") as f:
+        f.seek(index[0][1] + BLOCK.size + 4)
+        f.write(b"\xff" * 8)
+    with pytest.raises(ValueError):
+        list(read_segment(segment))
+    assert list(read_segment(segment, start=1950.0)) == written[950:]
+
+
+async def test_truncated_segment_ends_cleanly(tmp_path):
+    recorder = RecorderConsumer(tmp_path, serializer="json", compression=None)
+    written = messages(20)
+    await record(recorder, [written[:10], written[10:]])
+    [segment] = segment_paths(tmp_path)
+    data = segment.read_bytes()
+    segment.write_bytes(data[:-5])
+    assert list(read_segment(segment)) == written[:10]
+
+
+async def test_recorder_in_pipeline_and_replay(tmp_path):
+    recorder = RecorderConsumer(tmp_path / "rec", serializer="json", compression=None, batch_timeout_ms=1)
+    task = asyncio.create_task(recorder.start_loop())
+    written = messages(30)
+    for message in written:
+        await recorder.data_queue.put(message)
+    await asyncio.wait_for(recorder.data_queue.join(), 1)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    queue = BoundedQueue()
+    replay = ReplayProducer(tmp_path / "rec", queue, speed=None, start=1010.0)
+    await replay.start_loop()
+    assert [queue.get_nowait() for _ in range(queue.qsize())] == written[10:]
+
+
+@pytest.mark.parametrize("serializer", ["json", "msgpack"])
+@pytest.mark.parametrize("normalizer", [None, Normalizer()])
+async def test_normalized_records_replay_as_records(tmp_path, serializer, normalizer):
+    if serializer == "msgpack":
+        pytest.importorskip("msgpack")
+    live = Normalizer()
+    engine = OrderBookEngine()
+    ticker = live.ticker("binance|BTC/USDT|watchTicker", {"bid": 99.0, "ask": 101.0, "bidVolume": 2.0}, 1000.0)
+    written = [{"data": ticker, "producer": ticker.producer, "received": 1000.0}]
+    for nonce, bids in enumerate(([[100.0, 1.0], [99.0, 2.0]], [[100.0, 3.0]]), 1):
+        producer = "binance|BTC/USDT|watchOrderBook"
+        book = live.order_book(producer, {"bids": bids, "asks": [[101.0, 1.5]], "nonce": nonce}, 1000.0 + nonce)
+        written.append(engine.process({"data": book, "producer": producer, "received": 1000.0 + nonce}))
+    await record(RecorderConsumer(tmp_path, serializer=serializer, compression=None), [written])
+
+    queue = BoundedQueue()
+    await ReplayProducer(tmp_path, queue, speed=None, normalizer=normalizer).start_loop()
+    replayed = [queue.get_nowait()["data"] for _ in range(queue.qsize())]
+    assert replayed == [message["data"] for message in written]
+    ticker, snapshot, delta = replayed
+    assert isinstance(ticker, TickerRecord) and ticker.bid_volume == 2.0
+    assert isinstance(snapshot, OrderBookRecord) and snapshot.levels("bids") == [(100.0, 1.0), (99.0, 2.0)]
+    assert isinstance(delta, OrderBookDelta) and isinstance(delta.changes, array)
+    replica = OrderBookReplica()
+    assert replica.apply(snapshot) and replica.apply(delta)
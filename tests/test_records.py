@@ -0,0 +1,103 @@
+import copy
+import tracemalloc
+
+from array import array
+
+from crypto_data_collector.records import (
+    RECORD_TAG, Normalizer, OHLCVRecord, OrderBookRecord, TickerRecord, TradeRecord, from_tagged, pack_levels,
+    record_type, tagged_default
+)
+
+PRODUCER = "binance|BTC/USDT:USDT|watchTrades"
+
+RAW_TRADE = {
+    "info": {"e": "trade", "E": 1502962946216, "s": "BTCUSDT", "t": 12345, "p": "0.06917684", "q": "1.5"},
+    "id": "12345",
+    "timestamp": 1502962946216,
+    "datetime": "2017-08-17T12:42:26.216Z",
+    "symbol": "BTC/USDT:USDT",
+    "order": None,
+    "type": None,
+    "side": "buy",
+    "takerOrMaker": "taker",
+    "price": 0.06917684,
+    "amount": 1.5,
+    "cost": 0.10376526,
+    "fee": {"cost": 0.0015, "currency": "ETH", "rate": 0.002},
+    "fees": [{"cost": 0.0015, "currency": "ETH", "rate": 0.002}],
+}
+
+
+def test_trades():
+    records = Normalizer().normalize("watchTrades", PRODUCER, [RAW_TRADE], 1502962946300.0)
+    assert records == [
+        TradeRecord(PRODUCER, "12345", 1502962946216, 1502962946300.0, 0.06917684, 1.5, "buy", "taker")
+    ]
+    assert records[0].info is None
+    assert Normalizer(keep_info=True).trades(PRODUCER, [RAW_TRADE], 0.0)[0].info is RAW_TRADE["info"]
+
+
+def test_ticker():
+    raw = {"timestamp": 1, "bid": 1.0, "ask": 2.0, "last": 1.5, "bidVolume": 3.0, "baseVolume": 10.0, "info": {}}
+    record = Normalizer().normalize("watchTicker", PRODUCER, raw, 5.0)
+    assert isinstance(record, TickerRecord)
+    assert (record.bid, record.ask, record.last, record.bid_volume, record.ask_volume) == (1.0, 2.0, 1.5, 3.0, None)
+
+
+def test_ohlcv():
+    records = Normalizer().normalize("watchOHLCV", PRODUCER, [[60000, 1.0, 2.0, 0.5, 1.5, 10.0]], 5.0)
+    assert records == [OHLCVRecord(PRODUCER, 60000, 5.0, 1.0, 2.0, 0.5, 1.5, 10.0)]
+
+
+def test_order_book():
+    raw = {
+        "bids": [[100.0, 1.0], [99.0, 2.0], [98.0, 3.0]],
+        "asks": [[101.0, 1.5], [102.0, 2.5]],
+        "timestamp": 7,
+        "nonce": 42,
+        "symbol": "BTC/USDT:USDT",
+    }
+    record = Normalizer(depth=2).normalize("watchOrderBook", PRODUCER, raw, 8.0)
+    assert isinstance(record, OrderBookRecord)
+    assert record.bids == array("d", [100.0, 1.0, 99.0, 2.0])
+    assert record.levels("asks") == [(101.0, 1.5), (102.0, 2.5)]
+    assert record.nonce == 42
+
+
+def test_unknown_stream_passthrough():
+    data = {"anything": 1}
+    assert Normalizer().normalize("watchBidsAsks", PRODUCER, data, 0.0) is data
+
+
+def test_pack_levels_ignores_extra_fields():
+    assert pack_levels([[1.0, 2.0, 3], [4.0, 5.0, 6]]) == array("d", [1.0, 2.0, 4.0, 5.0])
+
+
+def allocated(build):
+    tracemalloc.start()
+    try:
+        kept = build()
+        return tracemalloc.get_traced_memory()[0], kept
+    finally:
+        tracemalloc.stop()
+
+
+def test_records_smaller_than_raw():
+    raw_size, _ = allocated(lambda: [copy.deepcopy(RAW_TRADE) for _ in range(1000)])
+    raws = [copy.deepcopy(RAW_TRADE) for _ in range(1000)]
+    normalizer = Normalizer()
+    record_size, _ = allocated(lambda: normalizer.trades(PRODUCER, raws, 0.0))
+    assert record_size * 4 < raw_size
+
+
+def test_record_tags_resolve_through_the_registry():
+    from crypto_data_collector.orderbook import OrderBookDelta
+
+    trade = Normalizer().trades(PRODUCER, [RAW_TRADE], 0.0)[0]
+    assert from_tagged(tagged_default(trade)) == trade
+    assert record_type(tagged_default(OrderBookDelta(PRODUCER, 1, 2.0, 3, 2, array("d"), None))[RECORD_TAG]) is OrderBookDelta
+
+    # Tags are looked up, never imported
+    for tag in ("os:system", "subprocess:Popen", "crypto_data_collector.records:Normalizer"):
+        assert record_type(tag) is None
+        assert from_tagged({RECORD_TAG: tag, "a": 1}) == {RECORD_TAG: tag, "a": 1}
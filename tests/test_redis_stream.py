@@ -0,0 +1,155 @@
+import json
+import time
+import asyncio
+
+import pytest
+
+from crypto_data_collector.redis_stream import RedisStreamConsumer
+from crypto_data_collector.records import TickerRecord
+from tests.conftest import msg
+
+
+class ResponseError(Exception):
+    pass
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def xadd(self, key, fields, maxlen=None, approximate=True):
+        self.commands.append((key, fields, maxlen, approximate))
+
+    async def execute(self, raise_on_error=True):
+        if self.client.down:
+            raise ConnectionError("redis down")
+        self.client.round_trips += 1
+        results = []
+        for key, fields, maxlen, _ in self.commands:
+            if key in self.client.rejected:
+                # e.g. WRONGTYPE, the key holds another type
+                results.append(ResponseError("WRONGTYPE"))
+                continue
+            stream = self.client.streams.setdefault(key, [])
+            stream.append(fields)
+            if maxlen is not None:
+                del stream[:-maxlen]
+            results.append(b"0-1")
+        errors = [r for r in results if isinstance(r, Exception)]
+        if raise_on_error and errors:
+            raise errors[0]
+        return results
+
+
+class FakeRedis:
+    def __init__(self):
+        self.streams = {}
+        self.down = False
+        self.round_trips = 0
+        self.closed = False
+        self.rejected = set()
+
+    def pipeline(self, transaction=True):
+        assert transaction is False
+        return FakePipeline(self)
+
+    async def aclose(self):
+        self.closed = True
+
+
+async def test_writes_each_producer_to_its_stream():
+    client = FakeRedis()
+    consumer = RedisStreamConsumer(client=client, maxlen=2)
+    await consumer.run_batch([
+        msg([1], "binance|BTC/USDT|watchTrades"),
+        msg([2], "binance|BTC/USDT|watchTrades"),
+        msg([3], "binance|BTC/USDT|watchTrades"),
+        msg(TickerRecord("bitmex|BTC/USD|watchTicker", 5, 1.0, 1.0, 2.0, 1.5), "bitmex|BTC/USD|watchTicker"),
+    ])
+    assert client.round_trips == 1
+    trades = client.streams["ccxt:binance|BTC/USDT|watchTrades"]
+    assert [json.loads(e["data"]) for e in trades] == [[2], [3]]
+    ticker = json.loads(client.streams["ccxt:bitmex|BTC/USD|watchTicker"][0]["data"])
+    assert ticker["bid"] == 1.0 and ticker["timestamp"] == 5
+    assert consumer.written == 4
+
+
+async def test_pipelines_in_chunks():
+    client = FakeRedis()
+    consumer = RedisStreamConsumer(client=client, pipeline_size=10, maxlen=None)
+    await consumer.run_batch([msg(i, "a|b|c") for i in range(25)])
+    assert client.round_trips == 3
+    assert len(client.streams["ccxt:a|b|c"]) == 25
+
+
+async def test_buffers_while_disconnected():
+    client = FakeRedis()
+    consumer = RedisStreamConsumer(client=client, reconnect_delay=0, max_buffer=5)
+    client.down = True
+    await consumer.run_batch([msg(i, "a|b|c") for i in range(3)])
+    await consumer.run_batch([msg(i, "a|b|c") for i in range(3, 7)])
+    assert not consumer.connected
+    assert consumer.dropped == 2
+    assert [m["data"] for m in consumer.buffer] == [2, 3, 4, 5, 6]
+
+    client.down = False
+    await consumer.run_batch([msg(7, "a|b|c")])
+    assert consumer.connected
+    # The buffer was full, the oldest message made room for the new one
+    assert consumer.dropped == 3
+    assert [json.loads(e["data"]) for e in client.streams["ccxt:a|b|c"]] == [3, 4, 5, 6, 7]
+
+
+async def test_backoff_never_blocks_batches():
+    client = FakeRedis()
+    consumer = RedisStreamConsumer(client=client, reconnect_delay=0.1, batch_timeout_ms=1)
+    client.down = True
+    started = time.perf_counter()
+    await consumer.run_batch([msg(1, "a|b|c")])
+    client.down = False
+    # Retry not due yet, the batch is buffered and run_batch returns at once
+    await consumer.run_batch([msg(2, "a|b|c")])
+    assert time.perf_counter() - started < 0.05
+    assert client.round_trips == 0
+    assert len(consumer.buffer) == 2
+
+    # Retried once due, without another message arriving
+    task = asyncio.create_task(consumer.start_loop())
+    await asyncio.sleep(0.2)
+    assert consumer.connected
+    assert [json.loads(e["data"]) for e in client.streams["ccxt:a|b|c"]] == [1, 2]
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+async def test_close_flushes_and_releases_client():
+    client = FakeRedis()
+    consumer = RedisStreamConsumer(client=client, reconnect_delay=0)
+    client.down = True
+    await consumer.run_batch([msg(1, "a|b|c")])
+    client.down = False
+    await consumer.close()
+    assert client.closed
+    assert len(client.streams["ccxt:a|b|c"]) == 1
+
+
+async def test_drops_messages_it_cannot_write():
+    client = FakeRedis()
+    client.rejected.add("ccxt:x|y|z")
+    consumer = RedisStreamConsumer(client=client, reconnect_delay=0)
+    await consumer.run_batch([
+        msg(1, "a|b|c"),
+        msg(object(), "a|b|c"),
+        msg(2, "x|y|z"),
+        msg(3, "a|b|c"),
+    ])
+    assert not consumer.buffer
+    assert consumer.failed == 2
+    assert consumer.written == 2
+    assert [json.loads(e["data"]) for e in client.streams["ccxt:a|b|c"]] == [1, 3]
+
+    # The consumer keeps going with the next batch
+    await consumer.run_batch([msg(4, "a|b|c")])
+    assert consumer.written == 3
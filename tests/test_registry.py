@@ -0,0 +1,135 @@
+import json
+import time
+
+import ccxt.pro
+import pytest
+
+from crypto_data_collector.exceptions import UnregisteredExchange, UnregisteredStream, UnregisteredSymbol
+from crypto_data_collector.market_cache import MarketCache
+from crypto_data_collector.registry import Registry
+from tests.conftest import MARKETS
+
+
+def make_config(*exchanges):
+    return {"exchanges": {
+        name: {"symbols": {"BTC/USDT": {"streams": {"watchTrades": None, "watchTicker": {"options": {}}}}}}
+        for name in exchanges
+    }}
+
+
+@pytest.fixture
+def load_markets_delay():
+    # Slow enough to tell concurrent registrations from sequential ones
+    return 0.2
+
+
+async def close(registry):
+    for exch_data in registry.registered["exchanges"].values():
+        await exch_data["object"].close()
+
+
+def test_cache_round_trip_and_ttl(tmp_path):
+    cache = MarketCache(tmp_path, ttl_s=60)
+    assert cache.load("binance") is None
+    cache.store("binance", {}, MARKETS, {"BTC": {"code": "BTC"}})
+    assert cache.load("binance", {}) == {"markets": MARKETS, "currencies": {"BTC": {"code": "BTC"}}}
+    # Different overrides are different entries
+    assert cache.load("binance", {"options": {"defaultType": "future"}}) is None
+
+    path = cache.path("binance")
+    entry = json.loads(path.read_text())
+    entry["created"] -= 120
+    path.write_text(json.dumps(entry))
+    assert cache.load("binance") is None
+    assert MarketCache(tmp_path, ttl_s=None).load("binance") is not None
+
+    path.write_text("{")
+    assert cache.load("binance") is None
+    assert (cache.hits, cache.misses) == (1, 4)
+
+
+async def test_register_config_is_concurrent(offline):
+    registry = Registry()
+    started = time.perf_counter()
+    names = await registry.register_config(make_config("binance", "kraken"))
+    elapsed = time.perf_counter() - started
+    await close(registry)
+    assert sorted(offline) == ["binance", "kraken"]
+    assert elapsed < 0.35
+    assert names == [
+        "binance|BTC/USDT|watchTrades", "binance|BTC/USDT|watchTicker",
+        "kraken|BTC/USDT|watchTrades", "kraken|BTC/USDT|watchTicker",
+    ]
+
+
+async def test_register_config_raises_after_all_exchanges_and_cleans_up(offline, monkeypatch):
+    config = make_config("binance", "kraken")
+    config["exchanges"]["kraken"]["symbols"] = {"DOGE/EUR": {"streams": {"watchTrades": None}}}
+    closed = []
+    binance_close = ccxt.pro.binance.close
+
+    async def close_binance(self):
+        closed.append(self.id)
+        await binance_close(self)
+
+    monkeypatch.setattr(ccxt.pro.binance, "close", close_binance)
+    registry = Registry()
+    await registry.register_exchange("kraken")
+    with pytest.raises(AttributeError):
+        await registry.register_config(config)
+    assert sorted(offline) == ["binance", "kraken"]
+    # Exchanges the failed call registered are closed, earlier ones are kept
+    assert not registry.exchange_registered("binance")
+    assert registry.exchange_registered("kraken")
+    assert closed == ["binance"]
+    await close(registry)
+
+
+async def test_register_exchange_uses_market_cache(tmp_path, offline):
+    cache = MarketCache(tmp_path)
+    registry = Registry(market_cache=cache)
+    await registry.register_exchange("binance")
+    await close(registry)
+    assert offline == ["binance"]
+    assert cache.path("binance", {}).exists()
+
+    registry = Registry(market_cache=cache)
+    await registry.register_config(make_config("binance"))
+    await close(registry)
+    # Served from the cache, no second load
+    assert offline == ["binance"]
+    assert registry.get_exchange_object("binance").symbols == ["BTC/USDT", "ETH/USDT"]
+
+
+async def test_stream_index(offline):
+    registry = Registry()
+    config = make_config("binance", "kraken")
+    config["exchanges"]["binance"]["symbols"]["ETH/USDT"] = {"streams": {"watchTrades": {"options": {"limit": 5}}}}
+    await registry.register_config(config)
+    await close(registry)
+
+    assert registry.producer_keys() == [
+        "binance|BTC/USDT|watchTrades", "binance|BTC/USDT|watchTicker", "binance|ETH/USDT|watchTrades",
+        "kraken|BTC/USDT|watchTrades", "kraken|BTC/USDT|watchTicker",
+    ]
+    assert registry.producer_keys(exchange_name="kraken") == ["kraken|BTC/USDT|watchTrades", "kraken|BTC/USDT|watchTicker"]
+    assert registry.producer_keys(stream_name="watchTicker") == ["binance|BTC/USDT|watchTicker", "kraken|BTC/USDT|watchTicker"]
+    assert registry.producer_keys("binance", "watchTrades") == ["binance|BTC/USDT|watchTrades", "binance|ETH/USDT|watchTrades"]
+    assert registry.get_stream("binance|ETH/USDT|watchTrades")["stream_options"] == {"limit": 5}
+    assert registry.get_stream_options("binance", "ETH/USDT", "watchTrades") == {"limit": 5}
+
+    with pytest.raises(UnregisteredExchange):
+        registry.get_stream("bitmex|BTC/USDT|watchTrades")
+    with pytest.raises(UnregisteredSymbol):
+        registry.get_stream_method("binance", "XRP/USDT", "watchTrades")
+    with pytest.raises(UnregisteredStream):
+        registry.get_stream_consumer_options("binance", "ETH/USDT", "watchTicker")
+    with pytest.raises(ValueError):
+        registry.get_stream("binance|BTC/USDT")
+
+    registry.unregister_stream("binance", "ETH/USDT", "watchTrades")
+    registry.unregister_exchange("kraken", force=True)
+    assert registry.producer_keys() == ["binance|BTC/USDT|watchTrades", "binance|BTC/USDT|watchTicker"]
+    assert registry.producer_keys(exchange_name="kraken") == []
+    assert registry.producer_keys(stream_name="watchTicker") == ["binance|BTC/USDT|watchTicker"]
+    assert not registry.stream_registered("watchTrades", "ETH/USDT", "binance")
@@ -0,0 +1,141 @@
+import asyncio
+
+import yaml
+
+from crypto_data_collector.producer import ProducerPipeline
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.registry import Registry
+from crypto_data_collector.reload import ConfigReloader, diff_config
+
+
+def config(exchanges):
+    return {"exchanges": {
+        name: {"symbols": {symbol: {"streams": streams} for symbol, streams in symbols.items()}}
+        for name, symbols in exchanges.items()
+    }}
+
+
+BASE = config({"binance": {"BTC/USDT": {"watchTicker": {"options": {}}, "watchTrades": {"options": {}}}}})
+
+
+async def test_diff_config(offline):
+    registry = Registry(fast_json=False)
+    await registry.register_config(BASE)
+    assert not diff_config(registry, BASE)
+
+    updated = config({
+        "binance": {"BTC/USDT": {"watchTicker": {"options": {"params": {"x": 1}}}}, "ETH/USDT": {"watchTrades": None}},
+        "kraken": {"BTC/USDT": {"watchTicker": None}},
+    })
+    diff = diff_config(registry, updated)
+    assert diff.added == ["binance|ETH/USDT|watchTrades", "kraken|BTC/USDT|watchTicker"]
+    assert diff.removed == ["binance|BTC/USDT|watchTrades"]
+    assert diff.changed == ["binance|BTC/USDT|watchTicker"]
+    assert diff.exchanges_added == ["kraken"]
+
+    updated["exchanges"]["binance"]["properties"] = {"timeout": 5000}
+    diff = diff_config(registry, updated)
+    assert diff.exchanges_changed == ["binance"]
+    assert diff.changed == ["binance|BTC/USDT|watchTicker"]
+    await registry.registered["exchanges"]["binance"]["object"].close()
+
+
+async def test_reload_applies_only_the_changes(offline, tmp_path):
+    (tmp_path / "config").mkdir()
+    path = tmp_path / "config" / "producers.yaml"
+    path.write_text(yaml.safe_dump(BASE))
+
+    registry = Registry(fast_json=False)
+    await registry.register_config(BASE)
+    pipeline = ProducerPipeline(BoundedQueue(), watch_stalls=False)
+    for producer in registry.create_producers(pipeline.get_data_queue()):
+        pipeline.add_producer(producer.producer_name, producer)
+    ticker = pipeline.producers["binance|BTC/USDT|watchTicker"]
+    binance = ticker.exchange
+    reloader = ConfigReloader(registry, pipeline, tmp_path, interval=0.01)
+    task = asyncio.create_task(reloader.run())
+    await asyncio.sleep(0.05)
+
+    path.write_text(yaml.safe_dump(config({
+        "binance": {"BTC/USDT": {"watchTicker": {"options": {}}}, "ETH/USDT": {"watchTicker": None}},
+        "kraken": {"BTC/USDT": {"watchTrades": None}},
+    })))
+    for _ in range(200):
+        if reloader.reloads:
+            break
+        await asyncio.sleep(0.01)
+    assert set(pipeline.producers) == {
+        "binance|BTC/USDT|watchTicker", "binance|ETH/USDT|watchTicker", "kraken|BTC/USDT|watchTrades"
+    }
+    # The untouched stream kept its producer, task and connection
+    assert pipeline.producers["binance|BTC/USDT|watchTicker"] is ticker
+    assert not ticker.task.done()
+    assert pipeline.producers["binance|ETH/USDT|watchTicker"].exchange is binance
+    messages = ticker.messages
+    await asyncio.sleep(0.05)
+    assert ticker.messages > messages
+    assert not registry.stream_registered("watchTrades", "BTC/USDT", "binance")
+
+    # Dropping an exchange stops its producers and unregisters it
+    diff = await reloader.apply(config({"binance": {"BTC/USDT": {"watchTicker": {"options": {}}}}}))
+    assert diff.exchanges_removed == ["kraken"]
+    assert set(pipeline.producers) == {"binance|BTC/USDT|watchTicker"}
+    assert not registry.exchange_registered("kraken")
+    assert not registry.symbol_registered("ETH/USDT", "binance")
+
+    # A stream that fails to register is skipped, the rest is applied
+    diff = await reloader.apply(config({"binance": {
+        "BTC/USDT": {"watchTicker": {"options": {}}}, "DOGE/USDT": {"watchTicker": None}, "ETH/USDT": {"watchTrades": None}
+    }}))
+    assert set(pipeline.producers) == {"binance|BTC/USDT|watchTicker", "binance|ETH/USDT|watchTrades"}
+    assert reloader.failures == 1
+
+    task.cancel()
+    await pipeline.stop_pipeline()
+
+
+async def test_reload_keeps_runtime_streams(offline, tmp_path):
+    registry = Registry(fast_json=False)
+    await registry.register_config(BASE)
+    pipeline = ProducerPipeline(BoundedQueue(), watch_stalls=False)
+    for producer in registry.create_producers(pipeline.get_data_queue()):
+        pipeline.add_producer(producer.producer_name, producer)
+    reloader = ConfigReloader(registry, pipeline, tmp_path, config=BASE)
+
+    # Added at runtime, e.g. through the control API
+    for exchange_name, symbol in (("binance", "ETH/USDT"), ("kraken", "BTC/USDT")):
+        await registry.register_exchange(exchange_name)
+        await registry.register_symbol(exchange_name, symbol)
+        await registry.register_stream(exchange_name, symbol, "watchTicker")
+        producer = registry.create_producer(exchange_name, symbol, "watchTicker", data_queue=pipeline.get_data_queue())
+        pipeline.add_producer(producer.producer_name, producer)
+
+    diff = await reloader.apply(config({"binance": {"BTC/USDT": {"watchTicker": {"options": {}}}}}))
+    assert diff.removed == ["binance|BTC/USDT|watchTrades"]
+    assert diff.exchanges_removed == []
+    assert set(pipeline.producers) == {
+        "binance|BTC/USDT|watchTicker", "binance|ETH/USDT|watchTicker", "kraken|BTC/USDT|watchTicker"
+    }
+
+    # A new overflow policy restarts the stream and applies it, removing it clears it
+    queue = pipeline.get_data_queue()
+    ticker = pipeline.producers["binance|BTC/USDT|watchTicker"]
+    diff = await reloader.apply(config({"binance": {"BTC/USDT": {"watchTicker": {"overflow": "drop_oldest"}}}}))
+    assert diff.changed == ["binance|BTC/USDT|watchTicker"]
+    assert pipeline.producers["binance|BTC/USDT|watchTicker"] is not ticker
+    assert queue.policy_for("binance|BTC/USDT|watchTicker").value == "drop_oldest"
+    diff = await reloader.apply(config({"binance": {"BTC/USDT": {"watchTicker": None}}}))
+    assert diff.changed == ["binance|BTC/USDT|watchTicker"]
+    assert queue.policy_for("binance|BTC/USDT|watchTicker") is queue.policy
+
+    # Re-creating the exchange restarts its runtime streams too
+    binance = pipeline.producers["binance|ETH/USDT|watchTicker"].exchange
+    updated = config({"binance": {"BTC/USDT": {"watchTicker": None}}})
+    updated["exchanges"]["binance"]["properties"] = {"timeout": 5000}
+    diff = await reloader.apply(updated)
+    assert diff.exchanges_changed == ["binance"]
+    assert pipeline.producers["binance|ETH/USDT|watchTicker"].exchange is not binance
+    assert set(pipeline.producers) == {
+        "binance|BTC/USDT|watchTicker", "binance|ETH/USDT|watchTicker", "kraken|BTC/USDT|watchTicker"
+    }
+    await pipeline.stop_pipeline()
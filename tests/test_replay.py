@@ -0,0 +1,96 @@
+import gzip
+import json
+import time
+import asyncio
+
+import pytest
+
+from crypto_data_collector.helpers import Status
+from crypto_data_collector.producer import ProducerPipeline
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.replay import ReplayProducer, read_recording
+
+
+def write_recording(path, messages, compress=False):
+    opener = gzip.open if compress else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        for message in messages:
+            f.write(json.dumps(message) + "\n")
+    return path
+
+
+def recorded(count, step_ms=10.0, producer="binance|BTC/USDT|watchTicker"):
+    return [{"data": {"last": float(i)}, "producer": producer, "received": 1000.0 + i * step_ms} for i in range(count)]
+
+
+def drain(queue):
+    out = []
+    while not queue.empty():
+        out.append(queue.get_nowait())
+    return out
+
+
+async def test_replay_as_fast_as_possible(tmp_path):
+    messages = recorded(2500, step_ms=1000.0)
+    path = write_recording(tmp_path / "a.jsonl", messages)
+    queue = BoundedQueue()
+    producer = ReplayProducer(path, queue, speed=None, chunk_size=100)
+    await asyncio.wait_for(producer.start_loop(), 2)
+    assert producer.state.status is Status.FINISHED
+    assert producer.done.is_set()
+    assert drain(queue) == messages
+    assert producer.messages == 2500
+
+
+async def test_replay_keeps_relative_timing(tmp_path):
+    path = write_recording(tmp_path / "a.jsonl", recorded(5, step_ms=100.0))
+    queue = BoundedQueue()
+    producer = ReplayProducer(path, queue, speed=4.0)
+    started = time.monotonic()
+    await producer.start_loop()
+    # 400ms of recording at 4x
+    assert 0.09 <= time.monotonic() - started < 0.5
+    assert queue.qsize() == 5
+
+
+async def test_replay_filters_and_caps_gaps(tmp_path):
+    messages = recorded(3, producer="binance|BTC/USDT|watchTrades")
+    messages += recorded(3, producer="binance|BTC/USDT|watchTicker")
+    # An hour long gap in the recording
+    messages += [{"data": {}, "producer": "binance|BTC/USDT|watchTrades", "received": 3_600_000.0}]
+    path = write_recording(tmp_path / "a.jsonl.gz", messages, compress=True)
+    queue = BoundedQueue()
+    producer = ReplayProducer(path, queue, speed=1.0, subscriptions=["*|*|trades"], max_gap_ms=10)
+    await asyncio.wait_for(producer.start_loop(), 1)
+    replayed = drain(queue)
+    assert [m["producer"] for m in replayed] == ["binance|BTC/USDT|watchTrades"] * 4
+    assert producer.skipped == 3
+
+
+async def test_replay_start_end_and_rewrite(tmp_path):
+    path = write_recording(tmp_path / "a.jsonl", recorded(10))
+    queue = BoundedQueue()
+    producer = ReplayProducer(path, queue, speed=None, start=1020.0, end=1050.0, rewrite_received=True)
+    before = time.time() * 1000
+    await producer.start_loop()
+    replayed = drain(queue)
+    assert [m["data"]["last"] for m in replayed] == [2.0, 3.0, 4.0, 5.0]
+    assert all(m["received"] >= before for m in replayed)
+
+
+async def test_replay_in_producer_pipeline(tmp_path):
+    path = write_recording(tmp_path / "a.jsonl", recorded(3))
+    queue = BoundedQueue()
+    pipeline = ProducerPipeline(data_queue=queue)
+    producer = ReplayProducer(path, queue, speed=None, repeat=True)
+    pipeline.add_producer(producer.producer_name, producer)
+    while queue.qsize() < 9:
+        await asyncio.sleep(0.01)
+    await pipeline.remove_producer(producer.producer_name)
+    assert pipeline.producers == {}
+    assert producer.state.status is Status.CANCELLED
+
+
+def test_unknown_recording_format(tmp_path):
+    with pytest.raises(ValueError):
+        read_recording(tmp_path / "a.csv")
@@ -0,0 +1,47 @@
+import json
+import asyncio
+
+import pytest
+
+from crypto_data_collector import runtime
+
+
+def test_loop_factory():
+    assert runtime.loop_factory("asyncio") is None
+    with pytest.raises(ValueError):
+        runtime.loop_factory("trio")
+    if runtime.uvloop is not None:
+        assert runtime.loop_factory("auto") is runtime.uvloop.new_event_loop
+    else:
+        assert runtime.loop_factory("uvloop") is None
+
+
+@pytest.mark.parametrize("loop", runtime.LOOPS)
+def test_run_returns_result(loop):
+    async def main():
+        await asyncio.sleep(0)
+        return type(asyncio.get_running_loop()).__module__
+
+    module = runtime.run(main(), loop=loop)
+    uses_uvloop = loop != "asyncio" and runtime.uvloop is not None
+    assert module.startswith("uvloop") == uses_uvloop
+
+
+def test_use_fast_json(monkeypatch):
+    orjson = pytest.importorskip("orjson")
+
+    class Exchange(runtime.Exchange):
+        pass
+
+    class CustomExchange(runtime.Exchange):
+        def on_json_response(self, response_body):
+            return json.loads(response_body)
+
+    monkeypatch.setattr(runtime.ws_client, "json_parser", json)
+    exchange = Exchange()
+    custom = CustomExchange()
+    assert runtime.use_fast_json(exchange)
+    assert runtime.use_fast_json(custom)
+    assert runtime.ws_client.json_parser is orjson
+    assert exchange.on_json_response is orjson.loads
+    assert custom.on_json_response is not orjson.loads
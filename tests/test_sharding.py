@@ -0,0 +1,101 @@
+import os
+import asyncio
+
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.sharding import ShardSupervisor, partition_config
+
+
+def make_config(exchanges, symbols, streams=("watchTrades", "watchTicker")):
+    return {
+        "queue": {"maxsize": 10},
+        "exchanges": {
+            exchange: {
+                "properties": {"timeout": 10000},
+                "symbols": {
+                    f"S{i}/USDT": {"streams": {stream: {"options": {}} for stream in streams}}
+                    for i in range(symbols)
+                },
+            }
+            for exchange in exchanges
+        },
+    }
+
+
+def producer_names(config):
+    return sorted(
+        f"{exchange}|{symbol}|{stream}"
+        for exchange, exch_data in config["exchanges"].items()
+        for symbol, symbol_data in exch_data["symbols"].items()
+        for stream in symbol_data["streams"]
+    )
+
+
+def test_partition_covers_every_stream_once():
+    config = make_config(["binance", "bitmex", "kraken"], 5)
+    parts = partition_config(config, 4)
+    assert len(parts) == 4
+    names = [name for part in parts for name in producer_names(part)]
+    assert sorted(names) == producer_names(config)
+    loads = [len(producer_names(part)) for part in parts]
+    assert max(loads) - min(loads) <= 2
+    for part in parts:
+        assert part["queue"] == {"maxsize": 10}
+        for exch_data in part["exchanges"].values():
+            assert exch_data["properties"] == {"timeout": 10000}
+
+
+def test_partition_more_shards_than_units():
+    config = make_config(["binance"], 2)
+    assert len(partition_config(config, 8)) == 2
+
+
+async def fake_factory(config, data_queue, normalizer):
+    # Runs in the shard process: a few messages per stream, then idle
+    async def produce():
+        for i in range(3):
+            for name in producer_names(config):
+                await data_queue.put({"data": i, "producer": name, "received": 0.0})
+        if config.get("crash"):
+            await asyncio.sleep(0.2)
+            os._exit(3)
+        await asyncio.Event().wait()
+    return asyncio.create_task(produce())
+
+
+async def collect(queue, count, timeout=20):
+    messages = []
+    async def take():
+        while len(messages) < count:
+            messages.append(await queue.get())
+    await asyncio.wait_for(take(), timeout)
+    return messages
+
+
+async def test_supervisor_forwards_messages_from_shards():
+    config = make_config(["binance", "bitmex"], 2)
+    queue = BoundedQueue()
+    supervisor = ShardSupervisor(config, shards=2, data_queue=queue, factory=fake_factory, normalize=False)
+    await supervisor.start()
+    try:
+        messages = await collect(queue, 3 * len(producer_names(config)))
+    finally:
+        await supervisor.stop()
+    assert sorted({m["producer"] for m in messages}) == producer_names(config)
+    assert sum(s["messages"] for s in supervisor.stats().values()) == len(messages)
+
+
+async def test_supervisor_restarts_dead_shard():
+    config = make_config(["binance"], 1, streams=("watchTrades",))
+    config["crash"] = True
+    queue = BoundedQueue()
+    supervisor = ShardSupervisor(
+        config, shards=1, data_queue=queue, factory=fake_factory, normalize=False,
+        check_interval=0.05, restart_delay=0.05
+    )
+    await supervisor.start()
+    try:
+        # 3 messages per run, 6 means the shard came back after dying
+        await collect(queue, 6)
+    finally:
+        await supervisor.stop()
+    assert supervisor.stats()[0]["restarts"] >= 1
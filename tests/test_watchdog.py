@@ -0,0 +1,124 @@
+import asyncio
+
+from crypto_data_collector.helpers import Status
+from crypto_data_collector.producer import ProducerPipeline
+from crypto_data_collector.queues import BoundedQueue
+from crypto_data_collector.watchdog import StallWatchdog
+from tests.conftest import make_producer
+
+
+class StallingExchange:
+    """
+    A ticker every `interval` seconds per subscription, the symbols in
+    stall_after go silent for good after that many messages until the
+    websocket connections are closed
+    """
+    name = "stalling"
+
+    def __init__(self, interval=0.01, stall_after=None):
+        self.interval = interval
+        self.stall_after = dict(stall_after or {})
+        self.sent = {}
+        self.subscriptions = {}
+        self.closed = 0
+
+    async def watchTicker(self, symbol, **kwargs):
+        if self.sent.get(symbol, 0) >= self.stall_after.get(symbol, float("inf")):
+            self.subscriptions[symbol] = self.subscriptions.get(symbol, 0) + 1
+            await asyncio.Event().wait()
+        await asyncio.sleep(self.interval)
+        self.sent[symbol] = self.sent.get(symbol, 0) + 1
+        return {"symbol": symbol, "last": 1.0}
+
+    async def close_ws_clients(self):
+        self.closed += 1
+        self.stall_after.clear()
+
+    async def close(self):
+        pass
+
+
+def test_threshold_follows_learned_gap():
+    watchdog = StallWatchdog(stall_factor=10, min_stall_s=1, max_stall_s=60)
+    exchange = StallingExchange()
+    producer = make_producer(exchange, "BTC/USDT", BoundedQueue())
+    producer.state.status = Status.RUNNING
+    producers = {producer.producer_name: producer}
+
+    assert watchdog.find_stalled(producers, now=0.0) == []
+    # 100 messages in 10s, a message every 100ms, stall after 1s (min_stall_s)
+    producer.messages, producer.last_message = 100, 10_000.0
+    assert watchdog.find_stalled(producers, now=10_000.0) == []
+    activity = watchdog.streams[producer.producer_name]
+    assert activity.gap == 100.0
+    assert watchdog.threshold_ms(activity) == 1000.0
+    assert watchdog.find_stalled(producers, now=10_900.0) == []
+    assert watchdog.find_stalled(producers, now=11_100.0) == [producer]
+
+    # A quiet stream, a message every 20s, stall after 200s capped to 60s
+    producer.messages, producer.last_message = 101, 30_000.0
+    watchdog.alpha = 1.0
+    assert watchdog.find_stalled(producers, now=30_000.0) == []
+    assert watchdog.threshold_ms(activity) == 60_000.0
+
+    # Producers backing off are not stalled
+    producer.state.status = Status.BACKOFF
+    assert watchdog.find_stalled(producers, now=200_000.0) == []
+
+
+async def test_stalled_subscription_is_restarted():
+    queue = BoundedQueue()
+    exchange = StallingExchange(stall_after={"ETH/USDT": 3})
+    pipeline = ProducerPipeline(queue, watchdog=StallWatchdog(check_interval=0.05, min_stall_s=0.2, max_stall_s=0.2))
+    healthy, stalled = (make_producer(exchange, symbol, queue) for symbol in ("BTC/USDT", "ETH/USDT"))
+    pipeline.add_producer(healthy.producer_name, healthy)
+    pipeline.add_producer(stalled.producer_name, stalled)
+
+    await asyncio.sleep(0.6)
+    assert stalled.stalls >= 1
+    assert exchange.subscriptions["ETH/USDT"] >= stalled.stalls
+    assert stalled.state.status is Status.RUNNING
+    assert healthy.stalls == 0
+    # Other producers of the exchange are fine, the connection is kept
+    assert exchange.closed == 0
+    for producer in (healthy, stalled):
+        await pipeline.remove_producer(producer.producer_name)
+
+
+async def test_exchange_wide_stall_restarts_connection():
+    queue = BoundedQueue()
+    exchange = StallingExchange(interval=0.005, stall_after={"BTC/USDT": 10, "ETH/USDT": 10})
+    pipeline = ProducerPipeline(queue, watchdog=StallWatchdog(check_interval=0.05, min_stall_s=0.2, max_stall_s=0.2))
+    producers = [make_producer(exchange, symbol, queue) for symbol in ("BTC/USDT", "ETH/USDT")]
+    for producer in producers:
+        pipeline.add_producer(producer.producer_name, producer)
+
+    await asyncio.sleep(0.6)
+    assert exchange.closed == 1
+    assert pipeline.watchdog.stats() == {"stalls": 2, "connection_restarts": 1}
+    # Delivering again after the reconnect
+    count = sum(p.messages for p in producers)
+    await asyncio.sleep(0.1)
+    assert sum(p.messages for p in producers) > count
+    for producer in producers:
+        await pipeline.remove_producer(producer.producer_name)
+
+
+async def test_producer_waiting_on_a_full_queue_is_not_stalled():
+    # No consumer, the BLOCK queue fills up and the producer waits on it
+    queue = BoundedQueue(maxsize=5)
+    exchange = StallingExchange(interval=0.005)
+    pipeline = ProducerPipeline(queue, watchdog=StallWatchdog(check_interval=0.05, min_stall_s=0.1, max_stall_s=0.1))
+    producer = make_producer(exchange, "BTC/USDT", queue)
+    pipeline.add_producer(producer.producer_name, producer)
+
+    await asyncio.sleep(0.5)
+    assert producer.blocked_since is not None
+    assert pipeline.watchdog.stats() == {"stalls": 0, "connection_restarts": 0}
+    assert exchange.closed == 0
+    assert exchange.sent["BTC/USDT"] == 6
+    for _ in range(5):
+        queue.get_nowait()
+    await asyncio.sleep(0)
+    assert producer.messages == 6
+    await pipeline.remove_producer(producer.producer_name)